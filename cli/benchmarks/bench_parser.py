@@ -0,0 +1,155 @@
+"""Benchmarks of the workflow parser and the stage planner.
+
+Synthetic workflows of every requested shape and size are generated and
+the time taken by parsing and by each of the graph operations is stored
+as JSON, so that results of different versions can be compared.
+
+    $ python benchmarks/bench_parser.py --size 100 --size 10000 \\
+        -o results.json
+"""
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import timeit
+
+import click
+import hcl
+
+from popper import __version__ as popper_version, hclparse
+from popper.cli import log
+from popper.parser import Workflow, WorkflowView
+
+from workflow_generator import (SHAPES, action_name, generate_graph,
+                                generate_workflow)
+
+
+def measure(fn, repeat, setup=None):
+    """Runs `fn` `repeat` times and returns the elapsed times, in seconds.
+    When given, `setup` is called before each run and is not timed, its
+    return value is passed to `fn`."""
+    times = list()
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = timeit.default_timer()
+        fn(arg)
+        times.append(timeit.default_timer() - start)
+    return times
+
+
+def benchmark(shape, size, repeat, with_pyhcl, **kwargs):
+    """Benchmarks the parser and the graph operations on a synthetic
+    workflow.
+
+    Returns:
+        dict: The elapsed times of each operation.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        os.environ['POPPER_CACHE_DIR'] = os.path.join(tmp_dir, 'cache')
+        wfile = os.path.join(tmp_dir, 'main.workflow')
+        content = generate_workflow(shape, size, **kwargs)
+        with open(wfile, 'w') as f:
+            f.write(content)
+
+        def fresh_workflow(_=None):
+            wf = Workflow(wfile)
+            if os.path.exists(wf.get_cache_file()):
+                os.remove(wf.get_cache_file())
+            return wf
+
+        def parsed_workflow(_=None):
+            wf = Workflow(wfile)
+            wf.parse()
+            return wf
+
+        results = dict()
+        if with_pyhcl:
+            results['hcl.loads'] = measure(
+                lambda _: hcl.loads(content), repeat)
+        results['hclparse.parse'] = measure(
+            lambda _: hclparse.parse(content), repeat)
+        results['parse'] = measure(
+            lambda wf: wf.parse(), repeat, fresh_workflow)
+        results['parse (cached)'] = measure(
+            lambda wf: wf.parse(), repeat, lambda: Workflow(wfile))
+
+        wf = parsed_workflow()
+        middle = action_name(size // 2)
+        last = action_name(size - 1)
+
+        def planner_setup():
+            wf.reset_levels()
+            return wf
+
+        results['get_stages'] = measure(
+            lambda wf: list(wf.get_stages()), repeat, planner_setup)
+        results['skip_actions'] = measure(
+            lambda _: Workflow.skip_actions(wf, [middle]), repeat)
+        results['filter_action'] = measure(
+            lambda _: Workflow.filter_action(wf, last), repeat)
+        results['filter_action (with dependencies)'] = measure(
+            lambda _: Workflow.filter_action(wf, last, True), repeat)
+        results['check_for_unreachable_actions'] = measure(
+            lambda view: view.check_for_unreachable_actions(), repeat,
+            lambda: WorkflowView(wf))
+        results['check_for_unreachable_actions (skip)'] = measure(
+            lambda view: view.check_for_unreachable_actions([last]), repeat,
+            lambda: Workflow.skip_actions(wf, [last]))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return {
+        'shape': shape,
+        'size': size,
+        'edges': sum(len(n) for n in generate_graph(shape, size, **kwargs)),
+        'times': dict((op, {'min': min(t), 'mean': sum(t) / len(t)})
+                      for op, t in results.items()),
+    }
+
+
+@click.command()
+@click.option('--shape', help='Shape of the workflows (can be given '
+              'multiple times) [default: all].',
+              type=click.Choice(SHAPES), multiple=True)
+@click.option('--size', help='Number of actions of the workflows (can be '
+              'given multiple times) [default: 10, 100, 1000, 10000].',
+              type=int, multiple=True)
+@click.option('--repeat', help='Times each operation is repeated.',
+              default=3, show_default=True)
+@click.option('--width', help='Width of the layers of a diamond.',
+              default=10, show_default=True)
+@click.option('--degree', help='Dependencies of a random action.',
+              default=3, show_default=True)
+@click.option('--seed', help='Seed of random graphs.',
+              default=0, show_default=True)
+@click.option('--skip-pyhcl', help='Do not time the pyhcl parser, which is '
+              'slow on large workflows.', is_flag=True)
+@click.option('-o', '--output', help='Path of the JSON results.',
+              type=click.File('w'), default='-')
+def cli(shape, size, repeat, width, degree, seed, skip_pyhcl, output):
+    """Benchmarks the workflow parser and planner on synthetic
+    workflows."""
+    log.setLevel('CRITICAL')
+
+    results = list()
+    for s in shape or SHAPES:
+        for n in size or [10, 100, 1000, 10000]:
+            click.echo('{} {}'.format(s, n), err=True)
+            results.append(benchmark(s, n, repeat, not skip_pyhcl,
+                                     width=width, degree=degree, seed=seed))
+
+    json.dump({
+        'popper_version': popper_version,
+        'python_version': platform.python_version(),
+        'timestamp': time.time(),
+        'repeat': repeat,
+        'results': results,
+    }, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,135 @@
+"""Generator of synthetic workflows, used to benchmark the parser and the
+stage planner on graphs of different shapes and sizes.
+
+    $ python benchmarks/workflow_generator.py diamond 10000 -o big.workflow
+"""
+import random
+
+import click
+
+
+SHAPES = ['chain', 'fanout', 'diamond', 'random']
+
+
+def chain(size, **kwargs):
+    """Every action needs the previous one."""
+    return [[] if i == 0 else [i - 1] for i in range(size)]
+
+
+def fanout(size, **kwargs):
+    """A root action needed by every other action but the last one, which
+    needs all of them."""
+    needs = [[]] + [[0] for _ in range(1, size - 1)]
+    if size > 1:
+        needs.append(list(range(1, size - 1)) or [0])
+    return needs
+
+
+def diamond(size, width=10, **kwargs):
+    """Layers of `width` actions, each of them needing every action of the
+    previous layer."""
+    needs = list()
+    for i in range(size):
+        layer = i // width
+        if layer == 0:
+            needs.append([])
+        else:
+            start = (layer - 1) * width
+            needs.append(list(range(start, start + width)))
+    return needs
+
+
+def random_dag(size, degree=3, seed=0, **kwargs):
+    """Every action needs up to `degree` randomly chosen actions among the
+    ones declared before it."""
+    rng = random.Random(seed)
+    needs = [[]]
+    for i in range(1, size):
+        needs.append(sorted(rng.sample(range(i), min(degree, i))))
+    return needs
+
+
+GENERATORS = {
+    'chain': chain,
+    'fanout': fanout,
+    'diamond': diamond,
+    'random': random_dag,
+}
+
+
+def generate_graph(shape, size, **kwargs):
+    """Returns the dependencies of a synthetic workflow.
+
+    Args:
+        shape (str): One of `SHAPES`.
+        size (int): The number of actions.
+        kwargs: Extra parameters of the shape, i.e. `width` for diamonds
+                and `degree` and `seed` for random graphs.
+
+    Returns:
+        list: The indices of the actions needed by each action.
+    """
+    if shape not in GENERATORS:
+        raise ValueError('Unknown workflow shape \'{}\'.'.format(shape))
+    return GENERATORS[shape](size, **kwargs)
+
+
+def action_name(i):
+    return 'action-{}'.format(i)
+
+
+def generate_workflow(shape, size, **kwargs):
+    """Returns the content of a synthetic workflow file. The workflow
+    resolves every action that is not needed by any other action.
+
+    Args:
+        shape (str): One of `SHAPES`.
+        size (int): The number of actions.
+        kwargs: Extra parameters of the shape.
+
+    Returns:
+        str: The content of the workflow file.
+    """
+    needs = generate_graph(shape, size, **kwargs)
+    needed = set()
+    for n in needs:
+        needed.update(n)
+    resolves = [action_name(i) for i in range(size) if i not in needed]
+
+    lines = [
+        'workflow "{} {}" {{'.format(shape, size),
+        '  resolves = [{}]'.format(
+            ', '.join('"{}"'.format(r) for r in resolves)),
+        '}',
+    ]
+    for i, n in enumerate(needs):
+        lines.append('')
+        lines.append('action "{}" {{'.format(action_name(i)))
+        lines.append('  uses = "sh"')
+        lines.append('  args = ["true"]')
+        if n:
+            lines.append('  needs = [{}]'.format(
+                ', '.join('"{}"'.format(action_name(j)) for j in n)))
+        lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+@click.command()
+@click.argument('shape', type=click.Choice(SHAPES))
+@click.argument('size', type=int)
+@click.option('--width', help='Width of the layers of a diamond.',
+              default=10, show_default=True)
+@click.option('--degree', help='Dependencies of a random action.',
+              default=3, show_default=True)
+@click.option('--seed', help='Seed of random graphs.',
+              default=0, show_default=True)
+@click.option('-o', '--output', help='Path of the workflow file.',
+              type=click.File('w'), default='-')
+def cli(shape, size, width, degree, seed, output):
+    """Writes a synthetic workflow with SIZE actions of the given SHAPE."""
+    output.write(generate_workflow(shape, size, width=width, degree=degree,
+                                   seed=seed))
+
+
+if __name__ == '__main__':
+    cli()
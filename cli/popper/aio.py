@@ -0,0 +1,270 @@
+"""An asyncio engine for running the actions of a workflow in parallel.
+
+Actions on the host, and the containers of the docker and singularity
+runtimes, are executed as subprocesses whose output and exit code are
+awaited on a single event loop, so many lightweight actions can run at
+the same time without a thread for each one. Pulling and building
+images, creating docker containers and executing actions in any other
+runtime are blocking operations that are run in a pool of threads.
+
+This module requires Python 3.5 or newer, `gha` only imports it when the
+asyncio engine is selected.
+"""
+import asyncio
+import os
+import signal
+import time
+from asyncio.subprocess import PIPE, STDOUT
+from concurrent.futures import ThreadPoolExecutor
+
+import popper.cli
+from popper.cli import log
+from popper import utils as pu
+from popper import log as logging
+from popper.gha import ActionScheduler, run_action_phase
+
+
+# Maximum length of a line of output of an action.
+LINE_LIMIT = 2 ** 20
+
+
+class AsyncActionScheduler(ActionScheduler):
+    """An `ActionScheduler` that runs the actions on an event loop.
+
+    When an action fails, the actions that are still running are
+    cancelled: their processes are terminated and their containers are
+    stopped. Actions that run in the pool of threads are stopped through
+    their runners. With `keep_going`, the actions that do not depend on
+    the failed ones are run instead.
+    """
+
+    def run(self, actions=None):
+        """Runs the actions and waits for all of them to complete.
+
+        Args:
+            actions (iterable): The actions to run. Defaults to all the
+                                actions of the workflow.
+        """
+        loop = asyncio.new_event_loop()
+        pool = ThreadPoolExecutor(max_workers=self.max_workers +
+                                  self.max_pulls)
+        try:
+            loop.run_until_complete(self.run_async(actions, loop, pool))
+        finally:
+            pool.shutdown(wait=True)
+            loop.close()
+
+    async def run_async(self, actions, loop, pool):
+        self.prefix = logging.get_prefix()
+        self.start(actions)
+
+        def submit(phase, runner):
+            return loop.create_task(
+                self.run_phase(phase, runner, loop, pool))
+
+        error = None
+        try:
+            while self.is_running() and error is None:
+                self.dispatch('execute', submit)
+                self.dispatch('prepare', submit)
+                self.wait_for_budget()
+                if not self.running:
+                    continue
+
+                done, _ = await asyncio.wait(
+                    list(self.running), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    e, result = task.result()
+                    if e is None:
+                        self.complete(task, result)
+                    elif self.fail(task, e):
+                        error = e
+        finally:
+            if self.running:
+                self.stop_async(loop, pool)
+                await asyncio.wait(list(self.running))
+                self.release_stopped()
+
+        if error is not None:
+            raise error
+        self.finish()
+
+    def stop_async(self, loop, pool):
+        """Cancels the actions that are running. Actions executing in the
+        pool of threads can not be cancelled, so they are stopped through
+        their runners."""
+        self.queues['prepare'] = list()
+        self.queues['execute'] = list()
+        for task, (phase, a, r) in self.running.items():
+            task.cancel()
+            if phase == 'execute' and r not in ASYNC_RUNNERS:
+                loop.run_in_executor(
+                    pool, self.wf.runners[a].stop, self.reuse)
+
+    async def run_phase(self, phase, runner, loop, pool):
+        """Runs a phase of an action.
+
+        Returns:
+            (BaseException, object): The error raised by the action, if any,
+                                     and the result of the phase.
+        """
+        try:
+            if phase == 'prepare':
+                await loop.run_in_executor(
+                    pool, run_action_phase, phase, runner, self.reuse,
+                    self.prefix)
+                return None, None
+
+            execute = ASYNC_RUNNERS.get(getattr(runner, 'runtime', None))
+            if execute is None:
+                result = await loop.run_in_executor(
+                    pool, run_action_phase, phase, runner, self.reuse,
+                    self.prefix)
+                return None, result
+
+            start = time.time()
+            timeout = None if runner.dry_run else runner.timeout
+            try:
+                await asyncio.wait_for(
+                    execute(runner, self.reuse, loop, pool), timeout)
+            except asyncio.TimeoutError:
+                # The process of the action has been terminated, or its
+                # container stopped, when cancelling it.
+                runner.timed_out = True
+                runner.handle_exit(None)
+            return None, time.time() - start
+        except (Exception, SystemExit) as e:
+            # log.fail() raises SystemExit, which would otherwise stop the
+            # event loop without giving a chance to other actions to be
+            # cancelled.
+            return e, None
+
+
+async def stream_process(name, cmd, shell=False, **kwargs):
+    """Starts a process, logs its output and waits for it to finish. When
+    cancelled, the process group of the process is terminated.
+
+    Args:
+        name (str): The name of the action the process belongs to.
+        cmd (list): The command to execute.
+        shell (bool): Whether to execute the command through the shell.
+        kwargs: Extra arguments for `asyncio.create_subprocess_exec()`.
+
+    Returns:
+        int: The exit code of the process.
+    """
+    log.debug('Executing: {}'.format(' '.join(cmd)))
+    if shell:
+        p = await asyncio.create_subprocess_shell(
+            ' '.join(cmd), stdout=PIPE, stderr=STDOUT, limit=LINE_LIMIT,
+            start_new_session=True, **kwargs)
+    else:
+        p = await asyncio.create_subprocess_exec(
+            *cmd, stdout=PIPE, stderr=STDOUT, limit=LINE_LIMIT,
+            start_new_session=True, **kwargs)
+    popper.cli.process_list.append(p.pid)
+
+    try:
+        while True:
+            line = await p.stdout.readline()
+            if not line:
+                break
+            log.action_info(pu.decode(line).rstrip('\n'))
+        return await p.wait()
+    except asyncio.CancelledError:
+        log.info("Stopping action '{}'".format(name))
+        try:
+            os.killpg(os.getpgid(p.pid), signal.SIGTERM)
+        except OSError:
+            pass
+        await p.wait()
+        raise
+
+
+def get_process_env(runner):
+    """Returns the environment of the process of an action, without
+    modifying the environment of popper."""
+    env = dict(os.environ)
+    env.update(runner.prepare_environment())
+    return env
+
+
+async def execute_host(runner, reuse, loop, pool):
+    """Executes an action of a `HostRunner`."""
+    if reuse:
+        log.fail('--reuse flag is not supported for actions running '
+                 'on the host.')
+
+    cmd = runner.host_command()
+    log.info('{}[{}] {}'.format(runner.msg_prefix, runner.action['name'],
+                                ' '.join(cmd)))
+    if runner.dry_run:
+        runner.handle_exit(0)
+        return
+
+    e = await stream_process(runner.action['name'], cmd, shell=True,
+                             cwd=runner.host_workdir(),
+                             env=get_process_env(runner))
+    runner.handle_exit(e)
+
+
+async def execute_docker(runner, reuse, loop, pool):
+    """Executes an action of a `DockerRunner`. The container is created
+    through the docker API and started with the docker client, which
+    forwards its output and exits with its exit code."""
+    runner.check_executable('docker')
+    await loop.run_in_executor(pool, runner.docker_create_container, reuse)
+
+    log.info('{}[{}] docker start '.format(runner.msg_prefix,
+                                           runner.action['name']))
+    if runner.dry_run:
+        runner.handle_exit(0)
+        return
+
+    try:
+        e = await stream_process(runner.action['name'],
+                                 ['docker', 'start', '--attach', runner.cid])
+    except asyncio.CancelledError:
+        await loop.run_in_executor(pool, runner.container.stop, 1)
+        raise
+    runner.handle_exit(e)
+
+
+async def execute_singularity(runner, reuse, loop, pool):
+    """Executes an action of a `SingularityRunner`."""
+    runner.check_executable('singularity')
+    _, image, _ = runner.get_build_resources()
+    container_path = runner.get_container_path(image)
+
+    env = runner.prepare_environment()
+    volumes = runner.prepare_volumes(env)
+    runs = runner.action.get('runs', None)
+    if runs:
+        cmd = ['singularity', 'exec']
+        commands = runs
+    else:
+        cmd = ['singularity', 'run']
+        commands = runner.action.get('args', None)
+
+    log.info('{}[{}] singularity {} {} {}'.format(
+        runner.msg_prefix, runner.action['name'], cmd[1],
+        container_path, commands))
+    if runner.dry_run:
+        runner.handle_exit(0)
+        return
+
+    cmd += ['--userns', '--pwd', env['GITHUB_WORKSPACE'],
+            '--bind', ','.join(volumes), container_path]
+    cmd += list(commands or [])
+    e = await stream_process(runner.action['name'], cmd,
+                             env=get_process_env(runner))
+    runner.handle_exit(e)
+
+
+# Asynchronous implementations of the execute phase, by runtime. Actions
+# of any other runtime are executed in the pool of threads.
+ASYNC_RUNNERS = {
+    'host': execute_host,
+    'docker': execute_docker,
+    'singularity': execute_singularity,
+}
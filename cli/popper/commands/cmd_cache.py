@@ -0,0 +1,73 @@
+import time
+
+import click
+
+from popper import utils as pu
+from popper.cli import pass_context, log
+from popper.gha import ResultCache
+
+
+@click.group('cache', short_help='Inspect and prune the results cache.')
+@pass_context
+def cli(ctx):
+    """Inspects and prunes the cache of the outputs of actions, populated
+    by `popper run --cache-results`.
+    """
+    pass
+
+
+@cli.command('list', short_help='List the entries of the results cache.')
+@pass_context
+def list_entries(ctx):
+    """Lists the entries of the results cache, least recently used first.
+    """
+    entries = ResultCache.get_entries()
+    now = time.time()
+    for e in entries:
+        log.info('{}  {:>10}  {:>6.1f}d  {} ({})'.format(
+            e['key'][:12], e.get('size', 0), (now - e['used']) / 86400,
+            e.get('action'), e.get('workflow')))
+    log.info('{} entries, {} bytes'.format(
+        len(entries), sum(e.get('size', 0) for e in entries)))
+
+
+@cli.command('prune', short_help='Remove entries from the results cache.')
+@click.option(
+    '--max-size',
+    help=(
+        'Remove the least recently used entries until the cache holds at '
+        'most this amount of data (e.g. 500m or 2g).'),
+    required=False,
+    default=None
+)
+@click.option(
+    '--older-than',
+    help='Remove the entries that were not used in this number of days.',
+    type=click.FloatRange(min=0),
+    required=False,
+    default=None
+)
+@click.option(
+    '--all',
+    'prune_all',
+    help='Remove every entry.',
+    required=False,
+    is_flag=True
+)
+@pass_context
+def prune(ctx, max_size, older_than, prune_all):
+    """Removes entries from the results cache.
+    """
+    if max_size is not None:
+        max_size = pu.parse_memory(max_size)
+        if max_size is None:
+            log.fail('Invalid value for --max-size.')
+    if prune_all:
+        max_size = 0
+    if max_size is None and older_than is None:
+        log.fail('One of --max-size, --older-than or --all is required.')
+
+    max_age = older_than * 86400 if older_than is not None else None
+    removed = ResultCache.evict(max_size=max_size, max_age=max_age)
+    log.info('Removed {} entries, {} bytes'.format(
+        len(removed), sum(e.get('size', 0) for e in removed)))
@@ -1,6 +1,9 @@
 import os
 import re
 import sys
+import threading
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 
@@ -27,6 +30,23 @@ from popper import log as logging
     required=False,
     default=None
 )
+@click.option(
+    '--cache-results',
+    help=(
+        'Restore the outputs of the actions that declare their inputs or '
+        'outputs from the results cache when they have not changed, '
+        'instead of running them.'),
+    required=False,
+    is_flag=True
+)
+@click.option(
+    '--coalesce',
+    help=(
+        'Run only once the actions that only differ by their name, the '
+        'actions that need them wait for the one that is run.'),
+    required=False,
+    is_flag=True
+)
 @click.option(
     '--debug',
     help=(
@@ -40,6 +60,41 @@ from popper import log as logging
     required=False,
     is_flag=True
 )
+@click.option(
+    '--engine',
+    help=(
+        'Engine used to run actions with --parallel: a pool of threads, or '
+        'an asyncio event loop (Python 3 only).'),
+    type=click.Choice(['threads', 'asyncio']),
+    required=False,
+    default='threads'
+)
+@click.option(
+    '--jobs',
+    help=(
+        'Maximum number of actions executed at the same time with '
+        '--parallel [default: number of CPUs].'),
+    type=click.IntRange(min=1),
+    envvar='POPPER_JOBS',
+    required=False,
+    default=None
+)
+@click.option(
+    '--keep-going',
+    help=(
+        'When an action fails, keep running the actions that do not '
+        'depend on it instead of stopping the workflow.'),
+    required=False,
+    is_flag=True
+)
+@click.option(
+    '--lazy-validation',
+    help=(
+        'Only validate the actions that are going to be run. Errors in '
+        'other actions are reported as warnings.'),
+    required=False,
+    is_flag=True
+)
 @click.option(
     '--log-file',
     help='Path to a log file. No log is created if this is not given.',
@@ -52,16 +107,64 @@ from popper import log as logging
 )
 @click.option(
     '--parallel',
-    help='Executes actions in stages in parallel.',
+    help=('Executes actions in parallel, each one as soon as the actions '
+          'it needs have completed.'),
     required=False,
     is_flag=True
 )
+@click.option(
+    '--prefetch',
+    help=(
+        'Pull or build in the background the images of the actions up to '
+        'this number of levels ahead of the ones executing.'),
+    type=click.IntRange(min=0),
+    envvar='POPPER_PREFETCH',
+    required=False,
+    default=0
+)
+@click.option(
+    '--prefetch-jobs',
+    help='Maximum number of images prefetched at the same time.',
+    type=click.IntRange(min=1),
+    envvar='POPPER_PREFETCH_JOBS',
+    required=False,
+    default=1,
+    show_default=True
+)
+@click.option(
+    '--pull-jobs',
+    help=(
+        'Maximum number of images pulled or built at the same time with '
+        '--parallel [default: same as --jobs].'),
+    type=click.IntRange(min=1),
+    envvar='POPPER_PULL_JOBS',
+    required=False,
+    default=None
+)
 @click.option(
     '--quiet',
     help='Do not print output generated by actions.',
     required=False,
     is_flag=True
 )
+@click.option(
+    '--repeat',
+    help=(
+        'Execute the actions this number of times, reusing the cloned '
+        'actions and images, and report statistics about their wall time.'),
+    type=click.IntRange(min=1),
+    required=False,
+    default=1,
+    show_default=True
+)
+@click.option(
+    '--resume',
+    help=(
+        'Do not run again the actions that completed successfully in a '
+        'previous run of the same commit and have not changed since.'),
+    required=False,
+    is_flag=True
+)
 @click.option(
     '--reuse',
     help='Reuse containers between executions (persist container state).',
@@ -75,6 +178,14 @@ from popper import log as logging
     required=False,
     default='docker'
 )
+@click.option(
+    '--samples-file',
+    help=(
+        'Write the wall time and exit code of every execution of an action '
+        'to this file, in JSON format if it ends with .json or in CSV.'),
+    required=False,
+    default=None
+)
 @click.option(
     '--skip',
     help=('Skip the given action (can be given multiple times).'),
@@ -94,6 +205,27 @@ from popper import log as logging
     required=False,
     is_flag=True
 )
+@click.option(
+    '--timeout',
+    help=(
+        'Stop the actions that execute for longer than this duration, e.g. '
+        '90, 30m or 2h. Actions override it through the POPPER_TIMEOUT key '
+        'of their env attribute.'),
+    callback=lambda ctx, param, value: parse_timeout(value),
+    envvar='POPPER_TIMEOUT',
+    required=False,
+    default=None
+)
+@click.option(
+    '--warmup',
+    help=(
+        'With --repeat, execute the actions this number of times before '
+        'the measured runs.'),
+    type=click.IntRange(min=0),
+    required=False,
+    default=0,
+    show_default=True
+)
 @click.option(
     '--with-dependencies',
     help=(
@@ -103,6 +235,18 @@ from popper import log as logging
     required=False,
     is_flag=True
 )
+@click.option(
+    '--workflow-jobs',
+    help=(
+        'Maximum number of workflows executed at the same time in CI, '
+        'either the runs given in the commit message or the workflows '
+        'found in the repository. Their actions share the --jobs limit.'),
+    type=click.IntRange(min=1),
+    envvar='POPPER_WORKFLOW_JOBS',
+    required=False,
+    default=1,
+    show_default=True
+)
 @click.option(
     '--workspace',
     help='Path to workspace folder.',
@@ -139,14 +283,19 @@ def cli(ctx, **kwargs):
     `popper:run[...]`. If found, popper executes with the options given in
     these run instances else popper executes all the workflows recursively.
     """
+    check_python_version(kwargs)
+
     if os.environ.get('CI') == 'true':
         # When CI is set,
         log.info('Running in CI environment...')
         popper_run_instances = parse_commit_message()
         if popper_run_instances:
+            workflow_jobs = kwargs['workflow_jobs']
+            runs = list()
             for args in get_args(popper_run_instances):
                 kwargs.update(args)
-                prepare_workflow_execution(**kwargs)
+                runs.append(dict(kwargs))
+            run_workflows(runs, workflow_jobs, prepare_workflow_execution)
         else:
             # If no special keyword is found, we run all the workflows,
             # recursively.
@@ -174,35 +323,93 @@ def prepare_workflow_execution(recursive=False, **kwargs):
     kwargs.pop('quiet')
     kwargs.pop('debug')
     kwargs.pop('log_file')
+    workflow_jobs = kwargs.pop('workflow_jobs')
 
     # Run the workflow accordingly as recursive/CI and Non-CI.
     if recursive:
-        for wfile in pu.find_recursive_wfile():
-            kwargs['wfile'] = wfile
-            run_workflow(**kwargs)
+        run_workflows([dict(kwargs, wfile=wfile)
+                       for wfile in pu.find_recursive_wfile()],
+                      workflow_jobs)
     else:
         run_workflow(**kwargs)
 
 
+def run_workflows(runs, max_workflows=1, target=None):
+    """Runs several workflows, at most `max_workflows` at the same time.
+
+    Workflows that run at the same time share the limit on the number of
+    actions executing at the same time (`--jobs`), their messages are
+    prefixed with the workflow they belong to, and the execution fails
+    once all of them have finished if any of them failed.
+
+    Args:
+        runs (list): The arguments of each run.
+        max_workflows (int): Maximum number of workflows running at the
+                             same time.
+        target (function): Runs a workflow given its arguments. Defaults
+                           to `run_workflow()`.
+    """
+    target = target or run_workflow
+    if max_workflows == 1 or len(runs) < 2:
+        for kwargs in runs:
+            target(**kwargs)
+        return
+
+    # Nested runs share the budget of the runs they belong to.
+    budget = runs[0].get('budget') or threading.Semaphore(
+        runs[0].get('jobs') or mp.cpu_count())
+    runs = [dict(kwargs, budget=budget) for kwargs in runs]
+    failed = list()
+
+    def run(i, kwargs):
+        name = kwargs['wfile'] or 'run {}'.format(i + 1)
+        if kwargs['wfile']:
+            name = os.path.relpath(kwargs['wfile'])
+        logging.set_prefix('[{}] '.format(name))
+        try:
+            target(**kwargs)
+        except SystemExit as e:
+            if e.code:
+                failed.append(name)
+        except Exception as e:
+            log.warning('Unexpected error: {}'.format(e))
+            failed.append(name)
+        finally:
+            logging.set_prefix(None)
+
+    with ThreadPoolExecutor(max_workers=max_workflows) as ex:
+        for f in [ex.submit(run, i, kwargs) for i, kwargs in enumerate(runs)]:
+            f.result()
+
+    if failed:
+        log.fail('Workflows {} failed.'.format(', '.join(sorted(failed))))
+
+
 def run_workflow(**kwargs):
 
     kwargs['wfile'] = pu.find_default_wfile(kwargs['wfile'])
     log.info('Found and running workflow at ' + kwargs['wfile'])
     # Initialize a Worklow. During initialization all the validation
     # takes place automatically.
+    lazy = kwargs.pop('lazy_validation', False)
+    targets = [kwargs['action']] if kwargs['action'] else None
+    keep = [kwargs['on_failure']] if kwargs['on_failure'] else None
     wf = Workflow(kwargs['wfile'])
-    wf_runner = WorkflowRunner(wf)
+    wf_runner = WorkflowRunner(wf, lazy, targets, keep)
 
     # Check for injected actions
     pre_wfile = os.environ.get('POPPER_PRE_WORKFLOW_PATH')
     post_wfile = os.environ.get('POPPER_POST_WORKFLOW_PATH')
 
     # Saving workflow instance for signal handling
-    popper.cli.interrupt_params['parallel'] = kwargs['parallel']
+    popper.cli.interrupt_params['parallel'] = (kwargs['parallel']
+                                               or kwargs['keep_going']
+                                               or kwargs['prefetch'])
+
+    # Options can also be given by popper:run instances of the commit.
+    check_python_version(kwargs)
 
     if kwargs['parallel']:
-        if sys.version_info[0] < 3:
-            log.fail('--parallel is only supported on Python3')
         log.warning("Using --parallel may result in interleaved output. "
                  "You may use --quiet flag to avoid confusion.")
 
@@ -217,24 +424,25 @@ def run_workflow(**kwargs):
     on_failure = kwargs.pop('on_failure')
     wfile = kwargs.pop('wfile')
 
+    # Injected workflows, and the action run on failure, are not repeated.
+    once_kwargs = dict(kwargs, repeat=1, warmup=0, samples_file=None)
+
     try:
         if pre_wfile:
             pre_wf = Workflow(pre_wfile)
-            pre_wf_runner = WorkflowRunner(pre_wf)
-            pre_wf_runner.run(**kwargs)
+            pre_wf_runner = WorkflowRunner(pre_wf, lazy)
+            pre_wf_runner.run(**once_kwargs)
 
         wf_runner.run(**kwargs)
 
         if post_wfile:
             post_wf = Workflow(post_wfile)
-            pre_wf_runner = WorkflowRunner(post_wf)
-            pre_wf_runner.run(**kwargs)
+            pre_wf_runner = WorkflowRunner(post_wf, lazy)
+            pre_wf_runner.run(**once_kwargs)
 
     except SystemExit as e:
         if (e.code != 0) and on_failure:
-            kwargs['skip'] = list()
-            kwargs['action'] = on_failure
-            wf_runner.run(**kwargs)
+            wf_runner.run(**dict(once_kwargs, skip=list(), action=on_failure))
         else:
             raise
 
@@ -244,6 +452,35 @@ def run_workflow(**kwargs):
         log.info('Workflow "{}" finished successfully.'.format(wfile))
 
 
+def check_python_version(kwargs):
+    """Fails if an option that runs actions, or workflows, concurrently
+    is used on Python 2.
+
+    Args:
+        kwargs (dict): The options of the run.
+    """
+    if sys.version_info[0] >= 3:
+        return
+    options = [('--parallel', kwargs.get('parallel')),
+               ('--keep-going', kwargs.get('keep_going')),
+               ('--prefetch', kwargs.get('prefetch')),
+               ('--workflow-jobs', kwargs.get('workflow_jobs', 1) != 1)]
+    used = [name for name, value in options if value]
+    if used:
+        log.fail('{} {} only supported on Python3'.format(
+            ', '.join(used), 'is' if len(used) == 1 else 'are'))
+
+
+def parse_timeout(value):
+    """Parse the value of the --timeout option into seconds."""
+    if value is None:
+        return None
+    seconds = pu.parse_duration(value)
+    if seconds is None:
+        raise click.BadParameter('must be a duration, e.g. 90, 30m or 2h.')
+    return seconds or None
+
+
 def parse_commit_message():
     """Parse `popper:run[]` keywords from head commit message.
     """
@@ -1,19 +1,25 @@
 from __future__ import unicode_literals
 import os
+import csv
+import json
+import heapq
+import hashlib
 import shutil
 import signal
+import sys
 import time
 import getpass
 import threading
 import subprocess
 import multiprocessing as mp
-from copy import deepcopy
 from builtins import dict
 from distutils.dir_util import copy_tree
 from distutils.spawn import find_executable
-from concurrent.futures import (ProcessPoolExecutor,
+from concurrent.futures import (FIRST_COMPLETED,
+                                ProcessPoolExecutor,
                                 ThreadPoolExecutor,
-                                as_completed)
+                                as_completed,
+                                wait)
 from subprocess import CalledProcessError, PIPE, Popen, STDOUT
 
 import yaml
@@ -25,21 +31,24 @@ from spython.main.parse.writers import SingularityWriter
 
 import popper.cli
 from popper.cli import log
-from popper import scm, utils as pu
-from popper.parser import Workflow
+from popper import scm, utils as pu, log as logging
+from popper.parser import Workflow, WorkflowView
 
 
 yaml.Dumper.ignore_aliases = lambda *args: True
 s_client = spython.main.Client
 
+# Exit code of the actions that exceed their timeout, as for timeout(1).
+TIMEOUT_EXIT_CODE = 124
+
 
 class WorkflowRunner(object):
     """A GHA workflow runner.
     """
 
-    def __init__(self, workflow):
+    def __init__(self, workflow, lazy=False, targets=None, keep=None):
         self.wf = workflow
-        self.wf.parse()
+        self.wf.parse(lazy, targets, keep)
         self.wid = pu.get_id(os.getuid(), self.wf.workflow_path)
         log.debug('workflow:\n{}'.format(
             yaml.dump(self.wf, default_flow_style=False, default_style='')))
@@ -77,10 +86,12 @@ class WorkflowRunner(object):
         cloned = set()
         infoed = False
 
-        for _, a in wf.action.items():
+        for a_name in list(wf.action):
+            a = wf.action[a_name]
             if ('docker://' in a['uses']
                     or './' in a['uses'] or a['uses'] == 'sh'):
                 continue
+            a = wf.edit_action(a_name)
 
             url, service, user, repo, action_dir, version = scm.parse(
                 a['uses'])
@@ -115,7 +126,8 @@ class WorkflowRunner(object):
 
     @staticmethod
     def instantiate_runners(runtime, wf, workspace, dry_run, skip_pull, wid):
-        """Factory of ActionRunner instances, one for each action.
+        """Factory of ActionRunner instances, one for each action, kept in
+        the `runners` attribute of the workflow by action name.
 
         Note:
             If the `uses` attribute startswith a './' and does not have
@@ -125,10 +137,10 @@ class WorkflowRunner(object):
             Same is the case when the `uses` attribute is equal to 'sh'.
         """
         env = WorkflowRunner.get_workflow_env(wf, workspace)
-        for _, a in wf.action.items():
+        for a_name, a in wf.action.items():
 
             if a['uses'] == 'sh':
-                a['runner'] = HostRunner(
+                wf.runners[a_name] = HostRunner(
                     a, workspace, env, dry_run, skip_pull, wid)
                 continue
 
@@ -137,20 +149,20 @@ class WorkflowRunner(object):
                     os.path.join(scm.get_git_root_folder(), a['uses'],
                                  'Dockerfile')):
 
-                    a['runner'] = HostRunner(
+                    wf.runners[a_name] = HostRunner(
                         a, workspace, env, dry_run, skip_pull, wid)
                     continue
 
             if runtime == 'docker':
-                a['runner'] = DockerRunner(
+                wf.runners[a_name] = DockerRunner(
                     a, workspace, env, dry_run, skip_pull, wid)
 
             elif runtime == 'singularity':
-                a['runner'] = SingularityRunner(
+                wf.runners[a_name] = SingularityRunner(
                     a, workspace, env, dry_run, skip_pull, wid)
 
             elif runtime == 'vagrant':
-                a['runner'] = VagrantRunner(
+                wf.runners[a_name] = VagrantRunner(
                     a, workspace, env, dry_run, skip_pull, wid)
 
     @staticmethod
@@ -180,10 +192,66 @@ class WorkflowRunner(object):
 
     def run(self, action, skip_clone, skip_pull, skip, workspace,
             reuse, dry_run, parallel, with_dependencies, runtime,
-            skip_secrets_prompt=False):
+            skip_secrets_prompt=False, jobs=None, pull_jobs=None,
+            engine='threads', keep_going=False, prefetch=0,
+            prefetch_jobs=1, budget=None, resume=False,
+            cache_results=False, timeout=None, repeat=1, warmup=0,
+            samples_file=None, coalesce=False):
         """Run the workflow or a specific action.
+
+        When running in parallel, at most `jobs` actions are executed and
+        at most `pull_jobs` images are pulled or built at the same time,
+        both default to the number of CPUs. The environment variables
+        `POPPER_<RUNTIME>_JOBS` and `POPPER_<RUNTIME>_PULL_JOBS` (e.g.
+        `POPPER_SINGULARITY_PULL_JOBS=2`) further limit the actions of
+        each runtime. With the 'asyncio' engine, actions are run on an
+        event loop instead of a pool of threads (see `popper.aio`).
+
+        As soon as an action fails, no other action is started and the
+        ones that are running are stopped. With `keep_going`, the actions
+        that do not depend on the failed ones are run to completion
+        instead, one at a time unless running in parallel.
+
+        Unless prefetching, the distinct images of the actions are pulled
+        or built once before running any action, at most `pull_jobs` at
+        the same time. With `prefetch`, the images of the actions up to
+        that many levels ahead of the ones executing are pulled or built
+        in the background instead, at most `prefetch_jobs` at the same
+        time.
+
+        When several workflows run at the same time, `budget` is a
+        semaphore that they share to limit the total number of actions
+        executing at the same time.
+
+        The outcome of every action is recorded in a journal. With
+        `resume`, the actions that completed successfully in a previous
+        run of the same commit, and that have not changed since, are not
+        run again.
+
+        With `cache_results`, the outputs of the actions that declare
+        their inputs or outputs are stored in the results cache, and are
+        restored instead of executing the actions when neither they nor
+        their inputs have changed (see `ResultCache`).
+
+        Actions that execute for longer than `timeout` seconds, or than
+        the `POPPER_TIMEOUT` key of their `env` attribute, are stopped and
+        fail with a distinct exit code.
+
+        For benchmarking, the actions are executed `warmup` times and then
+        `repeat` times, reusing the cloned actions and prepared images.
+        Statistics about the wall time of the actions in the latter runs
+        are printed at the end, and their samples written to
+        `samples_file`, in CSV or, for `.json` files, JSON format.
+
+        With `coalesce`, the actions that are identical to another one but
+        for their name are not run, and the actions that need them wait
+        for the other one instead.
         """
-        new_wf = deepcopy(self.wf)
+        measure = repeat > 1 or warmup or samples_file
+        if measure and cache_results:
+            log.fail('Results can not be cached when repeating runs.')
+
+        new_wf = WorkflowView(self.wf)
 
         if skip:
             new_wf = Workflow.skip_actions(self.wf, skip)
@@ -193,34 +261,1361 @@ class WorkflowRunner(object):
 
         new_wf.check_for_unreachable_actions(skip)
 
+        if coalesce:
+            new_wf = Workflow.coalesce_actions(new_wf)
+
         WorkflowRunner.check_secrets(new_wf, dry_run, skip_secrets_prompt)
         WorkflowRunner.download_actions(new_wf, dry_run, skip_clone, self.wid)
         WorkflowRunner.instantiate_runners(
             runtime, new_wf, workspace, dry_run, skip_pull, self.wid)
+        for a in new_wf.action:
+            new_wf.runners[a].timeout = get_timeout(
+                new_wf.action[a], timeout)
+            if isinstance(new_wf.runners[a], VagrantRunner):
+                # The VM is kept running until the last repetition.
+                new_wf.runners[a].executions = warmup + repeat
+
+        journal = RunJournal(self.wid, scm.get_sha())
+        completed = set()
+        if resume:
+            completed = journal.get_completed(new_wf)
+            for a in sorted(completed):
+                log.info("[popper] Skipping action '{}', it completed in a "
+                         "previous run".format(a))
+        actions = [a for a in new_wf.action if a not in completed]
+        results = None
+        if cache_results:
+            results = ResultCache(new_wf, workspace)
+        if dry_run:
+            journal, results = None, None
+
+        if not prefetch:
+            WorkflowRunner.prepare_images(new_wf, reuse, pull_jobs, actions)
+
+        samples = None
+        if measure:
+            samples = ActionSamples()
+
+        durations = ActionDurations(self.wid)
+        try:
+            for i in range(warmup + repeat):
+                measured = None
+                if samples:
+                    samples.iteration = i - warmup
+                    if i < warmup:
+                        log.info('[popper] Warmup run {} of {}'.format(
+                            i + 1, warmup))
+                    else:
+                        log.info('[popper] Run {} of {}'.format(
+                            i - warmup + 1, repeat))
+                        measured = samples
+                self.execute(new_wf, actions, completed, runtime, reuse,
+                             durations, parallel, jobs, pull_jobs, engine,
+                             keep_going, prefetch, prefetch_jobs, budget,
+                             journal, results, measured)
+        finally:
+            if not dry_run:
+                durations.save()
+            if samples:
+                samples.report()
+                if samples_file:
+                    samples.save(samples_file)
+            if results:
+                max_size = os.environ.get('POPPER_RESULTS_CACHE_SIZE')
+                if max_size:
+                    ResultCache.evict(max_size=pu.parse_memory(max_size))
+
+    @staticmethod
+    def execute(wf, actions, completed, runtime, reuse, durations, parallel,
+                jobs, pull_jobs, engine, keep_going, prefetch, prefetch_jobs,
+                budget, journal, results, samples):
+        """Executes the actions of a workflow once, see `run()`."""
+        if parallel or keep_going or prefetch:
+            if not parallel:
+                jobs, pull_jobs = 1, 1
+            Scheduler = ActionScheduler
+            if engine == 'asyncio':
+                if sys.version_info < (3, 5):
+                    log.fail('The asyncio engine is only supported on '
+                             'Python 3.5 or newer.')
+                from popper.aio import AsyncActionScheduler as Scheduler
+            Scheduler(
+                runtime, wf, reuse, durations, jobs, pull_jobs,
+                ActionScheduler.get_runtime_caps(),
+                ActionScheduler.get_runtime_caps(pull=True),
+                keep_going=keep_going, lookahead=prefetch,
+                max_prefetches=prefetch_jobs, budget=budget,
+                journal=journal, results=results, samples=samples).run(
+                    actions)
+        else:
+            for s in wf.get_stages():
+                s = [a for a in s if a not in completed]
+                WorkflowRunner.run_stage(
+                    runtime, wf, s, reuse, durations=durations,
+                    budget=budget, journal=journal, results=results,
+                    samples=samples)
+
+    @staticmethod
+    def prepare_images(wf, reuse=False, max_workers=None, actions=None):
+        """Pulls or builds every distinct image of the actions of a
+        workflow once, at most `max_workers` (by default the number of
+        CPUs) at the same time, and marks the actions as prepared.
+
+        Args:
+            actions (iterable): The actions to prepare. Defaults to all the
+                                actions of the workflow.
 
-        for s in new_wf.get_stages():
-            WorkflowRunner.run_stage(runtime, new_wf, s, reuse, parallel)
+        Returns:
+            (int, int): The number of images that were pulled or built and
+                        the number of actions that reuse one of them.
+        """
+        images = dict()
+        for a in sorted(actions if actions is not None else wf.action):
+            key = get_image_key(wf.runners[a], reuse)
+            if key is not None:
+                images.setdefault(key, list()).append(a)
+        if not images:
+            return 0, 0
+
+        log.info('[popper] Preparing {} images'.format(len(images)))
+        with ThreadPoolExecutor(
+                max_workers=max_workers or mp.cpu_count()) as ex:
+            futures = dict(
+                (ex.submit(run_action_phase, 'prepare',
+                           wf.runners[actions[0]], reuse,
+                           logging.get_prefix()), actions)
+                for actions in images.values())
+            for f in as_completed(futures):
+                try:
+                    f.result()
+                except (Exception, SystemExit):
+                    for p in futures:
+                        p.cancel()
+                    raise
+                for a in futures[f]:
+                    wf.runners[a].prepared = True
+
+        fetched = len(images)
+        reused = sum(len(actions) for actions in images.values()) - fetched
+        log.info('[popper] {} images fetched, {} reused by other '
+                 'actions'.format(fetched, reused))
+        return fetched, reused
 
     @staticmethod
-    def run_stage(runtime, wf, stage, reuse=False, parallel=False):
+    def run_stage(runtime, wf, stage, reuse=False, parallel=False,
+                  durations=None, budget=None, journal=None, results=None,
+                  samples=None):
         """Runs actions in a stage either parallely or
         sequentially."""
-        if runtime == 'singularity':
-            Executor = ProcessPoolExecutor
-        else:
-            Executor = ThreadPoolExecutor
         if parallel:
-            with Executor(max_workers=mp.cpu_count()) as ex:
-                flist = {
-                    ex.submit(wf.action[a]['runner'].run, reuse):
-                        a for a in stage
-                }
-                popper.cli.flist = flist
-                for future in as_completed(flist):
-                    future.result()
+            ActionScheduler(runtime, wf, reuse, durations,
+                            budget=budget, journal=journal,
+                            results=results, samples=samples).run(stage)
         else:
             for a in stage:
-                wf.action[a]['runner'].run(reuse)
+                start = None
+                try:
+                    prepare_action(wf.runners[a], reuse)
+                    if results and results.restore(a):
+                        if journal:
+                            journal.record(wf.action[a], 0)
+                        continue
+                    if budget:
+                        budget.acquire()
+                    start = time.time()
+                    try:
+                        elapsed = execute_action(
+                            wf.runners[a], reuse)
+                    finally:
+                        if budget:
+                            budget.release()
+                except (Exception, SystemExit) as e:
+                    if journal:
+                        journal.record(wf.action[a], get_exit_code(e))
+                    if samples and start is not None:
+                        samples.record(a, time.time() - start,
+                                       get_exit_code(e))
+                    raise
+                if durations:
+                    durations.record(a, elapsed)
+                if samples:
+                    samples.record(a, elapsed)
+                if results:
+                    results.store(a)
+                if journal:
+                    journal.record(wf.action[a], 0)
+
+
+def get_resource_hints(action):
+    """Returns the resources requested by an action through the
+    `POPPER_CPUS` and `POPPER_MEMORY` keys of its `env` attribute.
+
+    Args:
+        action (dict): The action.
+
+    Returns:
+        (float, int): The number of CPUs and the memory, in bytes, that
+                      the action needs, None for the ones not given.
+    """
+    env = action.get('env', dict())
+    cpus = env.get('POPPER_CPUS', None)
+    memory = env.get('POPPER_MEMORY', None)
+
+    if cpus is not None:
+        try:
+            cpus = float(cpus)
+        except ValueError:
+            cpus = -1
+        if cpus <= 0:
+            log.fail("Action '{}': POPPER_CPUS must be a positive "
+                     "number.".format(action['name']))
+
+    if memory is not None:
+        memory = pu.parse_memory(memory)
+        if not memory:
+            log.fail("Action '{}': POPPER_MEMORY must be an amount of "
+                     "memory, e.g. 512m or 2g.".format(action['name']))
+
+    return cpus, memory
+
+
+def get_timeout(action, default=None):
+    """Returns the maximum number of seconds an action may execute for,
+    given through the `POPPER_TIMEOUT` key of its `env` attribute, or
+    the default timeout of the workflow.
+
+    Args:
+        action (dict): The action.
+        default (float): The default timeout, None for no timeout.
+
+    Returns:
+        float: The timeout in seconds, or None for no timeout.
+    """
+    timeout = action.get('env', dict()).get('POPPER_TIMEOUT', None)
+    if timeout is None:
+        return default
+    seconds = pu.parse_duration(timeout)
+    if seconds is None:
+        log.fail("Action '{}': POPPER_TIMEOUT must be a duration, e.g. 90, "
+                 "30m or 2h.".format(action['name']))
+    # A timeout of 0 disables the default one.
+    return seconds or None
+
+
+def prepare_action(runner, reuse=False):
+    """Prepares an action, i.e. pulls or builds its image, unless its
+    image has already been prepared."""
+    if getattr(runner, 'prepared', False):
+        return
+    runner.prepare(reuse)
+
+
+def get_image_key(runner, reuse=False):
+    """Returns the image an action is run from, for the actions that can
+    share it with others.
+
+    Vagrant actions, whose images live in the VM of each action, and
+    docker actions whose container is going to be reused, do not share
+    images.
+
+    Returns:
+        tuple: The runtime, the image reference and the build source, or
+               None if the action does not share its image.
+    """
+    if (not isinstance(runner, (DockerRunner, SingularityRunner))
+            or isinstance(runner, VagrantRunner)):
+        return None
+    if reuse and runner.runtime == 'docker' and runner.docker_exists():
+        return None
+    _, image, build_source = runner.get_build_resources()
+    return runner.runtime, image, build_source
+
+
+def execute_action(runner, reuse=False):
+    """Executes a prepared action and returns the time it took, in
+    seconds. Actions that have a timeout are stopped by a watchdog once
+    it expires."""
+    watchdog = None
+    timeout = getattr(runner, 'timeout', None)
+    if timeout and not getattr(runner, 'dry_run', False):
+        watchdog = threading.Timer(timeout, time_out, (runner, reuse))
+        watchdog.daemon = True
+        watchdog.start()
+
+    start = time.time()
+    try:
+        runner.execute(reuse)
+    finally:
+        if watchdog:
+            watchdog.cancel()
+    return time.time() - start
+
+
+def time_out(runner, reuse=False):
+    """Stops an action that exceeded its timeout."""
+    runner.timed_out = True
+    runner.stop(reuse)
+
+
+def run_action_phase(phase, runner, reuse=False, prefix=None):
+    """Runs a phase of an action in a worker of a pool, logging with the
+    prefix of the workflow the action belongs to."""
+    logging.set_prefix(prefix)
+    if phase == 'prepare':
+        return prepare_action(runner, reuse)
+    return execute_action(runner, reuse)
+
+
+class ActionDurations(object):
+    """The durations of the actions of a workflow in previous runs, stored
+    in the durations cache and keyed by workflow id and action name.
+    """
+
+    # Weight of the latest run in the recorded duration of an action.
+    WEIGHT = 0.5
+
+    def __init__(self, wid):
+        self.path = os.path.join(
+            pu.setup_durations_cache(), '{}.json'.format(wid))
+        self.durations = dict()
+        self.updated = False
+        try:
+            with open(self.path, 'r') as f:
+                self.durations = dict(json.load(f))
+        except (IOError, OSError, ValueError, TypeError):
+            pass
+
+    def get(self, action):
+        """Returns the recorded duration of an action or None."""
+        return self.durations.get(action, None)
+
+    def estimate(self, action):
+        """Returns the expected duration of an action. Actions that have
+        not been run before are expected to take as long as the average
+        recorded action, or 1 second when there is no history at all.
+        """
+        if action in self.durations:
+            return self.durations[action]
+        if self.durations:
+            return sum(self.durations.values()) / len(self.durations)
+        return 1.0
+
+    def record(self, action, seconds):
+        """Records the duration of a successful run of an action."""
+        if action in self.durations:
+            seconds = (self.WEIGHT * seconds
+                       + (1 - self.WEIGHT) * self.durations[action])
+        self.durations[action] = seconds
+        self.updated = True
+
+    def save(self):
+        """Stores the recorded durations in the durations cache."""
+        if not self.updated:
+            return
+        tmp_file = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self.durations, f)
+            os.rename(tmp_file, self.path)
+        except (IOError, OSError):
+            log.debug('Unable to write durations file {}'.format(self.path))
+
+
+class ActionSamples(object):
+    """The wall time and exit code of every execution of the actions of a
+    workflow over repeated runs, and statistics about them.
+    """
+
+    # Percentiles reported besides the median.
+    PERCENTILES = [90, 95, 99]
+
+    # Columns of the samples in CSV format.
+    FIELDS = ['iteration', 'action', 'seconds', 'exit_code']
+
+    def __init__(self):
+        self.iteration = 0
+        self.samples = list()
+
+    def record(self, action, seconds, exit_code=0):
+        """Records an execution of an action in the current iteration."""
+        self.samples.append({
+            'iteration': self.iteration,
+            'action': action,
+            'seconds': seconds,
+            'exit_code': exit_code,
+        })
+
+    @staticmethod
+    def get_percentile(values, p):
+        """Returns the `p`-th percentile of sorted values, interpolating
+        between the closest ones."""
+        rank = (len(values) - 1) * p / 100.0
+        low = int(rank)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (rank - low)
+
+    def get_stats(self):
+        """Returns statistics about the wall time of the successful
+        executions of each action.
+
+        Returns:
+            dict: For each action, the number of `runs` and `failures`
+                  and, if it succeeded at least once, the `mean`,
+                  `median`, `stddev`, `min`, `max` and percentiles (e.g.
+                  `p90`) of its wall time, in seconds.
+        """
+        stats = dict()
+        for a in sorted(set(s['action'] for s in self.samples)):
+            runs = [s for s in self.samples if s['action'] == a]
+            times = sorted(s['seconds'] for s in runs if not s['exit_code'])
+            stats[a] = {'runs': len(runs), 'failures': len(runs) - len(times)}
+            if not times:
+                continue
+            mean = sum(times) / len(times)
+            stddev = 0.0
+            if len(times) > 1:
+                stddev = (sum((t - mean) ** 2 for t in times)
+                          / (len(times) - 1)) ** 0.5
+            stats[a].update({
+                'mean': mean,
+                'median': ActionSamples.get_percentile(times, 50),
+                'stddev': stddev,
+                'min': times[0],
+                'max': times[-1],
+            })
+            for p in ActionSamples.PERCENTILES:
+                stats[a]['p{}'.format(p)] = ActionSamples.get_percentile(
+                    times, p)
+        return stats
+
+    def report(self):
+        """Prints the statistics of every action."""
+        columns = (['mean', 'median', 'stddev']
+                   + ['p{}'.format(p) for p in ActionSamples.PERCENTILES])
+        log.info('[popper] {:<30} {:>5} {:>6} {}'.format(
+            'action', 'runs', 'failed',
+            ' '.join('{:>9}'.format(c) for c in columns)))
+        for a, entry in sorted(self.get_stats().items()):
+            log.info('[popper] {:<30} {:>5} {:>6} {}'.format(
+                a, entry['runs'], entry['failures'],
+                ' '.join('{:>9.3f}'.format(entry[c]) if c in entry
+                         else '{:>9}'.format('-') for c in columns)))
+
+    def save(self, path):
+        """Writes the samples to a file, in JSON format along with their
+        statistics if its name ends with `.json`, or in CSV format."""
+        try:
+            if path.endswith('.json'):
+                with open(path, 'w') as f:
+                    json.dump({'samples': self.samples,
+                               'stats': self.get_stats()}, f, indent=2)
+            else:
+                with open(path, 'w') as f:
+                    writer = csv.DictWriter(f, ActionSamples.FIELDS,
+                                            lineterminator='\n')
+                    writer.writeheader()
+                    writer.writerows(self.samples)
+        except (IOError, OSError) as e:
+            log.fail('Unable to write samples file {}: {}'.format(path, e))
+        log.info('[popper] Samples written to {}'.format(path))
+
+
+class RunJournal(object):
+    """The outcome of the actions of a workflow in previous runs of the
+    same commit, stored in the journals cache and keyed by workflow id
+    and git SHA. It is written as soon as each action finishes, so that
+    a failed run can be resumed.
+    """
+
+    # Attributes of an action that define what it does.
+    ATTRIBUTES = ['uses', 'runs', 'args', 'env', 'secrets', 'needs']
+
+    def __init__(self, wid, sha):
+        self.path = os.path.join(
+            pu.setup_journal_cache(), '{}_{}.json'.format(wid, sha))
+        self.entries = dict()
+        try:
+            with open(self.path, 'r') as f:
+                self.entries = dict(json.load(f))
+        except (IOError, OSError, ValueError, TypeError):
+            pass
+
+    @staticmethod
+    def get_digest(action):
+        """Returns a digest of the definition of an action."""
+        definition = dict((k, action[k]) for k in RunJournal.ATTRIBUTES
+                          if k in action)
+        return hashlib.sha1(json.dumps(
+            definition, sort_keys=True).encode()).hexdigest()
+
+    def record(self, action, exit_code):
+        """Records that an action finished with the given exit code.
+
+        Args:
+            action (dict): The action.
+            exit_code (int): 0 if it succeeded.
+        """
+        self.entries[action['name']] = {
+            'digest': RunJournal.get_digest(action),
+            'exit_code': exit_code,
+            'finished': time.time(),
+        }
+        self.save()
+
+    def get_completed(self, wf):
+        """Returns the actions of a workflow that completed successfully
+        and have not changed since, and neither have the actions they
+        need.
+
+        Args:
+            wf (Workflow): The workflow.
+
+        Returns:
+            set: The names of the completed actions.
+        """
+        pending = list()
+        for a in wf.action:
+            entry = self.entries.get(a, dict())
+            if (entry.get('exit_code', None) != 0 or entry.get('digest')
+                    != RunJournal.get_digest(wf.action[a])):
+                pending.append(a)
+
+        # Actions that need one that has to run have to run again too.
+        outdated = set(pending)
+        while pending:
+            for n in wf.action[pending.pop()].get('next', set()):
+                if n in wf.action and n not in outdated:
+                    outdated.add(n)
+                    pending.append(n)
+
+        return set(wf.action) - outdated
+
+    def save(self):
+        """Stores the journal in the journals cache."""
+        tmp_file = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self.entries, f)
+            os.rename(tmp_file, self.path)
+        except (IOError, OSError):
+            log.debug('Unable to write journal file {}'.format(self.path))
+
+
+class ResultCache(object):
+    """A content-addressed cache of the outputs of actions.
+
+    Actions opt in by declaring, through the `POPPER_INPUTS` and
+    `POPPER_OUTPUTS` keys of their `env` attribute, comma-separated lists
+    of the paths of the workspace they read and write. The key of an
+    action is a hash of its definition, the image it runs in, the content
+    of its inputs and the keys of the actions it needs. When an entry
+    exists for that key, the outputs it holds are restored into the
+    workspace instead of running the action.
+
+    Entries are stored in the results cache, one directory per key, with
+    a `manifest.json` file that describes them. When the cache grows over
+    a size limit, the entries that were least recently used are evicted.
+    """
+
+    # Attributes of an action that are part of its key.
+    ATTRIBUTES = ['uses', 'runs', 'args', 'env']
+
+    def __init__(self, wf, workspace):
+        self.wf = wf
+        self.workspace = workspace
+        self.root = pu.setup_results_cache()
+        self.keys = dict()
+
+    @staticmethod
+    def get_paths(action, key):
+        """Returns the paths declared by an action in an `env` key."""
+        value = action.get('env', dict()).get(key, '')
+        return [p.strip() for p in value.split(',') if p.strip()]
+
+    @staticmethod
+    def is_cacheable(action):
+        """Whether an action declares its inputs or outputs."""
+        return bool(ResultCache.get_paths(action, 'POPPER_INPUTS')
+                    or ResultCache.get_paths(action, 'POPPER_OUTPUTS'))
+
+    def hash_path(self, digest, path):
+        """Updates a digest with the names and content of the files of a
+        path of the workspace."""
+        full_path = os.path.join(self.workspace, path)
+        if os.path.isdir(full_path):
+            files = list()
+            for root, dirs, names in os.walk(full_path):
+                dirs.sort()
+                files.extend(os.path.join(root, n) for n in sorted(names))
+        elif os.path.exists(full_path):
+            files = [full_path]
+        else:
+            digest.update('missing:{}'.format(path).encode())
+            return
+
+        for f in files:
+            digest.update(os.path.relpath(f, self.workspace).encode())
+            with open(f, 'rb') as fd:
+                for chunk in iter(lambda: fd.read(1 << 20), b''):
+                    digest.update(chunk)
+
+    def get_key(self, a):
+        """Computes the key of an action, once the actions it needs have
+        run. The keys of the actions it needs that did not run in this
+        invocation, e.g. because they were skipped with `--resume`, are
+        computed first, in the same way, so that the key does not depend
+        on which actions were run.
+        """
+        stack = [(a, False)]
+        while stack:
+            n, expanded = stack.pop()
+            if expanded:
+                self.keys[n] = self.compute_key(n)
+            elif n == a or n not in self.keys:
+                stack.append((n, True))
+                for m in self.wf.action[n].get('needs', list()):
+                    if m not in self.keys and m in self.wf.action:
+                        stack.append((m, False))
+        return self.keys[a]
+
+    def compute_key(self, a):
+        """Computes the key of an action whose needed actions have keys."""
+        action = self.wf.action[a]
+        definition = dict((k, action[k]) for k in ResultCache.ATTRIBUTES
+                          if k in action)
+        digest = hashlib.sha256(
+            json.dumps(definition, sort_keys=True).encode())
+        image = get_image_digest(self.wf.runners[a])
+        digest.update('image:{}'.format(image).encode())
+        for path in ResultCache.get_paths(action, 'POPPER_INPUTS'):
+            self.hash_path(digest, path)
+        for n in sorted(action.get('needs', list())):
+            digest.update('need:{}'.format(self.keys.get(n)).encode())
+        return digest.hexdigest()
+
+    def restore(self, a):
+        """Computes the key of an action and, if the cache holds an entry
+        for it, restores its outputs into the workspace.
+
+        Returns:
+            bool: Whether the outputs were restored.
+        """
+        if a in self.keys:
+            # Already looked up.
+            return False
+        key = self.get_key(a)
+        action = self.wf.action[a]
+        entry = os.path.join(self.root, key)
+        if (not ResultCache.is_cacheable(action)
+                or not os.path.isfile(os.path.join(entry, 'manifest.json'))):
+            return False
+
+        for path in ResultCache.get_paths(action, 'POPPER_OUTPUTS'):
+            src = os.path.join(entry, 'outputs', path)
+            dst = os.path.join(self.workspace, path)
+            if os.path.isdir(dst):
+                shutil.rmtree(dst)
+            if os.path.isdir(src):
+                shutil.copytree(src, dst)
+            elif os.path.exists(src):
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                shutil.copy2(src, dst)
+
+        ResultCache.touch(entry)
+        log.info("[popper] Restored the outputs of action '{}' from the "
+                 "cache".format(a))
+        return True
+
+    def store(self, a):
+        """Stores the outputs of an action that completed successfully."""
+        action = self.wf.action[a]
+        if a not in self.keys or not ResultCache.is_cacheable(action):
+            return
+
+        entry = os.path.join(self.root, self.keys[a])
+        tmp_entry = '{}.{}.tmp'.format(entry, os.getpid())
+        outputs = ResultCache.get_paths(action, 'POPPER_OUTPUTS')
+        try:
+            for path in outputs:
+                src = os.path.join(self.workspace, path)
+                dst = os.path.join(tmp_entry, 'outputs', path)
+                if os.path.isdir(src):
+                    shutil.copytree(src, dst)
+                elif os.path.exists(src):
+                    if not os.path.isdir(os.path.dirname(dst)):
+                        os.makedirs(os.path.dirname(dst))
+                    shutil.copy2(src, dst)
+                else:
+                    log.warning("Output '{}' of action '{}' was not found, "
+                                "it is not cached.".format(path, a))
+                    shutil.rmtree(tmp_entry, ignore_errors=True)
+                    return
+
+            if not os.path.isdir(tmp_entry):
+                os.makedirs(tmp_entry)
+            with open(os.path.join(tmp_entry, 'manifest.json'), 'w') as f:
+                json.dump({
+                    'action': a,
+                    'workflow': self.wf.workflow_path,
+                    'outputs': outputs,
+                    'created': time.time(),
+                    'used': time.time(),
+                    'size': ResultCache.get_size(tmp_entry),
+                }, f)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(tmp_entry, entry)
+        except (IOError, OSError) as e:
+            log.warning("Unable to cache the outputs of action '{}': "
+                        "{}".format(a, e))
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    @staticmethod
+    def get_size(path):
+        """Returns the size, in bytes, of the files in a directory."""
+        size = 0
+        for root, _, names in os.walk(path):
+            for n in names:
+                size += os.path.getsize(os.path.join(root, n))
+        return size
+
+    @staticmethod
+    def touch(entry):
+        """Marks an entry as used now."""
+        manifest_file = os.path.join(entry, 'manifest.json')
+        try:
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+            manifest['used'] = time.time()
+            with open(manifest_file, 'w') as f:
+                json.dump(manifest, f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    @staticmethod
+    def get_entries():
+        """Returns the entries of the cache, least recently used first.
+
+        Returns:
+            list: The manifest of each entry, with its `key`.
+        """
+        root = pu.setup_results_cache()
+        entries = list()
+        for key in os.listdir(root):
+            try:
+                with open(os.path.join(root, key, 'manifest.json')) as f:
+                    manifest = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+            manifest['key'] = key
+            entries.append(manifest)
+        return sorted(entries, key=lambda e: e.get('used', 0))
+
+    @staticmethod
+    def evict(max_size=None, max_age=None):
+        """Removes the entries that were not used in the last `max_age`
+        seconds, and then the least recently used ones until the cache
+        holds at most `max_size` bytes.
+
+        Returns:
+            list: The removed entries.
+        """
+        entries = ResultCache.get_entries()
+        size = sum(e.get('size', 0) for e in entries)
+        now = time.time()
+        removed = list()
+        for e in entries:
+            too_old = max_age is not None and now - e['used'] > max_age
+            too_big = max_size is not None and size > max_size
+            if not too_old and not too_big:
+                continue
+            shutil.rmtree(os.path.join(pu.setup_results_cache(), e['key']),
+                          ignore_errors=True)
+            size -= e.get('size', 0)
+            removed.append(e)
+        return removed
+
+
+def get_image_digest(runner):
+    """Returns an identifier of the image an action runs in, or None for
+    actions that do not run in an image, or whose image is not found."""
+    if isinstance(runner, VagrantRunner) or runner.dry_run:
+        return None
+    if isinstance(runner, DockerRunner):
+        _, image, _ = runner.get_build_resources()
+        try:
+            return runner.d_client.images.get(image).id
+        except docker.errors.APIError:
+            return None
+    if isinstance(runner, SingularityRunner):
+        _, image, _ = runner.get_build_resources()
+        path = runner.get_container_path(image)
+        if not os.path.exists(path):
+            return None
+        return '{}:{}'.format(os.path.getsize(path),
+                              int(os.path.getmtime(path)))
+    return None
+
+
+def get_exit_code(error):
+    """Returns the exit code of a failed action from the error it
+    raised."""
+    code = getattr(error, 'code', None)
+    if isinstance(code, int) and code:
+        return code
+    return 1
+
+
+class ActionScheduler(object):
+    """Runs the actions of a workflow in parallel, dispatching each action
+    as soon as all of the actions it needs have completed, instead of
+    waiting for every action of the previous stage to finish.
+
+    Every action goes through two phases, `prepare` (pulling or building
+    its image) and `execute`, that are limited separately, globally and
+    for each runtime.
+
+    Actions that declare the CPUs and memory they need (see
+    `get_resource_hints()`) are packed against the capacity of the host:
+    they are executed only when the resources they request are free.
+
+    When more actions are ready than can be dispatched, the ones with the
+    longest remaining path to the end of the workflow (according to the
+    durations of previous runs) are dispatched first.
+
+    With a `lookahead` depth, the images of the actions up to that many
+    levels below the earliest action that has not completed are
+    prefetched while the actions above them execute, so that they are
+    ready by the time their dependencies complete. Prefetching only uses
+    the pulls that are not needed by ready actions. Every action is
+    prepared once, whether it was prefetched or not.
+    """
+
+    RUNTIMES = ['docker', 'singularity', 'vagrant', 'host']
+
+    def __init__(self, runtime, wf, reuse=False, durations=None,
+                 max_workers=None, max_pulls=None, caps=None,
+                 pull_caps=None, capacity=None, keep_going=False,
+                 lookahead=0, max_prefetches=1, budget=None,
+                 journal=None, results=None, samples=None):
+        """
+        Args:
+            runtime (str): The container runtime, actions are run in a pool
+                           of processes for singularity and in a pool of
+                           threads otherwise.
+            wf (Workflow): The workflow, with its runners instantiated.
+            reuse (bool): Passed to the runners.
+            durations (ActionDurations): Durations of previous runs, used
+                                         to prioritize actions. The new
+                                         durations are recorded in it.
+            max_workers (int): Maximum number of actions executing at the
+                               same time. Defaults to the number of CPUs.
+            max_pulls (int): Maximum number of actions being prepared at
+                             the same time. Defaults to `max_workers`.
+            caps (dict): Maximum number of actions executing at the same
+                         time, for each runtime.
+            pull_caps (dict): Maximum number of actions being prepared at
+                              the same time, for each runtime.
+            capacity (tuple): The number of CPUs and the memory, in bytes,
+                              available to actions. Defaults to the ones
+                              of the host.
+            keep_going (bool): When an action fails, keep running the
+                               actions that do not depend on it instead of
+                               stopping the ones that are running.
+            lookahead (int): Number of levels of the workflow, below the
+                             earliest action that has not completed, whose
+                             images are prefetched.
+            max_prefetches (int): Maximum number of images prefetched at
+                                  the same time. These count against the
+                                  limits of the prepare phase.
+            budget (threading.Semaphore): Limits the number of actions
+                                          executing at the same time
+                                          together with other workflows.
+            journal (RunJournal): Records the outcome of every action.
+            results (ResultCache): Restores the outputs of actions instead
+                                   of executing them, when cached.
+            samples (ActionSamples): Records the wall time and exit code of
+                                     every execution of an action.
+        """
+        self.runtime = runtime
+        self.wf = wf
+        self.reuse = reuse
+        self.durations = durations
+        self.max_workers = max_workers or mp.cpu_count()
+        self.max_pulls = max_pulls or self.max_workers
+        self.limits = {
+            'prepare': (self.max_pulls, pull_caps or dict()),
+            'execute': (self.max_workers, caps or dict()),
+        }
+        self.capacity = capacity or ActionScheduler.get_host_capacity()
+        self.keep_going = keep_going
+        self.lookahead = lookahead
+        self.max_prefetches = max_prefetches
+        self.budget = budget
+        self.journal = journal
+        self.results = results
+        self.samples = samples
+
+    @staticmethod
+    def get_host_capacity():
+        """Returns the number of CPUs and the memory of the host."""
+        return mp.cpu_count(), pu.get_host_memory()
+
+    @staticmethod
+    def get_runtime_caps(pull=False):
+        """Reads the per-runtime limits from the `POPPER_<RUNTIME>_JOBS`
+        (or `POPPER_<RUNTIME>_PULL_JOBS`) environment variables.
+
+        Args:
+            pull (bool): Whether to read the limits of the prepare phase.
+
+        Returns:
+            dict: The limit of each runtime that has one.
+        """
+        caps = dict()
+        for r in ActionScheduler.RUNTIMES:
+            var = 'POPPER_{}_{}JOBS'.format(r.upper(), 'PULL_' if pull else '')
+            value = os.environ.get(var, None)
+            if not value:
+                continue
+            if not value.isdigit() or int(value) < 1:
+                log.fail('{} must be a positive integer.'.format(var))
+            caps[r] = int(value)
+        return caps
+
+    def get_dependencies(self, actions):
+        """Returns, for each action, the number of actions it is still
+        waiting for and the actions that are waiting for it. Dependencies
+        on actions that are not going to be run are ignored.
+        """
+        pending = dict((a, 0) for a in actions)
+        waiting = dict((a, list()) for a in actions)
+        for a in actions:
+            for n in self.wf.action[a].get('needs', list()):
+                if n in pending:
+                    pending[a] += 1
+                    waiting[n].append(a)
+        return pending, waiting
+
+    def get_priorities(self, pending, waiting):
+        """Returns the length of the longest path from each action to the
+        end of the workflow, including the action itself. Without history,
+        every action is expected to take the same time, so the priority
+        of an action is the number of actions in that path.
+        """
+        priorities = dict()
+        indegree = dict(pending)
+        order = [a for a, n in indegree.items() if not n]
+        for a in order:
+            for n in waiting[a]:
+                indegree[n] -= 1
+                if not indegree[n]:
+                    order.append(n)
+
+        for a in reversed(order):
+            if self.durations:
+                duration = self.durations.estimate(a)
+            else:
+                duration = 1.0
+            priorities[a] = duration + max(
+                [priorities[n] for n in waiting[a]] + [0])
+        return priorities
+
+    @staticmethod
+    def get_levels(pending, waiting):
+        """Returns the level of each action: the number of actions in the
+        longest path from an action that needs no other one, excluding
+        the action itself."""
+        levels = dict((a, 0) for a, n in pending.items() if not n)
+        indegree = dict(pending)
+        order = list(levels)
+        for a in order:
+            for n in waiting[a]:
+                levels[n] = max(levels.get(n, 0), levels[a] + 1)
+                indegree[n] -= 1
+                if not indegree[n]:
+                    order.append(n)
+        return levels
+
+    def fits(self, hints):
+        """Whether the resources requested by an action are free. An
+        action that needs more than the capacity of the host is executed
+        when no other action is executing."""
+        if not sum(self.active['execute'].values()):
+            return True
+        for requested, used, available in zip(hints, self.used,
+                                              self.capacity):
+            if requested and available and used + requested > available:
+                return False
+        return True
+
+    def reserve(self, hints, sign=1):
+        """Marks the resources requested by an action as used or, when
+        `sign` is -1, as free."""
+        self.used = [u + sign * (h or 0) for u, h in zip(self.used, hints)]
+
+    def dispatch(self, phase, submit):
+        """Submits the queued actions of a phase, by priority, while the
+        global and the per-runtime limits of the phase, and the capacity
+        of the host, allow it.
+
+        Args:
+            phase (str): Either 'prepare' or 'execute'.
+            submit (function): Called with the phase and the runner of an
+                               action, starts running the phase of the
+                               action and returns a future for it.
+        """
+        limit, caps = self.limits[phase]
+        queue = self.queues[phase]
+        active = self.active[phase]
+        blocked = list()
+        while queue and sum(active.values()) < limit:
+            item = heapq.heappop(queue)
+            a = item[-1]
+            runner = self.wf.runners[a]
+            r = getattr(runner, 'runtime', None)
+            if phase == 'prepare':
+                if a in self.prepared or a in self.preparing:
+                    # Already prefetched, or being prefetched.
+                    continue
+                key = self.keys[a]
+                if key in self.resolved:
+                    self.prepare_done(a)
+                    continue
+                if key in self.leaders:
+                    # The image is being prepared for another action.
+                    self.preparing.add(a)
+                    self.followers[self.leaders[key]].append(a)
+                    continue
+                if (self.pending[a]
+                        and len(self.prefetching) >= self.max_prefetches):
+                    blocked.append(item)
+                    continue
+            if active.get(r, 0) >= caps.get(r, limit):
+                blocked.append(item)
+                continue
+            if phase == 'execute':
+                if self.results and self.results.restore(a):
+                    self.succeed(a)
+                    continue
+                if not self.fits(self.hints[a]):
+                    blocked.append(item)
+                    continue
+                if self.budget and not self.budget.acquire(False):
+                    blocked.append(item)
+                    continue
+                self.reserve(self.hints[a])
+                self.started[a] = time.time()
+            else:
+                self.preparing.add(a)
+                if self.keys[a] is not None:
+                    self.leaders[self.keys[a]] = a
+                    self.followers[a] = list()
+                if self.pending[a]:
+                    self.prefetching.add(a)
+                    log.debug("Prefetching image of action '{}'".format(a))
+            active[r] = active.get(r, 0) + 1
+            self.running[submit(phase, runner)] = (phase, a, r)
+        for item in blocked:
+            heapq.heappush(queue, item)
+
+    def start(self, actions=None):
+        """Sets up the state of the scheduler before running the actions.
+
+        Args:
+            actions (iterable): The actions to run. Defaults to all the
+                                actions of the workflow.
+        """
+        self.pending, self.waiting = self.get_dependencies(
+            list(actions if actions is not None else self.wf.action))
+        self.priorities = self.get_priorities(self.pending, self.waiting)
+
+        self.hints = dict()
+        self.used = [0, 0]
+        for a in self.pending:
+            self.hints[a] = get_resource_hints(self.wf.action[a])
+            for requested, available, name in zip(
+                    self.hints[a], self.capacity, ['CPUs', 'memory']):
+                if requested and available and requested > available:
+                    log.warning("Action '{}' requests more {} than the host "
+                                "has, it will run alone.".format(a, name))
+
+        # Items of the prepare queue of ready actions go before the ones
+        # of prefetched actions.
+        self.queues = {
+            'prepare': [(0, -self.priorities[a], a)
+                        for a, n in self.pending.items() if not n],
+            'execute': list(),
+        }
+        heapq.heapify(self.queues['prepare'])
+        self.active = {'prepare': dict(), 'execute': dict()}
+        self.running = dict()
+        self.completed = 0
+        self.started = dict()
+        self.failed = list()
+        self.timed_out = list()
+        self.dropped = set()
+        self.preparing = set()
+        self.prepared = set()
+        self.prefetching = set()
+        popper.cli.flist = self.running
+
+        # Actions that share an image are prepared once: the first one
+        # to be dispatched prepares it and the others follow it.
+        self.keys = dict(
+            (a, get_image_key(self.wf.runners[a], self.reuse))
+            for a in self.pending)
+        self.leaders = dict()
+        self.followers = dict()
+        self.resolved = set()
+
+        self.level = ActionScheduler.get_levels(self.pending, self.waiting)
+        self.levels = dict()
+        for a, level in self.level.items():
+            self.levels.setdefault(level, list()).append(a)
+        self.remaining = dict(
+            (level, len(a)) for level, a in self.levels.items())
+        self.frontier = 0
+        self.horizon = 0
+        self.prefetch()
+
+    def prefetch(self):
+        """Queues the actions that are at most `lookahead` levels below
+        the earliest level that has not completed."""
+        while (self.frontier in self.remaining
+               and not self.remaining[self.frontier]):
+            self.frontier += 1
+        # Actions of the frontier are queued when they become ready.
+        self.horizon = max(self.horizon, self.frontier)
+        while (self.horizon < self.frontier + self.lookahead
+               and self.horizon + 1 in self.levels):
+            self.horizon += 1
+            for a in self.levels[self.horizon]:
+                if (a in self.preparing or a in self.prepared
+                        or a in self.dropped):
+                    continue
+                heapq.heappush(
+                    self.queues['prepare'], (1, -self.priorities[a], a))
+
+    def is_running(self):
+        """Whether there are actions queued or running."""
+        return bool(self.queues['prepare'] or self.queues['execute']
+                    or self.running)
+
+    def complete(self, f, result):
+        """Updates the state of the scheduler once a phase of an action
+        has completed successfully.
+
+        Args:
+            f: The future of the phase.
+            result: The result of the phase, the time the action took for
+                    the execute phase.
+        """
+        phase, a, r = self.running.pop(f)
+        self.active[phase][r] -= 1
+
+        if phase == 'prepare':
+            key = self.keys[a]
+            if key is not None:
+                self.leaders.pop(key)
+                self.resolved.add(key)
+            for n in [a] + self.followers.pop(a, list()):
+                self.prepare_done(n)
+            return
+
+        self.release(a)
+        if self.durations:
+            self.durations.record(a, result)
+        if self.samples:
+            self.samples.record(a, result)
+        if self.results:
+            self.results.store(a)
+        self.succeed(a)
+
+    def succeed(self, a):
+        """Releases the actions waiting for an action that completed
+        successfully."""
+        if self.journal:
+            self.journal.record(self.wf.action[a], 0)
+        self.completed += 1
+        for n in self.waiting[a]:
+            self.pending[n] -= 1
+            if not self.pending[n]:
+                self.ready(n)
+
+        self.remaining[self.level[a]] -= 1
+        self.prefetch()
+
+    def prepare_done(self, a):
+        """Marks an action as prepared and queues it for execution if its
+        dependencies have completed."""
+        self.preparing.discard(a)
+        self.prefetching.discard(a)
+        self.prepared.add(a)
+        if not self.pending[a]:
+            heapq.heappush(
+                self.queues['execute'], (-self.priorities[a], a))
+
+    def ready(self, a):
+        """Queues an action whose dependencies have completed for its
+        next phase. Actions being prefetched are queued for execution when
+        their prepare phase completes."""
+        if a in self.prepared:
+            heapq.heappush(
+                self.queues['execute'], (-self.priorities[a], a))
+        elif a not in self.preparing and a not in self.failed:
+            heapq.heappush(
+                self.queues['prepare'], (0, -self.priorities[a], a))
+
+    def release(self, a):
+        """Frees the resources and the slot of the budget used by an action
+        that is no longer executing."""
+        self.reserve(self.hints[a], -1)
+        if self.budget:
+            self.budget.release()
+
+    def wait_for_budget(self):
+        """Blocks until an action of another workflow leaves the budget,
+        when all the actions that can be dispatched are waiting for it."""
+        if self.budget and not self.running and self.queues['execute']:
+            self.budget.acquire()
+            self.budget.release()
+
+    def fail(self, f, error=None):
+        """Updates the state of the scheduler once a phase of an action
+        has failed.
+
+        Args:
+            f: The future of the phase.
+            error (BaseException): The error raised by the phase.
+
+        Returns:
+            bool: Whether the run has to be stopped.
+        """
+        phase, a, r = self.running.pop(f)
+        self.active[phase][r] -= 1
+        failed = [a]
+        if phase == 'execute':
+            self.release(a)
+            if get_exit_code(error) == TIMEOUT_EXIT_CODE:
+                self.timed_out.append(a)
+            if self.samples:
+                self.samples.record(a, time.time() - self.started[a],
+                                    get_exit_code(error))
+        else:
+            self.leaders.pop(self.keys[a], None)
+            failed += self.followers.pop(a, list())
+        for n in failed:
+            self.preparing.discard(n)
+            self.prefetching.discard(n)
+            self.failed.append(n)
+            if self.journal:
+                self.journal.record(self.wf.action[n], get_exit_code(error))
+        self.drop(failed)
+        return not self.keep_going
+
+    def drop(self, actions):
+        """Marks failed actions, and the actions that need them, as done
+        with their level, since they are not going to complete, so that
+        the actions of the levels below keep being prefetched."""
+        actions = list(actions)
+        for a in actions:
+            if a in self.dropped:
+                continue
+            self.dropped.add(a)
+            self.remaining[self.level[a]] -= 1
+            actions.extend(self.waiting[a])
+        self.prefetch()
+
+    def stop(self):
+        """Stops dispatching actions and stops the ones that are running.
+        """
+        self.queues['prepare'] = list()
+        self.queues['execute'] = list()
+        for f, (phase, a, r) in list(self.running.items()):
+            if f.cancel():
+                self.running.pop(f)
+                if phase == 'execute':
+                    self.release(a)
+            elif phase == 'execute':
+                self.wf.runners[a].stop(self.reuse)
+
+    def release_stopped(self):
+        """Frees the resources of the actions that were stopped."""
+        for phase, a, _ in self.running.values():
+            if phase == 'execute':
+                self.release(a)
+        self.running.clear()
+
+    def finish(self):
+        """Checks that every action has been run."""
+        if self.failed:
+            failed = sorted(a for a in self.failed if a not in self.timed_out)
+            not_run = sorted(a for a, n in self.pending.items() if n)
+            msg = list()
+            for actions, outcome in [(failed, 'failed'),
+                                     (sorted(self.timed_out), 'timed out'),
+                                     (not_run, 'were not run')]:
+                if actions:
+                    msg.append('Actions {} {}.'.format(', '.join(actions),
+                                                       outcome))
+            log.fail(' '.join(msg))
+
+        if self.completed != len(self.pending):
+            log.fail('Actions {} could not be scheduled.'.format(
+                ', '.join(sorted(a for a, n in self.pending.items() if n))))
+
+    def run(self, actions=None):
+        """Runs the actions and waits for all of them to complete.
+
+        Args:
+            actions (iterable): The actions to run. Defaults to all the
+                                actions of the workflow.
+        """
+        if self.runtime == 'singularity':
+            Executor = ProcessPoolExecutor
+        else:
+            Executor = ThreadPoolExecutor
+
+        prefix = logging.get_prefix()
+        self.start(actions)
+
+        with Executor(max_workers=self.max_workers + self.max_pulls) as ex:
+            def submit(phase, runner):
+                return ex.submit(run_action_phase, phase, runner,
+                                 self.reuse, prefix)
+
+            error = None
+            while self.is_running() and error is None:
+                self.dispatch('execute', submit)
+                self.dispatch('prepare', submit)
+                self.wait_for_budget()
+                if not self.running:
+                    # Actions restored from the results cache released
+                    # others that are yet to be dispatched.
+                    continue
+
+                done, _ = wait(list(self.running),
+                               return_when=FIRST_COMPLETED)
+                for f in done:
+                    try:
+                        result = f.result()
+                    except (Exception, SystemExit) as e:
+                        if self.fail(f, e):
+                            error = e
+                        continue
+                    self.complete(f, result)
+
+            if error is not None:
+                # Fail fast: the actions that are running are stopped, so
+                # that the executor does not wait for them to finish.
+                self.stop()
+
+        if error is not None:
+            self.release_stopped()
+            raise error
+        self.finish()
 
 
 class ActionRunner(object):
@@ -235,6 +1630,10 @@ class ActionRunner(object):
         self.skip_pull = skip_pull
         self.wid = wid
         self.msg_prefix = "DRYRUN: " if dry_run else ""
+        self.stopped = False
+        self.prepared = False
+        self.timeout = None
+        self.timed_out = False
         self.setup_necessary_files()
 
     def handle_exit(self, ecode):
@@ -243,7 +1642,14 @@ class ActionRunner(object):
         Args:
             ecode (int): The exit code of the action's process.
         """
-        if ecode == 0:
+        if self.timed_out:
+            log.warning("Action '{}' timed out after {} seconds.".format(
+                self.action['name'], self.timeout))
+            sys.exit(TIMEOUT_EXIT_CODE)
+        elif self.stopped:
+            log.info("Action '{}' was stopped.".format(self.action['name']))
+            sys.exit(1)
+        elif ecode == 0:
             log.info(
                 "Action '{}' ran successfully !".format(
                     self.action['name']))
@@ -306,7 +1712,7 @@ class ActionRunner(object):
         Returns:
             dict: The environment variables dict.
         """
-        env = self.action.get('env', {})
+        env = dict(self.action.get('env', {}))
 
         for s in self.action.get('secrets', []):
             env.update({s: os.environ[s]})
@@ -331,15 +1737,44 @@ class ActionRunner(object):
         for k, v in env.items():
             os.environ.pop(k, None)
 
-    def run(self, reuse=False):
+    def prepare(self, reuse=False):
+        """Gets the action ready to be executed, e.g. by pulling or
+        building the image it runs in. Runners that have nothing to
+        prepare do not need to implement it.
+
+        Args:
+            reuse (bool): Whether to reuse existent containers or not.
+        """
+        pass
+
+    def execute(self, reuse=False):
         raise NotImplementedError(
             "This method is required to be implemented in derived classes."
         )
 
+    def stop(self, reuse=False):
+        """Stops the action while it is executing, from another thread.
+        Runners that can not interrupt an action let it finish.
+
+        Args:
+            reuse (bool): Whether containers are reused or not.
+        """
+        self.stopped = True
+
+    def run(self, reuse=False):
+        """Prepares and executes the action.
+
+        Args:
+            reuse (bool): Whether to reuse existent containers or not.
+        """
+        self.prepare(reuse)
+        self.execute(reuse)
+
 
 class DockerRunner(ActionRunner):
     """Run a Github Action in Docker runtime.
     """
+    runtime = 'docker'
 
     def __init__(self, action, workspace, env, dry, skip_pull, wid):
         super(DockerRunner, self).__init__(
@@ -390,30 +1825,87 @@ class DockerRunner(ActionRunner):
         image = image.lower()
         return (build, image, build_source)
 
-    def run(self, reuse=False):
-        """Parent function to handle the execution of an
-        action.
+    def prepare(self, reuse=False):
+        """Pulls or builds the image of the action.
+
+        Args:
+            reuse (bool): Whether to reuse existent containers or not.
+        """
+        self.check_executable('docker')
+        self.docker_prepare_image(reuse)
+
+    def execute(self, reuse=False):
+        """Creates the container of the action and runs it.
 
         Args:
             reuse (bool): Whether to reuse existent containers or not.
         """
         self.check_executable('docker')
+        e = self.docker_run_container(reuse)
+        self.handle_exit(e)
+
+    def stop(self, reuse=False):
+        """Stops the container of the action and, unless it is going to be
+        reused, removes it.
+
+        Args:
+            reuse (bool): Whether containers are reused or not.
+        """
+        self.stopped = True
+        if self.dry_run or self.container is None:
+            return
+        log.info("Stopping container '{}'".format(self.container.name))
+        try:
+            self.container.stop(timeout=1)
+            if not reuse:
+                self.container.remove(force=True)
+        except docker.errors.APIError:
+            pass
+
+    def docker_prepare_image(self, reuse=False):
+        """Pulls or builds the image of the action, unless an existing
+        container is going to be reused.
+
+        Args:
+            reuse (bool): Whether to reuse existent containers or not.
+        """
+        if reuse and self.docker_exists():
+            return
+
         build, image, build_source = self.get_build_resources()
+        if build:
+            self.docker_build(image, build_source)
+        else:
+            self.docker_pull(image)
+
+    def docker_run_container(self, reuse=False):
+        """Creates (or recreates) the container of the action from its
+        image and starts it.
+
+        Args:
+            reuse (bool): Whether to reuse existent containers or not.
+
+        Returns:
+            int: The exit code of the container.
+        """
+        self.docker_create_container(reuse)
+        return self.docker_start()
+
+    def docker_create_container(self, reuse=False):
+        """Creates (or recreates) the container of the action from its
+        image.
+
+        Args:
+            reuse (bool): Whether to reuse existent containers or not.
+        """
+        _, image, _ = self.get_build_resources()
 
         if not reuse:
             if self.docker_exists():
                 self.docker_rm()
-            if build:
-                self.docker_build(image, build_source)
-            else:
-                self.docker_pull(image)
             self.docker_create(image)
         else:
             if not self.docker_exists():
-                if build:
-                    self.docker_build(image, build_source)
-                else:
-                    self.docker_pull(image)
                 self.docker_create(image)
             else:
                 self.container.commit(self.cid, 'reuse')
@@ -423,9 +1915,6 @@ class DockerRunner(ActionRunner):
         if self.container is not None:
             popper.cli.docker_list.append(self.container)
 
-        e = self.docker_start()
-        self.handle_exit(e)
-
     def docker_exists(self):
         """Check whether the container exists or not.
 
@@ -493,9 +1982,25 @@ class DockerRunner(ActionRunner):
             working_dir=env['GITHUB_WORKSPACE'],
             environment=env,
             entrypoint=self.action.get('runs', None),
-            detach=True
+            detach=True,
+            **self.get_container_limits()
         )
 
+    def get_container_limits(self):
+        """Returns the resource limits of the container, from the
+        resources requested by the action.
+
+        Returns:
+            dict: Keyword arguments for `containers.create()`.
+        """
+        cpus, memory = get_resource_hints(self.action)
+        limits = dict()
+        if cpus:
+            limits['nano_cpus'] = int(cpus * 1e9)
+        if memory:
+            limits['mem_limit'] = memory
+        return limits
+
     def docker_start(self):
         """Start the container process.
 
@@ -548,6 +2053,7 @@ class DockerRunner(ActionRunner):
 class SingularityRunner(ActionRunner):
     """Runs a Github Action in Singularity runtime.
     """
+    runtime = 'singularity'
 
     def __init__(self, action, workspace, env, dry_run, skip_pull, wid):
         super(SingularityRunner, self).__init__(action, workspace, env,
@@ -598,34 +2104,45 @@ class SingularityRunner(ActionRunner):
 
         return (build, image, build_source)
 
-    def run(self, reuse=False):
-        """Parent function to handle the execution
-        of the action.
+    def prepare(self, reuse=False):
+        """Builds the container of the action.
 
         Args:
             reuse (bool): Whether to reuse containers or not.
         """
         self.check_executable('singularity')
-        singularity_cache = SingularityRunner.setup_singularity_cache(self.wid)
 
         if reuse:
             log.fail('Reusing containers in singularity runtime is '
                      'currently not supported.')
 
         build, image, build_source = self.get_build_resources()
-
-        container_path = os.path.join(
-            singularity_cache, pu.sanitized_name(image, self.wid) + '.sif'
-        )
+        container_path = self.get_container_path(image)
 
         if build:
             self.singularity_build_from_recipe(build_source, container_path)
         else:
             self.singularity_build_from_image(image, container_path)
 
-        e = self.singularity_start(container_path)
+    def execute(self, reuse=False):
+        """Runs the container of the action.
+
+        Args:
+            reuse (bool): Whether to reuse containers or not.
+        """
+        self.check_executable('singularity')
+        _, image, _ = self.get_build_resources()
+        e = self.singularity_start(self.get_container_path(image))
         self.handle_exit(e)
 
+    def get_container_path(self, image):
+        """Returns the path of the container of an image in the
+        singularity cache."""
+        singularity_cache = SingularityRunner.setup_singularity_cache(self.wid)
+        return os.path.join(
+            singularity_cache, pu.sanitized_name(image, self.wid) + '.sif'
+        )
+
     @staticmethod
     def convert(dockerfile, singularityfile):
         """Convert a Dockerfile to a Singularity recipe file.
@@ -639,7 +2156,10 @@ class SingularityRunner(ActionRunner):
         """
         parser = DockerParser(dockerfile)
         for p in parser.recipe.files:
-            p[0] = p[0].strip('\"')
+            # Sources are relative to the build context, and the build is
+            # not run from it.
+            p[0] = os.path.join(os.path.dirname(dockerfile),
+                                p[0].strip('\"'))
             p[1] = p[1].strip('\"')
             if os.path.isdir(p[0]):
                 p[0] += '/.'
@@ -687,14 +2207,11 @@ class SingularityRunner(ActionRunner):
             container (str): The name of the container image.
             wid (str): The workflow id.
         """
-        pwd = os.getcwd()
-        os.chdir(build_source)
         recipefile = SingularityRunner.get_recipe_file(build_source, wid)
         s_client.build(
             recipe=recipefile,
             image=container,
             build_folder=build_dest)
-        os.chdir(pwd)
 
     def singularity_exists(self, container_path):
         """Check whether the container exists or not.
@@ -825,6 +2342,7 @@ class VagrantRunner(DockerRunner):
     """
     Run an Action in Vagrant runtime.
     """
+    runtime = 'vagrant'
     actions = set()
     running = False
     vbox_path = None
@@ -842,6 +2360,8 @@ class VagrantRunner(DockerRunner):
             action, workspace, env, dry, skip_pull, wid
         )
         self.cid = pu.sanitized_name(self.action['name'], wid)
+        # Number of times the action is going to be executed.
+        self.executions = 1
         VagrantRunner.actions.add(self.action['name'])
 
     @staticmethod
@@ -861,6 +2381,33 @@ class VagrantRunner(DockerRunner):
             os.makedirs(vagrant_cache)
         return vagrant_cache
 
+    def get_container_limits(self):
+        """Returns the resource limits of the container. CPU limits are
+        not supported by the version of the docker API used in the VM."""
+        limits = super(VagrantRunner, self).get_container_limits()
+        limits.pop('nano_cpus', None)
+        return limits
+
+    def vagrant_connect(self):
+        """Starts the VM, if it is not running yet, and connects to the
+        docker daemon running in it."""
+        self.check_executable('vagrant')
+        self.check_executable('virtualbox')
+
+        VagrantRunner.lock.acquire()
+        if not VagrantRunner.running:
+            VagrantRunner.vbox_path = VagrantRunner.setup_vagrant_cache(
+                self.wid)
+            self.vagrant_write_vagrantfile(VagrantRunner.vbox_path)
+            self.vagrant_start(VagrantRunner.vbox_path)
+            VagrantRunner.running = True
+        VagrantRunner.lock.release()
+
+        self.d_client = docker.DockerClient(
+            base_url='tcp://0.0.0.0:2375',
+            version='1.22',
+            timeout=120)
+
     def vagrant_write_vagrantfile(self, vagrant_box_path):
         """Bootstrap the Vagrantfile required to start
         the VM.
@@ -924,56 +2471,28 @@ class VagrantRunner(DockerRunner):
         vagrant.Vagrant(root=vagrant_box_path).halt()
         time.sleep(5)
 
-    def run(self, reuse=False):
-        """Parent function to handle the execution
-        of the action.
+    def prepare(self, reuse=False):
+        """Starts the VM, if it is not running yet, and pulls or builds
+        the image of the action in it.
 
         Args:
             reuse (bool): Whether to reuse containers or not.
         """
-        self.check_executable('vagrant')
-        self.check_executable('virtualbox')
-
-        VagrantRunner.lock.acquire()
-        if not VagrantRunner.running:
-            VagrantRunner.vbox_path = VagrantRunner.setup_vagrant_cache(
-                self.wid)
-            self.vagrant_write_vagrantfile(VagrantRunner.vbox_path)
-            self.vagrant_start(VagrantRunner.vbox_path)
-            VagrantRunner.running = True
-        VagrantRunner.lock.release()
+        self.vagrant_connect()
+        self.docker_prepare_image(reuse)
 
-        self.d_client = docker.DockerClient(
-            base_url='tcp://0.0.0.0:2375',
-            version='1.22',
-            timeout=120)
-
-        build, image, build_source = self.get_build_resources()
-        if not reuse:
-            if self.docker_exists():
-                self.docker_rm()
-            if build:
-                self.docker_build(image, build_source)
-            else:
-                self.docker_pull(image)
-            self.docker_create(image)
-        else:
-            if not self.docker_exists():
-                if build:
-                    self.docker_build(image, build_source)
-                else:
-                    self.docker_pull(image)
-                self.docker_create(image)
-            else:
-                self.container.commit(self.cid, 'reuse')
-                self.docker_rm()
-                self.docker_create('{}:reuse'.format(self.cid))
-
-        if self.container is not None:
-            popper.cli.docker_list.append(self.container)
+    def execute(self, reuse=False):
+        """Runs the container of the action in the VM and stops the VM
+        once every action is done with all of its executions.
 
-        e = self.docker_start()
-        VagrantRunner.actions.remove(self.action['name'])
+        Args:
+            reuse (bool): Whether to reuse containers or not.
+        """
+        self.vagrant_connect()
+        e = self.docker_run_container(reuse)
+        self.executions -= 1
+        if self.executions <= 0:
+            VagrantRunner.actions.discard(self.action['name'])
 
         # If all the actions are done, stop the VM
         if len(VagrantRunner.actions) == 0 and e != 78:
@@ -987,58 +2506,83 @@ class HostRunner(ActionRunner):
     """
     Run an Action on the Host Machine.
     """
+    runtime = 'host'
 
     def __init__(self, action, workspace, env, dry, skip_pull, wid):
         super(HostRunner, self).__init__(
             action, workspace, env, dry, skip_pull, wid)
-        self.cwd = os.getcwd()
+        self.process = None
 
-    def run(self, reuse=False):
+    def execute(self, reuse=False):
         if reuse:
             log.fail('--reuse flag is not supported for actions running '
                      'on the host.')
 
         cmd = self.host_prepare()
-        self.prepare_environment(set_env=True)
-        e = self.host_start(cmd)
-        self.remove_environment()
+        # The environment of the action is given to its process only, as
+        # other actions may be running in other threads.
+        env = dict(os.environ)
+        env.update(self.prepare_environment())
+        e = self.host_start(cmd, env)
         self.handle_exit(e)
 
+    def stop(self, reuse=False):
+        """Terminates the process group of the action."""
+        self.stopped = True
+        if self.process is None or self.process.poll() is not None:
+            return
+        log.info("Stopping process '{}'".format(self.process.pid))
+        try:
+            os.killpg(os.getpgid(self.process.pid), signal.SIGTERM)
+        except OSError:
+            pass
+
     def host_prepare(self):
         """Prepare the commands and environment to start execution.
 
         Returns:
             str: The command to execute.
         """
+        return self.host_command()
+
+    def host_workdir(self):
+        """Returns the directory the action is executed from."""
+        root = scm.get_git_root_folder()
+        if self.action['uses'] == 'sh':
+            return root
+        if 'repo_dir' in self.action:
+            return self.action['repo_dir']
+        return os.path.join(root, self.action['uses'])
+
+    def host_command(self):
+        """Returns the command that executes the action.
+
+        Returns:
+            list: The command to execute.
+        """
         root = scm.get_git_root_folder()
         if self.action['uses'] == 'sh':
-            cmd = self.action.get('runs', [])
+            cmd = list(self.action.get('runs', []))
             if cmd:
                 cmd[0] = os.path.join(root, cmd[0])
             cmd.extend(self.action.get('args', []))
-
-            if not self.dry_run:
-                os.chdir(root)
         else:
-            cmd = self.action.get('runs', ['entrypoint.sh'])
+            cmd = list(self.action.get('runs', ['entrypoint.sh']))
             cmd[0] = os.path.join('./', cmd[0])
             cmd.extend(self.action.get('args', []))
 
             if not self.dry_run:
-                if 'repo_dir' in self.action:
-                    os.chdir(self.action['repo_dir'])
-                    cmd[0] = os.path.join(self.action['repo_dir'], cmd[0])
-                else:
-                    os.chdir(os.path.join(root, self.action['uses']))
-                    cmd[0] = os.path.join(root, self.action['uses'], cmd[0])
+                cmd[0] = os.path.join(self.host_workdir(), cmd[0])
 
         return cmd
 
-    def host_start(self, cmd):
+    def host_start(self, cmd, env=None):
         """Start the execution of the command on the host machine.
 
         Args:
             cmd (str): The command to execute.
+            env (dict): The environment of the process. Defaults to the
+                        one of popper.
         Returns:
             int: The returncode of the process.
         """
@@ -1053,8 +2597,10 @@ class HostRunner(ActionRunner):
         try:
             log.debug('Executing: {}'.format(' '.join(cmd)))
             p = Popen(' '.join(cmd), stdout=PIPE, stderr=STDOUT, shell=True,
-                      universal_newlines=True, preexec_fn=os.setsid)
+                      universal_newlines=True, preexec_fn=os.setsid, env=env,
+                      cwd=self.host_workdir())
 
+            self.process = p
             popper.cli.process_list.append(p.pid)
 
             log.debug('Reading process output')
@@ -1074,5 +2620,4 @@ class HostRunner(ActionRunner):
         finally:
             log.action_info()
 
-        os.chdir(self.cwd)
         return ecode
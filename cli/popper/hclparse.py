@@ -0,0 +1,285 @@
+from __future__ import unicode_literals
+import re
+
+from popper.cli import log
+
+
+TOKEN_RE = re.compile(r'''
+    (?P<whitespace>\s+)
+  | (?P<comment>(?:\#|//)[^\n]*)
+  | (?P<multicomment>/\*.*?\*/)
+  | (?P<string>"(?:[^"\\\n]|\\")*")
+  | (?P<number>-?[0-9]+(?:\.[0-9]+)?(?![\w.]))
+  | (?P<bool>(?:true|false)(?![\w.-]))
+  | (?P<identifier>[A-Za-z_][\w.-]*)
+  | (?P<punctuation>[{}\[\]=,])
+''', re.VERBOSE | re.DOTALL)
+
+UNESCAPE_RE = re.compile(r'\\(")')
+
+
+class HCLParseError(ValueError):
+    """Raised when a workflow file can not be parsed by `parse()`, either
+    because it is invalid or because it uses HCL syntax that is outside
+    of the subset supported by this module.
+    """
+    pass
+
+
+def tokenize(text):
+    """Generator of the tokens of a workflow file.
+
+    Args:
+        text (str): The content of the workflow file.
+
+    Yields:
+        (str, object, int): The type, value and line number of a token.
+    """
+    lineno = 1
+    pos = 0
+    for m in TOKEN_RE.finditer(text):
+        if m.start() != pos:
+            break
+        kind = m.lastgroup
+        value = m.group(kind)
+        pos = m.end()
+
+        if kind in ('whitespace', 'multicomment'):
+            lineno += value.count('\n')
+        elif kind == 'comment':
+            pass
+        elif kind == 'string':
+            value = value[1:-1]
+            if '\\' in value:
+                value = UNESCAPE_RE.sub(r'\1', value)
+            yield 'string', value, lineno
+        elif kind == 'number':
+            if '.' in value:
+                yield 'number', float(value), lineno
+            else:
+                yield 'number', int(value), lineno
+        elif kind == 'bool':
+            yield 'bool', value == 'true', lineno
+        elif kind == 'identifier':
+            yield 'identifier', value, lineno
+        else:
+            yield value, value, lineno
+
+    if pos != len(text):
+        raise HCLParseError('Line {}: unsupported character {!r}.'.format(
+            lineno, text[pos]))
+
+
+class Parser(object):
+    """A streaming recursive-descent parser for the subset of HCL used by
+    Github Actions workflows: top-level blocks with a single label
+    (`workflow "name" { ... }` and `action "name" { ... }`) whose
+    attributes are strings, numbers, booleans, lists and maps.
+
+    The result has the same structure as the one produced by `hcl.loads`.
+    While parsing, the top-level `action` declarations are recorded along
+    with their line numbers.
+    """
+
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.declarations = list()
+        self.advance()
+
+    def advance(self):
+        self.current = next(self.tokens, (None, None, None))
+
+    def error(self, expected):
+        kind, value, lineno = self.current
+        if kind is None:
+            raise HCLParseError(
+                'Unexpected end of file, expected {}.'.format(expected))
+        raise HCLParseError('Line {}: unexpected {!r}, expected {}.'.format(
+            lineno, value, expected))
+
+    def expect(self, kind):
+        if self.current[0] != kind:
+            self.error(kind)
+        value = self.current[1]
+        self.advance()
+        return value
+
+    def parse(self):
+        """Parses the whole file.
+
+        Returns:
+            dict: The parsed content of the file.
+        """
+        result = dict()
+        while self.current[0] is not None:
+            lineno = self.current[2]
+            key = self.expect('identifier')
+            if self.current[0] == '=':
+                self.advance()
+                if key in result:
+                    self.error('a new attribute')
+                result[key] = self.parse_value()
+                continue
+
+            label = self.expect('string')
+            if self.current[0] != '{':
+                self.error('{')
+            self.advance()
+            body = self.parse_object('}')
+
+            blocks = result.setdefault(key, dict())
+            if not isinstance(blocks, dict):
+                raise HCLParseError(
+                    'Line {}: \'{}\' is both an attribute and a '
+                    'block.'.format(lineno, key))
+            if label in blocks:
+                # pyhcl merges the attributes of duplicated blocks.
+                blocks[label].update(body)
+            else:
+                blocks[label] = body
+
+            if key == 'action':
+                self.declarations.append((label, lineno))
+
+        return result
+
+    def parse_object(self, closing):
+        """Parses the attributes of a block or a map, up to and including
+        the closing token."""
+        obj = dict()
+        while self.current[0] != closing:
+            if self.current[0] not in ('identifier', 'string'):
+                self.error('an attribute name')
+            key = self.current[1]
+            self.advance()
+
+            if self.current[0] == '=':
+                self.advance()
+                value = self.parse_value()
+            elif self.current[0] == '{':
+                self.advance()
+                value = self.parse_object('}')
+            else:
+                self.error('=')
+
+            if key in obj:
+                # pyhcl turns repeated attributes into lists of values, this
+                # is left to the fallback parser.
+                raise HCLParseError(
+                    'Repeated attribute \'{}\'.'.format(key))
+            obj[key] = value
+
+            if self.current[0] == ',':
+                self.advance()
+        self.advance()
+        return obj
+
+    def parse_list(self):
+        """Parses the items of a list, up to and including the closing
+        bracket."""
+        items = list()
+        while self.current[0] != ']':
+            items.append(self.parse_value())
+            if self.current[0] == ',':
+                self.advance()
+            elif self.current[0] != ']':
+                self.error(']')
+        self.advance()
+        return items
+
+    def parse_value(self):
+        kind, value, _ = self.current
+        if kind in ('string', 'number', 'bool'):
+            self.advance()
+            return value
+        if kind == '[':
+            self.advance()
+            return self.parse_list()
+        if kind == '{':
+            self.advance()
+            return self.parse_object('}')
+        self.error('a value')
+
+
+def parse(text):
+    """Parses the content of a workflow file.
+
+    Args:
+        text (str): The content of the workflow file.
+
+    Returns:
+        (dict, list): The parsed content of the file and the list of
+                      (name, line number) tuples of the action
+                      declarations found in it.
+
+    Raises:
+        HCLParseError: If the content can not be parsed.
+    """
+    parser = Parser(text)
+    return parser.parse(), parser.declarations
+
+
+def parse_with_pyhcl(text):
+    """Parses the content of a workflow file with `hcl`, recording the
+    action declarations while the token stream is consumed by its parser.
+
+    Args:
+        text (str): The content of the workflow file.
+
+    Returns:
+        (dict, list): The parsed content of the file and the list of
+                      (name, line number) tuples of the action
+                      declarations found in it.
+    """
+    from hcl.lexer import Lexer
+    from hcl.parser import HclParser
+
+    class ActionDeclarationLexer(Lexer):
+        """An HCL lexer that records the top-level `action` declarations.
+        """
+
+        def __init__(self):
+            super(ActionDeclarationLexer, self).__init__()
+            self.declarations = list()
+            self.depth = 0
+            self.previous = None
+
+        def token(self):
+            t = super(ActionDeclarationLexer, self).token()
+            if t is None:
+                return t
+
+            if t.type in ('LEFTBRACE', 'LEFTBRACKET'):
+                self.depth += 1
+            elif t.type in ('RIGHTBRACE', 'RIGHTBRACKET'):
+                self.depth -= 1
+            elif (t.type == 'STRING' and self.depth == 0 and self.previous
+                  and self.previous.type == 'IDENTIFIER'
+                  and self.previous.value == 'action'):
+                self.declarations.append((t.value, self.previous.lineno))
+
+            self.previous = t
+            return t
+
+    lexer = ActionDeclarationLexer()
+    parsed = HclParser().yacc.parse(text, lexer=lexer)
+    return parsed, lexer.declarations
+
+
+def loads(text):
+    """Parses the content of a workflow file with the native parser,
+    falling back to `hcl` for content that it does not support.
+
+    Args:
+        text (str): The content of the workflow file.
+
+    Returns:
+        (dict, list): The parsed content of the file and the list of
+                      (name, line number) tuples of the action
+                      declarations found in it.
+    """
+    try:
+        return parse(text)
+    except HCLParseError as e:
+        log.debug('Falling back to pyhcl: {}'.format(e))
+        return parse_with_pyhcl(text)
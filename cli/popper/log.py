@@ -1,6 +1,7 @@
 import logging
 import sys
 import os
+import threading
 
 ACTION_INFO = 15
 logging.addLevelName(ACTION_INFO, 'ACTION_INFO')
@@ -127,6 +128,31 @@ class LevelFilter(logging.Filter):
             return (record.levelno in self.passlevels)
 
 
+_context = threading.local()
+
+
+def set_prefix(prefix=None):
+    """Sets the prefix of the messages logged by the current thread, used
+    to tell apart the output of workflows that run at the same time."""
+    _context.prefix = prefix
+
+
+def get_prefix():
+    """Returns the prefix of the messages logged by the current thread."""
+    return getattr(_context, 'prefix', None)
+
+
+class PrefixFilter(logging.Filter):
+    """Prepends the prefix of the current thread to messages."""
+
+    def filter(self, record):
+        prefix = get_prefix()
+        if prefix:
+            # Not str(), which fails for unicode messages on Python 2.
+            record.msg = u'{}{}'.format(prefix, record.msg)
+        return True
+
+
 def setup_logging(level='ACTION_INFO'):
     """
     Setups logging facilities with custom Logger and Formatter
@@ -148,6 +174,7 @@ def setup_logging(level='ACTION_INFO'):
 
     log.addHandler(h1)
     log.addHandler(h2)
+    log.addFilter(PrefixFilter())
     log.setLevel(level)
 
     return log
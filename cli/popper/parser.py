@@ -1,74 +1,560 @@
 from __future__ import unicode_literals
-from copy import deepcopy
+import io
+import os
+import json
+import itertools
 from builtins import str, dict
 
-import hcl
-
 from popper.cli import log
-from popper import utils as pu
+from popper import __version__ as popper_version, hclparse, utils as pu
 
 
 VALID_ACTION_ATTRS = ["uses", "args", "needs", "runs", "secrets", "env"]
 VALID_WORKFLOW_ATTRS = ["resolves", "on"]
 
+# Bump this whenever the layout of the compiled workflow cache changes.
+WORKFLOW_CACHE_FORMAT = 3
+
+# Prefix of the keys of the `env` attribute of an action that declare the
+# values of a parameter sweep, e.g. `POPPER_MATRIX_SIZE = "1,10,100"`.
+MATRIX_PREFIX = 'POPPER_MATRIX_'
+
+
+class Action(object):
+    """Represents an action of a workflow.
+
+    Actions are accessed through the same interface as a `dict` whose keys
+    are the attributes of an action block, plus the attributes that are
+    attached to the action while it is processed (`name`, `next`,
+    `repo_dir` and `action_dir`). An attribute that has not been
+    set is not a key of the action. The attributes are stored in slots,
+    which keeps large workflows small in memory and cheap to pickle.
+
+    Every action of a workflow is also identified by an integer `id`.
+    """
+    KEYS = ('uses', 'args', 'needs', 'runs', 'secrets', 'env',
+            'name', 'next', 'repo_dir', 'action_dir')
+
+    __slots__ = ('id',) + KEYS
+    __hash__ = None
+
+    def __init__(self, id=None, name=None, attrs=None):
+        """Creates an action.
+
+        Args:
+            id (int): The integer id of the action in its workflow.
+            name (str): The name of the action.
+            attrs (dict): The attributes of the action.
+        """
+        self.id = id
+        if name is not None:
+            self.name = name
+        if attrs:
+            for k, v in attrs.items():
+                self[k] = v
+
+    def __getitem__(self, key):
+        if key not in Action.KEYS:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in Action.KEYS:
+            raise KeyError('Invalid action attribute \'{}\'.'.format(key))
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        delattr(self, key)
+
+    def __contains__(self, key):
+        return key in Action.KEYS and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (Action, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return 'Action({})'.format(dict(self.items()))
+
+    def __getstate__(self):
+        return (self.id, dict(self.items()))
+
+    def __setstate__(self, state):
+        self.id = state[0]
+        for k, v in state[1].items():
+            setattr(self, k, v)
+
+    def keys(self):
+        return [k for k in Action.KEYS if hasattr(self, k)]
+
+    def values(self):
+        return [getattr(self, k) for k in self.keys()]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.keys()]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = getattr(self, key)
+        delattr(self, key)
+        return value
+
+    def copy(self):
+        """Returns a shallow copy of the action."""
+        return Action(self.id, attrs=self)
+
+
+class ReachabilityIndex(object):
+    """Reachability index of the actions of a workflow.
+
+    The actions are sorted in topological order and, for each action, the
+    set of its ancestors (the actions it transitively needs) and of its
+    descendants (the actions that transitively need it) is stored as a
+    bitset indexed by action id. Upstream and downstream closures of any
+    set of actions are then answered with a single pass over the set.
+    """
+
+    def __init__(self, actions):
+        """Builds the index.
+
+        Args:
+            actions (dict): The actions of a workflow, indexed by name.
+        """
+        size = max([a.id for a in actions.values()] + [-1]) + 1
+        self.names = [None] * size
+        for a_name, a_block in actions.items():
+            self.names[a_block.id] = a_name
+
+        needs = [list() for _ in range(size)]
+        children = [list() for _ in range(size)]
+        for a_block in actions.values():
+            for n in a_block.get('needs', list()):
+                if n in actions:
+                    needs[a_block.id].append(actions[n].id)
+                    children[actions[n].id].append(a_block.id)
+
+        # Kahn's algorithm over the dependencies. Actions that are part of
+        # a cycle are left out of the order and have no closure.
+        in_degree = [len(n) for n in needs]
+        self.order = [i for i in range(size)
+                      if self.names[i] is not None and not in_degree[i]]
+        for i in self.order:
+            for c in children[i]:
+                in_degree[c] -= 1
+                if not in_degree[c]:
+                    self.order.append(c)
+
+        self.ancestors = [0] * size
+        for i in self.order:
+            for n in needs[i]:
+                self.ancestors[i] |= self.ancestors[n] | (1 << n)
+
+        self.descendants = [0] * size
+        for i in reversed(self.order):
+            for c in children[i]:
+                self.descendants[i] |= self.descendants[c] | (1 << c)
+
+        self.ids = dict((n, i) for i, n in enumerate(self.names) if n)
+
+    def to_names(self, bits):
+        """Returns the names of the actions in a bitset."""
+        names = set()
+        while bits:
+            lowest = bits & -bits
+            names.add(self.names[lowest.bit_length() - 1])
+            bits ^= lowest
+        return names
+
+    def to_bits(self, names):
+        """Returns the bitset of a collection of action names."""
+        bits = 0
+        for n in names:
+            bits |= 1 << self.ids[n]
+        return bits
+
+    def is_acyclic(self):
+        """Whether every action of the workflow is in the topological
+        order, that is, whether the dependencies have no cycles."""
+        return len(self.order) == len(self.ids)
+
+    def get_topological_order(self):
+        """Returns the names of the actions in topological order."""
+        return [self.names[i] for i in self.order]
+
+    def get_ancestors(self, names):
+        """Returns the upstream closure of a collection of actions, not
+        including the actions themselves."""
+        bits = 0
+        for n in names:
+            bits |= self.ancestors[self.ids[n]]
+        return self.to_names(bits)
+
+    def get_descendants(self, names):
+        """Returns the downstream closure of a collection of actions, not
+        including the actions themselves."""
+        bits = 0
+        for n in names:
+            bits |= self.descendants[self.ids[n]]
+        return self.to_names(bits)
+
+    def get_unreachable(self, entrypoint):
+        """Returns the actions that are neither in `entrypoint` nor in its
+        upstream closure."""
+        bits = self.to_bits(entrypoint)
+        for n in entrypoint:
+            bits |= self.ancestors[self.ids[n]]
+        return self.to_names(((1 << len(self.names)) - 1) & ~bits) - {None}
+
 
 class Workflow(object):
     """Represent's a immutable workflow.
     """
 
     def __init__(self, wfile):
-        # Read and parse the workflow file.
-        with open(wfile, 'r') as fp:
-            self.parsed_workflow = hcl.load(fp)
-            fp.seek(0)
-            self.workflow_content = fp.readlines()
-            self.workflow_path = wfile
+        # Read the workflow file. The HCL content is only parsed when it is
+        # needed, i.e. when the workflow is not found in the cache.
+        with io.open(wfile, 'r', encoding='utf-8') as fp:
+            self._workflow_text = fp.read()
+        self.workflow_path = wfile
+        self.workflow_hash = pu.get_id(popper_version, WORKFLOW_CACHE_FORMAT,
+                                       self._workflow_text)
+        self._parsed_workflow = None
+        self.action_declarations = list()
+        self.expansions = dict()
+        self.runners = dict()
+
+    @property
+    def parsed_workflow(self):
+        """The content of the workflow file, as parsed by `hclparse`.
+
+        The action declarations, along with their line numbers, are
+        recorded in `action_declarations` while the file is tokenized, and
+        the content of the file is released once it has been parsed.
+        """
+        return self.load_parsed_workflow()
+
+    def load_parsed_workflow(self):
+        """Parses the workflow file, if it has not been parsed yet.
+
+        Returns:
+            dict: The content of the workflow file.
+        """
+        if self._parsed_workflow is None:
+            if self._workflow_text is None:
+                with io.open(self.workflow_path, 'r', encoding='utf-8') as fp:
+                    self._workflow_text = fp.read()
+            self._parsed_workflow, self.action_declarations = hclparse.loads(
+                self._workflow_text)
+            self._workflow_text = None
+        return self._parsed_workflow
 
     def get_action(self, action):
         """Returns an action from a workflow."""
-        if self.parsed_workflow['action'].get(action, None):
-            return self.parsed_workflow['action'][action]
+        if self.action.get(action, None):
+            return self.action[action]
         else:
             log.fail("Action '{}' doesn\'t exist.".format(action))
 
-    def parse(self):
-        """Parse and validate a workflow."""
-        self.validate_workflow_block()
-        self.validate_action_blocks()
-        self.normalize()
-        self.check_for_empty_workflow()
+    def edit_action(self, action):
+        """Returns an action that can be modified. A workflow owns its
+        actions, so this is the action itself.
+
+        Args:
+            action (str): The name of the action.
+
+        Returns:
+            dict: The action.
+        """
+        return self.get_action(action)
+
+    def parse(self, lazy=False, targets=None, keep=None):
+        """Parse and validate a workflow.
+
+        The validated and normalized graph is stored in the compiled
+        workflows cache, so that subsequent parsing of the same workflow
+        file (by the same version of popper) skips this entirely.
+
+        In lazy mode, only the workflow block and the actions reachable
+        from `targets` (or from the [resolves] attribute when no target
+        is given) are validated and normalized. Errors in any other
+        action are reported as warnings and the action is left out of the
+        workflow. A lazily parsed workflow is not stored in the cache, and
+        a workflow found in the cache is narrowed down to the targets.
+
+        Args:
+            lazy (bool): Whether to validate lazily.
+            targets (list): The actions that are going to be run. In lazy
+                            mode, they replace the [resolves] attribute.
+            keep (list): Other actions that must be validated in lazy
+                         mode, e.g. the one given to `--on-failure`.
+        """
+        cached = self.load_from_cache()
+        if not cached:
+            self.validate_workflow_block()
+
+            scope = None
+            if lazy:
+                workflow_block = list(
+                    self.parsed_workflow['workflow'].values())[0]
+                entrypoint = targets or workflow_block['resolves']
+                if pu.of_type(entrypoint, ['str']):
+                    entrypoint = [entrypoint]
+                scope = self.get_action_scope(
+                    list(entrypoint) + list(keep or []))
+
+            self.validate_action_blocks(scope)
+            self.normalize(scope)
+            self.expand_matrices()
+
+        if lazy and targets:
+            targets = Workflow.expand_names(targets, self.expansions)
+            for a in targets:
+                self.get_action(a)
+            self.resolves = list(targets)
+            if cached:
+                self.restrict_to(targets + Workflow.expand_names(
+                    keep or list(), self.expansions))
+
+        if not cached:
+            self.check_for_empty_workflow()
+            self.complete_graph()
+            if not lazy:
+                self.save_to_cache()
+
+    def restrict_to(self, entrypoint):
+        """Leaves out of the workflow the actions that are not needed by
+        the given ones, and builds the graph again from the [resolves]
+        attribute.
+
+        Args:
+            entrypoint (list): The actions to keep, along with the actions
+                               they need.
+        """
+        for a in entrypoint:
+            self.get_action(a)
+        keep = set(entrypoint) | self.get_index().get_ancestors(entrypoint)
+        self.action = dict((a_name, a_block)
+                           for a_name, a_block in self.action.items()
+                           if a_name in keep)
+        for a_block in self.action.values():
+            a_block.pop('next', None)
+        self.root = set()
+        self._index = None
         self.complete_graph()
 
+    def get_action_scope(self, entrypoint):
+        """Returns the names of the actions that are reachable from the
+        given ones by following the [needs] attribute of the action
+        blocks, before they are validated.
+
+        Args:
+            entrypoint (list): List of actions from where to start.
+
+        Returns:
+            set: The reachable actions, including the entrypoint.
+        """
+        action_blocks = self.parsed_workflow.get('action', dict())
+        scope = set()
+        pending = list(entrypoint)
+        while pending:
+            a_name = pending.pop()
+            if a_name in scope or a_name not in action_blocks:
+                continue
+            scope.add(a_name)
+            needs = action_blocks[a_name].get('needs', list())
+            if pu.of_type(needs, ['str']):
+                needs = [needs]
+            if pu.of_type(needs, ['los']):
+                pending.extend(needs)
+        return scope
+
+    def get_cache_file(self):
+        """Returns the path to the compiled version of this workflow in
+        the compiled workflows cache."""
+        return os.path.join(pu.setup_workflow_cache(),
+                            '{}.json'.format(self.workflow_hash))
+
+    def load_from_cache(self):
+        """Loads the validated and normalized graph of the workflow from
+        the compiled workflows cache.
+
+        Returns:
+            bool: Whether the workflow was found in the cache or not.
+        """
+        cache_file = self.get_cache_file()
+        if not os.path.isfile(cache_file):
+            return False
+
+        try:
+            with io.open(cache_file, 'r', encoding='utf-8') as cf:
+                compiled = json.load(cf)
+        except (IOError, OSError, ValueError):
+            log.debug('Ignoring corrupt cache file {}'.format(cache_file))
+            return False
+
+        self._workflow_text = None
+        self.name = compiled['name']
+        self.resolves = compiled['resolves']
+        self.on = compiled['on']
+        self.root = set(compiled['root'])
+        self.expansions = compiled['expansions']
+        self.action = dict()
+        self.props = dict()
+        for a_id, (a_name, a_block) in enumerate(compiled['action'].items()):
+            a_block = Action(a_id, attrs=a_block)
+            if 'next' in a_block:
+                a_block['next'] = set(a_block['next'])
+            self.action[a_name] = a_block
+        self.reset_levels()
+
+        log.debug('Loaded workflow from cache file {}'.format(cache_file))
+        return True
+
+    def save_to_cache(self):
+        """Stores the validated and normalized graph of the workflow in
+        the compiled workflows cache."""
+        compiled = {
+            'name': self.name,
+            'resolves': self.resolves,
+            'on': self.on,
+            'root': sorted(self.root),
+            'expansions': self.expansions,
+            'action': dict()
+        }
+        for a_name, a_block in self.action.items():
+            a_block = dict(a_block.items())
+            if 'next' in a_block:
+                a_block['next'] = sorted(a_block['next'])
+            compiled['action'][a_name] = a_block
+
+        # Write to a temporary file first, so that concurrent invocations
+        # never read a partially written entry.
+        cache_file = self.get_cache_file()
+        tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'w') as cf:
+                json.dump(compiled, cf)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError):
+            log.debug('Unable to write cache file {}'.format(cache_file))
+
+    def get_action_levels(self):
+        """Assigns every action reachable from the root set to a stage
+        level. The level of an action is the earliest stage in which all
+        of its dependencies have already been executed, i.e. the root
+        actions are at level 0 and every other action is one level after
+        the deepest of the actions it needs.
+
+        The levels are computed with a Kahn-style traversal over the
+        forward (`next`) edges, visiting every node and edge exactly once.
+
+        Returns:
+            dict: A mapping from action names to their level.
+        """
+        if getattr(self, '_levels', None) is not None:
+            return self._levels
+
+        # Count incoming edges only from actions that are reachable
+        # from the root set.
+        in_degree = dict()
+        reachable = set(self.root)
+        pending = list(self.root)
+        while pending:
+            n = pending.pop()
+            for m in self.action[n].get('next', set()):
+                in_degree[m] = in_degree.get(m, 0) + 1
+                if m not in reachable:
+                    reachable.add(m)
+                    pending.append(m)
+
+        levels = dict()
+        current_level = [a for a in self.root if not in_degree.get(a, 0)]
+        depth = 0
+        while current_level:
+            next_level = list()
+            for n in current_level:
+                levels[n] = depth
+                for m in self.action[n].get('next', set()):
+                    in_degree[m] -= 1
+                    if in_degree[m] == 0:
+                        next_level.append(m)
+            current_level = next_level
+            depth += 1
+
+        self._levels = levels
+        return levels
+
+    def get_action_level(self, action):
+        """Returns the stage level of an action, as computed by
+        `get_action_levels()`.
+
+        Args:
+            action (str): The name of the action.
+
+        Returns:
+            int: The level of the action or None if it is unreachable.
+        """
+        return self.get_action_levels().get(action, None)
+
+    def reset_levels(self):
+        """Discards the cached stage levels. This needs to be called
+        whenever the edges of the workflow graph are modified."""
+        self._levels = None
+
+    def get_index(self):
+        """Returns the `ReachabilityIndex` of the workflow. The index is
+        built the first time it is requested and reflects the workflow
+        graph as it was after parsing.
+        """
+        if getattr(self, '_index', None) is None:
+            self._index = ReachabilityIndex(self.action)
+        return self._index
+
     @pu.threadsafe_generator
     def get_stages(self):
         """Generator of stages. A stages is a list of actions that can be
         executed in parallel.
         """
-        def resolve_intersections(stage):
-            """Removes actions from a stage that creates
-            conflict between the selected stage candidates."""
-            actions_to_remove = set()
-            for a in stage:
-                if self.action[a].get('next', None):
-                    intersection = self.action[a]['next'].intersection(stage)
-                    if intersection:
-                        for i in intersection:
-                            actions_to_remove.add(i)
-
-            for a in actions_to_remove:
-                stage.remove(a)
-
-        current_stage = self.root
-
-        while current_stage:
-            yield current_stage
-            next_stage = set()
-            for n in current_stage:
-                next_stage.update(
-                    self.action[n].get(
-                        'next', set()))
-                resolve_intersections(next_stage)
-            current_stage = next_stage
+        stages = list()
+        for a, level in self.get_action_levels().items():
+            while len(stages) <= level:
+                stages.append(set())
+            stages[level].add(a)
+
+        for stage in stages:
+            yield stage
 
     def check_for_empty_workflow(self):
         """Checks whether all the actions mentioned in resolves
@@ -88,27 +574,37 @@ class Workflow(object):
         previous nodes they depend on. To make the workflow easier to process,
         we add forward edges. This also obtains the root nodes.
 
+        Every node is expanded only once, so the traversal is linear in the
+        size of the graph regardless of how many paths lead to a node.
+
         Args:
             entrypoint (list): List of nodes from where to start
                                generating the graph.
             root (set) : Set of nodes without dependencies,
                          that would eventually be used as root.
         """
-        for node in entrypoint:
+        visited = set()
+        pending = list(entrypoint)
+        while pending:
+            node = pending.pop()
+            if node in visited:
+                continue
+            visited.add(node)
             if self.get_action(node).get('needs', None):
                 for n in self.action[node]['needs']:
-                    self.find_root([n], root)
                     if not self.get_action(n).get('next', None):
                         self.action[n]['next'] = set()
                     self.action[n]['next'].add(node)
+                    if n not in visited:
+                        pending.append(n)
             else:
                 root.add(node)
 
     def complete_graph(self):
-        """Driver function to run the recursive function
-        `_complete_graph_util()` which adds forward edges.
+        """Driver function to run `find_root()` which adds forward edges.
         """
         self.find_root(self.resolves, self.root)
+        self.reset_levels()
 
     def validate_workflow_block(self):
         """Validate the syntax of the workflow block.
@@ -140,52 +636,61 @@ class Workflow(object):
             if not pu.of_type(workflow_block['on'], ['str']):
                 log.fail('[on] attribute mist be a string.')
 
-    def validate_action_blocks(self):
+    def validate_action_blocks(self, scope=None):
         """Validate the syntax of the action blocks.
+
+        Args:
+            scope (set): When given, only errors in these actions are
+                         fatal, errors in any other action are reported
+                         as warnings.
         """
         self.check_duplicate_actions()
         if not self.parsed_workflow.get('action', None):
             log.fail('Atleast one action block must be present.')
 
-        for _, a_block in self.parsed_workflow['action'].items():
-            for key in a_block.keys():
-                if key not in VALID_ACTION_ATTRS:
-                    log.fail(
-                        'Invalid action attribute \'{}\' found.'.format(key))
-
-            if not a_block.get('uses', None):
-                log.fail('[uses] attribute must be present in action block.')
-
-            if not pu.of_type(a_block['uses'], ['str']):
-                log.fail('[uses] attribute must be a string.')
-
-            if a_block.get('needs', None):
-                if not pu.of_type(a_block['needs'], ['str', 'los']):
-                    log.fail(
-                        '[needs] attribute must be a string or a list '
-                        'of strings.')
-
-            if a_block.get('args', None):
-                if not pu.of_type(a_block['args'], ['str', 'los']):
-                    log.fail(
-                        '[args] attribute must be a string or a list '
-                        'of strings.')
+        for a_name, a_block in self.parsed_workflow['action'].items():
+            for error in Workflow.get_action_block_errors(a_block):
+                if scope is None or a_name in scope:
+                    log.fail(error)
+                log.warning('Ignoring action \'{}\': {}'.format(a_name, error))
+                break
 
-            if a_block.get('runs', None):
-                if not pu.of_type(a_block['runs'], ['str', 'los']):
-                    log.fail(
-                        '[runs] attribute must be a string or a list '
-                        'of strings.')
-
-            if a_block.get('env', None):
-                if not pu.of_type(a_block['env'], ['dict']):
-                    log.fail('[env] attribute must be a dict.')
-
-            if a_block.get('secrets', None):
-                if not pu.of_type(a_block['secrets'], ['str', 'los']):
-                    log.fail(
-                        '[secrets] attribute must be a string or a list '
-                        'of strings.')
+    @staticmethod
+    def get_action_block_errors(a_block):
+        """Generator of the syntax errors of an action block."""
+        for key in a_block.keys():
+            if key not in VALID_ACTION_ATTRS:
+                yield 'Invalid action attribute \'{}\' found.'.format(key)
+
+        if not a_block.get('uses', None):
+            yield '[uses] attribute must be present in action block.'
+
+        elif not pu.of_type(a_block['uses'], ['str']):
+            yield '[uses] attribute must be a string.'
+
+        if a_block.get('needs', None):
+            if not pu.of_type(a_block['needs'], ['str', 'los']):
+                yield ('[needs] attribute must be a string or a list '
+                       'of strings.')
+
+        if a_block.get('args', None):
+            if not pu.of_type(a_block['args'], ['str', 'los']):
+                yield ('[args] attribute must be a string or a list '
+                       'of strings.')
+
+        if a_block.get('runs', None):
+            if not pu.of_type(a_block['runs'], ['str', 'los']):
+                yield ('[runs] attribute must be a string or a list '
+                       'of strings.')
+
+        if a_block.get('env', None):
+            if not pu.of_type(a_block['env'], ['dict']):
+                yield '[env] attribute must be a dict.'
+
+        if a_block.get('secrets', None):
+            if not pu.of_type(a_block['secrets'], ['str', 'los']):
+                yield ('[secrets] attribute must be a string or a list '
+                       'of strings.')
 
     @staticmethod
     def format_command(params):
@@ -195,7 +700,7 @@ class Workflow(object):
             return params.split(" ")
         return params
 
-    def normalize(self):
+    def normalize(self, scope=None):
         """Takes properties from the `self.parsed_workflow` dict and
         makes them native to the `Workflow` class. Also it normalizes
         some of the attributes of a parsed workflow according to
@@ -205,6 +710,10 @@ class Workflow(object):
         if provided as a string to a list of string by splitting around
         whitespace. Also, it changes parameters like `uses` and `resolves`,
         if provided as a string to a list.
+
+        Args:
+            scope (set): When given, only these actions are normalized and
+                         the rest are left out of the workflow.
         """
         for wf_name, wf_block in self.parsed_workflow['workflow'].items():
 
@@ -212,14 +721,18 @@ class Workflow(object):
             self.resolves = wf_block['resolves']
             self.on = wf_block.get('on', 'push')
             self.root = set()
-            self.action = self.parsed_workflow['action']
+            self.action = dict()
             self.props = dict()
 
             if pu.of_type(self.resolves, ['str']):
                 self.resolves = [self.resolves]
 
-        for a_name, a_block in self.action.items():
-            a_block['name'] = a_name
+        for a_id, (a_name, a_block) in enumerate(
+                self.parsed_workflow['action'].items()):
+            if scope is not None and a_name not in scope:
+                continue
+            a_block = Action(a_id, a_name, a_block)
+            self.action[a_name] = a_block
 
             if a_block.get('needs', None):
                 if pu.of_type(a_block['needs'], ['str']):
@@ -235,19 +748,111 @@ class Workflow(object):
                 a_block['secrets'] = Workflow.format_command(
                     a_block['secrets'])
 
+    @staticmethod
+    def get_matrix(a_block):
+        """Returns the parameters swept by an action, declared through the
+        `POPPER_MATRIX_<NAME>` keys of its `env` attribute as
+        comma-separated lists of values.
+
+        Args:
+            a_block (Action): The action.
+
+        Returns:
+            list: The name and the list of values of each parameter,
+                  sorted by name.
+        """
+        matrix = list()
+        for key, value in sorted(a_block.get('env', dict()).items()):
+            if not key.startswith(MATRIX_PREFIX):
+                continue
+            values = [v.strip() for v in str(value).split(',')]
+            if not key[len(MATRIX_PREFIX):] or not all(values):
+                log.fail('Action \'{}\': {} must be a comma-separated list '
+                         'of values.'.format(a_block['name'], key))
+            matrix.append((key[len(MATRIX_PREFIX):], values))
+        return matrix
+
+    def expand_matrices(self):
+        """Replaces every action that declares a matrix with one action for
+        each combination of the values of its parameters. The expansions
+        are named after the action and their values, e.g. `a[SIZE=10]`,
+        and see each parameter as a variable of their environment. The
+        actions that need a matrix action, and the [resolves] attribute,
+        need all its expansions instead.
+
+        The names of the expansions of each matrix action are kept in
+        `expansions`, so that the action can still be selected by its name.
+
+        Returns:
+            dict: The names of the expansions of each matrix action.
+        """
+        expansions = dict()
+        self.expansions = expansions
+        actions = dict()
+        for a_name, a_block in self.action.items():
+            matrix = Workflow.get_matrix(a_block)
+            if not matrix:
+                actions[a_name] = a_block
+                continue
+
+            env = dict((k, v) for k, v in a_block['env'].items()
+                       if not k.startswith(MATRIX_PREFIX))
+            names = [k for k, _ in matrix]
+            expansions[a_name] = list()
+            for values in itertools.product(*[v for _, v in matrix]):
+                params = list(zip(names, values))
+                e_name = '{}[{}]'.format(a_name, ','.join(
+                    '{}={}'.format(k, v) for k, v in params))
+                if e_name in self.action or e_name in actions:
+                    log.fail('Action \'{}\' is also an expansion of the '
+                             'matrix of action \'{}\'.'.format(e_name, a_name))
+                attrs = dict(a_block.items())
+                attrs['name'] = e_name
+                attrs['env'] = dict(env)
+                attrs['env'].update(params)
+                actions[e_name] = Action(attrs=attrs)
+                expansions[a_name].append(e_name)
+
+        if not expansions:
+            return expansions
+
+        for a_block in actions.values():
+            if a_block.get('needs', None):
+                a_block['needs'] = Workflow.expand_names(
+                    a_block['needs'], expansions)
+        self.resolves = Workflow.expand_names(self.resolves, expansions)
+
+        for a_id, a_block in enumerate(actions.values()):
+            a_block.id = a_id
+        self.action = actions
+        log.debug('Expanded matrix actions {}'.format(', '.join(
+            '{} into {}'.format(a, len(e))
+            for a, e in sorted(expansions.items()))))
+        return expansions
+
+    @staticmethod
+    def expand_names(names, expansions):
+        """Replaces the names of matrix actions by their expansions."""
+        expanded = list()
+        for n in names:
+            expanded.extend(expansions.get(n, [n]))
+        return expanded
+
     def check_duplicate_actions(self):
         """Checks whether duplicate action blocks are
-        present or not."""
-        parsed_acount = 0
-        if self.parsed_workflow.get('action', None):
-            parsed_acount = len(list(self.parsed_workflow['action'].items()))
-        acount = 0
-        for line in self.workflow_content:
-            line = line.strip()
-            if line.startswith('action '):
-                acount += 1
-        if parsed_acount != acount:
-            log.fail('Duplicate action identifiers found.')
+        present or not, using the action declarations recorded while
+        the workflow file was tokenized."""
+        self.load_parsed_workflow()
+        lines = dict()
+        for a_name, lineno in self.action_declarations:
+            lines.setdefault(a_name, list()).append(lineno)
+
+        duplicates = [
+            '\'{}\' (lines {})'.format(a, ', '.join(map(str, linenos)))
+            for a, linenos in sorted(lines.items()) if len(linenos) > 1]
+        if duplicates:
+            log.fail('Duplicate action identifiers found: {}.'.format(
+                ', '.join(duplicates)))
 
     def check_for_unreachable_actions(self, skip=None):
         """Validates a workflow by checking for unreachable nodes / gaps
@@ -258,18 +863,26 @@ class Workflow(object):
         """
 
         def _traverse(entrypoint, reachable, actions):
-            for node in entrypoint:
+            pending = list(entrypoint)
+            while pending:
+                node = pending.pop()
+                if node in reachable:
+                    continue
                 reachable.add(node)
-                _traverse(actions[node].get(
-                    'next', []), reachable, actions)
+                pending.extend(actions[node].get('next', []))
 
-        reachable = set()
         skipped = set(self.props.get('skip_list', []))
         actions = set(map(lambda a: a[0], self.action.items()))
 
-        _traverse(self.root, reachable, self.action)
-
-        unreachable = actions - reachable
+        if self.is_pristine() and self.get_index().is_acyclic():
+            # The graph is the one that was built from the resolves
+            # attribute, so the reachable actions are its upstream closure.
+            unreachable = actions.intersection(
+                self.get_index().get_unreachable(self.resolves))
+        else:
+            reachable = set()
+            _traverse(self.root, reachable, self.action)
+            unreachable = actions - reachable
         if unreachable - skipped:
             if skip:
                 log.fail('Actions {} are unreachable.'.format(
@@ -283,38 +896,117 @@ class Workflow(object):
         for a in unreachable:
             self.action.pop(a)
 
+        self.reset_levels()
+
+    def is_pristine(self):
+        """Whether the graph of the workflow is still the one built by
+        `parse()`."""
+        return True
+
     @staticmethod
     def skip_actions(wf, skip_list=list()):
         """Removes the actions to be skipped from the workflow graph and
-        return a new `Workflow` object.
+        return a new `WorkflowView` object.
+
+        Only the skipped actions and their direct neighbours are copied,
+        the rest of the action definitions are shared with `wf`.
 
         Args:
             wf (Workflow) : The workflow object to operate upon.
-            skip_list (list) : List of actions to be skipped.
+            skip_list (list) : List of actions to be skipped. Skipping a
+                               matrix action skips all its expansions.
 
         Returns:
-            Workflow : The updated workflow object.
+            WorkflowView : The updated workflow object.
         """
-        workflow = deepcopy(wf)
+        skip_list = Workflow.expand_names(skip_list, wf.expansions)
+        workflow = WorkflowView(wf)
         for sa_name in skip_list:
-            sa_block = workflow.get_action(sa_name)
+            sa_block = workflow.edit_action(sa_name)
+
+            # Handle skipping of non-root action's
+            for a_name in sa_block.get('needs', list()):
+                if sa_name in workflow.action[a_name].get('next', set()):
+                    workflow.edit_action(a_name)['next'].remove(sa_name)
+
+            for a_name in sa_block.get('next', set()):
+                if sa_name in workflow.action[a_name].get('needs', list()):
+                    workflow.edit_action(a_name)['needs'].remove(sa_name)
+
             # Clear up all connections from sa_block
             sa_block.get('next', set()).clear()
             del sa_block.get('needs', list())[:]
 
             # Handle skipping of root action's
-            if sa_name in workflow.root:
-                workflow.root.remove(sa_name)
+            workflow.root.discard(sa_name)
 
-            # Handle skipping of non-root action's
-            for a_name, a_block in workflow.action.items():
-                if sa_name in a_block.get('next', set()):
-                    a_block['next'].remove(sa_name)
+        workflow.props['skip_list'] = list(skip_list)
+        return workflow
 
-                if sa_name in a_block.get('needs', list()):
-                    a_block['needs'].remove(sa_name)
+    def get_identical_actions(self):
+        """Finds the actions that do the same as another one, i.e. that
+        only differ from it by their name: they have the same attributes
+        and need the same actions, or actions that are themselves
+        identical.
 
-        workflow.props['skip_list'] = list(skip_list)
+        Returns:
+            dict: The actions that are identical to each action, for the
+                  actions that have any, by the name of the first one.
+        """
+        attrs = [k for k in VALID_ACTION_ATTRS if k != 'needs']
+        canonical = dict()
+        signatures = dict()
+        identical = dict()
+        for stage in self.get_stages():
+            for a in sorted(stage):
+                a_block = self.action[a]
+                needs = sorted(set(canonical.get(n, n)
+                                   for n in a_block.get('needs', list())))
+                signature = json.dumps(
+                    [a_block.get(k, None) for k in attrs] + [needs],
+                    sort_keys=True)
+                first = signatures.setdefault(signature, a)
+                canonical[a] = first
+                if first != a:
+                    identical.setdefault(first, list()).append(a)
+        return identical
+
+    @staticmethod
+    def coalesce_actions(wf):
+        """Removes the actions that are identical to another one from the
+        workflow graph, the actions that need them need the other one
+        instead, and returns a new `WorkflowView` object.
+
+        Args:
+            wf (Workflow) : The workflow object to operate upon.
+
+        Returns:
+            WorkflowView : The updated workflow object.
+        """
+        workflow = WorkflowView(wf)
+        coalesced = dict()
+        for first, others in sorted(wf.get_identical_actions().items()):
+            log.info('[popper] Coalescing actions {} into \'{}\''.format(
+                ', '.join(others), first))
+            for ia_name in others:
+                ia_block = workflow.action.pop(ia_name)
+                for a_name in ia_block.get('needs', list()):
+                    if ia_name in workflow.action[a_name].get('next', set()):
+                        workflow.edit_action(a_name)['next'].remove(ia_name)
+
+                for a_name in ia_block.get('next', set()):
+                    a_block = workflow.edit_action(a_name)
+                    a_block['needs'].remove(ia_name)
+                    if first not in a_block['needs']:
+                        a_block['needs'].append(first)
+                    workflow.edit_action(first).setdefault(
+                        'next', set()).add(a_name)
+
+                workflow.root.discard(ia_name)
+                coalesced[ia_name] = first
+
+        workflow.props['coalesced'] = coalesced
+        workflow.reset_levels()
         return workflow
 
     @staticmethod
@@ -324,66 +1016,125 @@ class Workflow(object):
 
         Args:
             wf (Workflow) : The workflow object to operate upon.
-            action (str) : The action to run.
+            action (str) : The action to run. For a matrix action, all
+                           its expansions are run.
             with_dependencies (bool) : Filter out action to
             run with dependencies or not.
 
         Returns:
-            Workflow : The updated workflow object.
+            WorkflowView : The updated workflow object.
         """
-        # Recursively generate root when an action is run
-        # with the `--with-dependencies` flag.
-        def find_root_recursively(workflow, action, required_actions):
-            required_actions.add(action)
-            if workflow.get_action(action).get('needs', None):
-                for a in workflow.get_action(action)['needs']:
-                    find_root_recursively(workflow, a, required_actions)
-                    if not workflow.get_action(a).get('next', None):
-                        workflow.get_action(a)['next'] = set()
-                    workflow.get_action(a)['next'].add(action)
-            else:
-                workflow.root.add(action)
+        actions = Workflow.expand_names([action], wf.expansions)
+        for a in actions:
+            wf.get_action(a)
 
         # The list of actions that needs to be preserved.
-        workflow = deepcopy(wf)
+        required_actions = set(actions)
 
-        actions = set(map(lambda x: x[0], workflow.action.items()))
+        if with_dependencies:
+            required_actions.update(wf.get_index().get_ancestors(actions))
 
-        required_actions = set()
+        workflow = WorkflowView(wf, required_actions)
+        workflow.root = set()
 
         if with_dependencies:
             # Prepare the graph for running only the given action
             # only with its dependencies.
-            find_root_recursively(workflow, action, required_actions)
+            for ra in required_actions:
+                a_block = workflow.action[ra]
+                needs = a_block.get('needs', list())
+                for n in needs:
+                    if ra not in workflow.action[n].get('next', set()):
+                        n_block = workflow.edit_action(n)
+                        n_block.setdefault('next', set()).add(ra)
+
+                dropped = a_block.get('next', set()) - required_actions
+                if dropped:
+                    workflow.edit_action(ra)['next'] -= dropped
+
+                if not needs:
+                    workflow.root.add(ra)
+        else:
+            # Prepare the actions for their execution only.
+            for a in actions:
+                a_block = workflow.edit_action(a)
+                if a_block.get('next', None):
+                    a_block['next'] = set()
 
-            filtered_actions = actions - required_actions
+                if a_block.get('needs', None):
+                    a_block['needs'] = list()
 
-            for ra in required_actions:
-                a_block = workflow.get_action(ra)
-                common_actions = filtered_actions.intersection(
-                    a_block.get('next', set()))
-                if common_actions:
-                    for ca in common_actions:
-                        a_block['next'].remove(ca)
+                workflow.root.add(a)
+
+        return workflow
+
+
+class WorkflowView(Workflow):
+    """A copy-on-write view of a parsed workflow.
+
+    The view shares the action definitions of the workflow it was created
+    from and only keeps its own root set and the actions it has edited.
+    Actions are copied the first time they are modified through
+    `edit_action()`, so creating and modifying a view costs time and
+    memory proportional to the size of the change and not to the size of
+    the workflow.
+    """
+
+    def __init__(self, wf, actions=None):
+        """Creates a view of a workflow.
+
+        Args:
+            wf (Workflow): The workflow or view to create the view from.
+            actions (iterable): The actions to include in the view. All
+                                the actions of `wf` are included if this
+                                is not given.
+        """
+        self.base = wf.base if isinstance(wf, WorkflowView) else wf
+        self.workflow_path = wf.workflow_path
+        self.name = wf.name
+        self.resolves = wf.resolves
+        self.on = wf.on
+        self.root = set(wf.root)
+        self.expansions = wf.expansions
+        self.runners = dict(wf.runners)
+        self.props = dict(wf.props)
+        if actions is None:
+            self.action = dict(wf.action)
         else:
-            # Prepare the action for its execution only.
-            required_actions.add(action)
+            self.action = dict((a, wf.action[a]) for a in actions)
+        self.edited = set()
+        self.reset_levels()
 
-            if workflow.get_action(action).get('next', None):
-                workflow.get_action(action)['next'] = set()
+    @property
+    def parsed_workflow(self):
+        return self.base.parsed_workflow
 
-            if workflow.get_action(action).get('needs', None):
-                workflow.get_action(action)['needs'] = list()
+    def load_parsed_workflow(self):
+        return self.base.load_parsed_workflow()
 
-            workflow.root.add(action)
+    def get_index(self):
+        return self.base.get_index()
 
-        # Make the list of the actions to be removed.
-        actions = actions - required_actions
+    def is_pristine(self):
+        return not self.edited and self.root == self.base.root
 
-        # Remove the remaining actions
-        for a in actions:
-            if a in workflow.root:
-                workflow.root.remove(a)
-            workflow.action.pop(a)
+    def edit_action(self, action):
+        """Returns a copy of an action that is owned by this view and can
+        therefore be modified without affecting other views.
 
-        return workflow
+        Args:
+            action (str): The name of the action.
+
+        Returns:
+            dict: The action owned by the view.
+        """
+        if action not in self.edited:
+            a_block = self.get_action(action).copy()
+            if 'next' in a_block:
+                a_block['next'] = set(a_block['next'])
+            if 'needs' in a_block:
+                a_block['needs'] = list(a_block['needs'])
+            self.action[action] = a_block
+            self.edited.add(action)
+        self.reset_levels()
+        return self.action[action]
@@ -53,6 +53,66 @@ def setup_search_cache():
     return search_cache_file
 
 
+def setup_workflow_cache():
+    """Set up the cache of compiled workflows.
+
+    Returns:
+        str: The path to the compiled workflows cache directory.
+    """
+    base_cache = setup_base_cache()
+    workflow_cache = os.path.join(base_cache, 'workflows')
+
+    if not os.path.isdir(workflow_cache):
+        os.makedirs(workflow_cache)
+
+    return workflow_cache
+
+
+def setup_durations_cache():
+    """Set up the cache of the durations of previously run actions.
+
+    Returns:
+        str: The path to the durations cache directory.
+    """
+    base_cache = setup_base_cache()
+    durations_cache = os.path.join(base_cache, 'durations')
+
+    if not os.path.isdir(durations_cache):
+        os.makedirs(durations_cache)
+
+    return durations_cache
+
+
+def setup_journal_cache():
+    """Set up the cache of the journals of workflow runs.
+
+    Returns:
+        str: The path to the journals cache directory.
+    """
+    base_cache = setup_base_cache()
+    journal_cache = os.path.join(base_cache, 'journals')
+
+    if not os.path.isdir(journal_cache):
+        os.makedirs(journal_cache)
+
+    return journal_cache
+
+
+def setup_results_cache():
+    """Set up the cache of the outputs of actions.
+
+    Returns:
+        str: The path to the results cache directory.
+    """
+    base_cache = setup_base_cache()
+    results_cache = os.path.join(base_cache, 'results')
+
+    if not os.path.isdir(results_cache):
+        os.makedirs(results_cache)
+
+    return results_cache
+
+
 def decode(line):
     """Make treatment of stdout Python 2/3 compatible."""
     if isinstance(line, bytes):
@@ -368,3 +428,50 @@ def write_file(path, content=''):
     f = open(path, 'w')
     f.write(content)
     f.close()
+
+
+def parse_memory(value):
+    """Parse an amount of memory given as a number of bytes or as a
+    string with a unit suffix, like docker's `--memory` option (e.g.
+    `512m`, `2g` or `1.5GB`).
+
+    Args:
+        value (str): The amount of memory.
+
+    Returns:
+        int: The amount of memory in bytes, or None if it is invalid.
+    """
+    units = {'': 1, 'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3,
+             't': 1024 ** 4}
+    match = re.match(r'^\s*([0-9]+(?:\.[0-9]+)?)\s*([bkmgt]?)b?\s*$',
+                     str(value).lower())
+    if not match:
+        return None
+    return int(float(match.group(1)) * units[match.group(2)])
+
+
+def parse_duration(value):
+    """Parse a duration given as a number of seconds or as a string with
+    a unit suffix (e.g. `90`, `30s`, `15m` or `1.5h`).
+
+    Args:
+        value (str): The duration.
+
+    Returns:
+        float: The duration in seconds, or None if it is invalid.
+    """
+    units = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    match = re.match(r'^\s*([0-9]+(?:\.[0-9]+)?)\s*([smhd]?)\s*$',
+                     str(value).lower())
+    if not match:
+        return None
+    return float(match.group(1)) * units[match.group(2)]
+
+
+def get_host_memory():
+    """Returns the physical memory of the host, in bytes, or None if it
+    can not be determined."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
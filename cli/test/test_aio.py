@@ -0,0 +1,144 @@
+import os
+import sys
+import shutil
+import time
+import unittest
+
+from popper.cli import log
+from popper.parser import Workflow
+from popper.gha import WorkflowRunner
+import popper.utils as pu
+
+
+@unittest.skipIf(sys.version_info < (3, 5),
+                 'The asyncio engine requires Python 3.5 or newer')
+class TestAsyncActionScheduler(unittest.TestCase):
+
+    def setUp(self):
+        os.makedirs('/tmp/test_folder')
+        os.chdir('/tmp/test_folder')
+        log.setLevel('CRITICAL')
+
+    def tearDown(self):
+        os.chdir('/tmp')
+        shutil.rmtree('/tmp/test_folder')
+        log.setLevel('NOTSET')
+
+    def write_script(self, name, content):
+        pu.write_file('/tmp/test_folder/' + name, '#!/bin/sh\n' + content)
+        os.chmod('/tmp/test_folder/' + name, 0o755)
+
+    def get_workflow(self):
+        pu.write_file('/tmp/test_folder/a.workflow', """
+        workflow "sample" {
+            resolves = "end"
+        }
+        action "slow" {
+            uses = "sh"
+            runs = "slow.sh"
+        }
+        action "b" {
+            uses = "sh"
+            runs = "touch"
+            args = "b.done"
+        }
+        action "c" {
+            uses = "sh"
+            runs = "c.sh"
+            needs = "b"
+            env = { MARKER = "c.done" }
+        }
+        action "end" {
+            uses = "sh"
+            runs = "touch"
+            args = "end.done"
+            needs = ["slow", "c"]
+        }
+        """)
+        self.write_script('slow.sh', 'sleep 1\ntouch slow.done\n')
+        self.write_script('touch', 'touch "$@"\n')
+        self.write_script('c.sh', 'test -f b.done && touch $MARKER\n')
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        WorkflowRunner.instantiate_runners(
+            'docker', wf, '/tmp/test_folder', False, False, '12345')
+        return wf
+
+    def test_run(self):
+        from popper.aio import AsyncActionScheduler
+
+        wf = self.get_workflow()
+        AsyncActionScheduler('docker', wf, max_workers=4).run()
+        for a in ['slow', 'b', 'c', 'end']:
+            self.assertTrue(os.path.exists('/tmp/test_folder/' + a + '.done'))
+        self.assertEqual(os.getcwd(), '/tmp/test_folder')
+        self.assertNotIn('MARKER', os.environ)
+
+        # The second action of the chain does not wait for the slow one.
+        self.assertLess(os.path.getmtime('/tmp/test_folder/c.done'),
+                        os.path.getmtime('/tmp/test_folder/slow.done'))
+
+    def test_cancellation(self):
+        from popper.aio import AsyncActionScheduler
+
+        wf = self.get_workflow()
+        self.write_script('c.sh', 'exit 1\n')
+        start = time.time()
+        scheduler = AsyncActionScheduler('docker', wf, max_workers=4)
+        self.assertRaises(SystemExit, scheduler.run)
+        self.assertLess(time.time() - start, 1)
+
+        # The slow action is stopped when the other one fails.
+        time.sleep(1.5)
+        self.assertFalse(os.path.exists('/tmp/test_folder/slow.done'))
+        self.assertFalse(os.path.exists('/tmp/test_folder/end.done'))
+
+    def test_keep_going(self):
+        from popper.aio import AsyncActionScheduler
+
+        wf = self.get_workflow()
+        self.write_script('c.sh', 'exit 1\n')
+        scheduler = AsyncActionScheduler('docker', wf, max_workers=4,
+                                         keep_going=True)
+        self.assertRaises(SystemExit, scheduler.run)
+
+        # The slow action does not depend on the failed one.
+        self.assertTrue(os.path.exists('/tmp/test_folder/slow.done'))
+        self.assertFalse(os.path.exists('/tmp/test_folder/end.done'))
+        self.assertEqual(scheduler.failed, ['c'])
+
+    def test_timeout(self):
+        from popper.aio import AsyncActionScheduler
+
+        wf = self.get_workflow()
+        wf.runners['slow'].timeout = 0.2
+        scheduler = AsyncActionScheduler('docker', wf, max_workers=4,
+                                         keep_going=True)
+        self.assertRaises(SystemExit, scheduler.run)
+
+        # The other actions are not held up by the one that timed out.
+        self.assertEqual(scheduler.timed_out, ['slow'])
+        self.assertTrue(os.path.exists('/tmp/test_folder/c.done'))
+        self.assertFalse(os.path.exists('/tmp/test_folder/slow.done'))
+
+    def test_thread_fallback(self):
+        from popper.aio import AsyncActionScheduler
+
+        wf = self.get_workflow()
+        events = list()
+
+        class RecordingRunner(object):
+            def __init__(self, name):
+                self.name = name
+
+            def prepare(self, reuse=False):
+                pass
+
+            def execute(self, reuse=False):
+                events.append(self.name)
+
+        for a in wf.action:
+            wf.runners[a] = RecordingRunner(a)
+        AsyncActionScheduler('docker', wf, max_workers=1).run()
+        self.assertEqual(events[-1], 'end')
+        self.assertLess(events.index('b'), events.index('c'))
@@ -1,6 +1,9 @@
 import os
+import json
 import signal
 import shutil
+import time
+import threading
 import unittest
 try:
     from unittest.mock import patch
@@ -15,6 +18,14 @@ import vagrant
 from popper.cli import log
 from popper.parser import Workflow
 from popper.gha import (WorkflowRunner,
+                        get_resource_hints,
+                        get_timeout,
+                        execute_action,
+                        ActionDurations,
+                        ActionSamples,
+                        RunJournal,
+                        ResultCache,
+                        ActionScheduler,
                         ActionRunner,
                         DockerRunner,
                         SingularityRunner,
@@ -24,17 +35,73 @@ import popper.utils as pu
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
+class RecordingRunner(object):
+    """Runner that records when each of its phases starts and ends."""
+    runtime = 'host'
+
+    def __init__(self, name, events, delay=0, fail=False):
+        self.name = name
+        self.events = events
+        self.delay = delay
+        self.fail = fail
+
+    def prepare(self, reuse=False):
+        self.events.append(('prepare', self.name))
+
+    def execute(self, reuse=False):
+        self.events.append(('start', self.name))
+        time.sleep(self.delay)
+        if self.fail:
+            log.fail('Action failed.')
+        self.events.append(('end', self.name))
+
+    def stop(self, reuse=False):
+        self.events.append(('stop', self.name))
+
+
+class CountingRunner(object):
+    """Runner that counts the runners in each phase at the same time."""
+    lock = threading.Lock()
+    active = {'prepare': 0, 'execute': 0}
+    peak = {'prepare': 0, 'execute': 0}
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def track(self, phase, delay):
+        with self.lock:
+            self.active[phase] += 1
+            self.peak[phase] = max(
+                self.peak[phase], self.active[phase])
+        time.sleep(delay)
+        with self.lock:
+            self.active[phase] -= 1
+
+    def prepare(self, reuse=False):
+        self.track('prepare', 0.05)
+
+    def execute(self, reuse=False):
+        self.track('execute', 0.5)
+
+
 class TestWorkflowRunner(unittest.TestCase):
 
     def setUp(self):
         os.makedirs('/tmp/test_folder')
         os.chdir('/tmp/test_folder')
         log.setLevel('CRITICAL')
+        # Durations, journals and results are cached in the test folder.
+        self.cache_dir = os.environ.get('POPPER_CACHE_DIR')
+        os.environ['POPPER_CACHE_DIR'] = '/tmp/test_folder/cache'
 
     def tearDown(self):
         os.chdir('/tmp')
         shutil.rmtree('/tmp/test_folder')
         log.setLevel('NOTSET')
+        if self.cache_dir is None:
+            os.environ.pop('POPPER_CACHE_DIR', None)
+        else:
+            os.environ['POPPER_CACHE_DIR'] = self.cache_dir
 
     def test_check_secrets(self):
         os.environ['SECRET_ONE'] = '1234'
@@ -99,7 +166,7 @@ class TestWorkflowRunner(unittest.TestCase):
         env = WorkflowRunner.get_workflow_env(wf, '/tmp/test_folder')
         WorkflowRunner.instantiate_runners(
             'docker', wf, '/tmp/test_folder', False, False, '12345')
-        self.assertIsInstance(wf.action['a']['runner'], HostRunner)
+        self.assertIsInstance(wf.runners['a'], HostRunner)
 
         os.makedirs('/tmp/test_folder/actions/sample')
         pu.write_file('/tmp/test_folder/actions/sample/entrypoint.sh')
@@ -120,7 +187,7 @@ class TestWorkflowRunner(unittest.TestCase):
         env = WorkflowRunner.get_workflow_env(wf, '/tmp/test_folder')
         WorkflowRunner.instantiate_runners(
             'singularity', wf, '/tmp/test_folder', False, False, '12345')
-        self.assertIsInstance(wf.action['a']['runner'], HostRunner)
+        self.assertIsInstance(wf.runners['a'], HostRunner)
 
         pu.write_file('/tmp/test_folder/a.workflow', """
         workflow "sample" {
@@ -136,15 +203,15 @@ class TestWorkflowRunner(unittest.TestCase):
         env = WorkflowRunner.get_workflow_env(wf, '/tmp/test_folder')
         WorkflowRunner.instantiate_runners(
             'singularity', wf, '/tmp/test_folder', False, False, '12345')
-        self.assertIsInstance(wf.action['a']['runner'], SingularityRunner)
+        self.assertIsInstance(wf.runners['a'], SingularityRunner)
 
         WorkflowRunner.instantiate_runners(
             'docker', wf, '/tmp/test_folder', False, False, '12345')
-        self.assertIsInstance(wf.action['a']['runner'], DockerRunner)
+        self.assertIsInstance(wf.runners['a'], DockerRunner)
 
         WorkflowRunner.instantiate_runners(
             'vagrant', wf, '/tmp/test_folder', False, False, '12345')
-        self.assertIsInstance(wf.action['a']['runner'], VagrantRunner)
+        self.assertIsInstance(wf.runners['a'], VagrantRunner)
 
     def test_download_actions(self):
         pu.write_file('/tmp/test_folder/a.workflow', """
@@ -164,6 +231,7 @@ class TestWorkflowRunner(unittest.TestCase):
         wf.parse()
 
         # Download actions in the default cache directory.
+        os.environ.pop('POPPER_CACHE_DIR')
         WorkflowRunner.download_actions(wf, False, False, '12345')
         self.assertEqual(
             os.path.exists(
@@ -227,6 +295,507 @@ class TestWorkflowRunner(unittest.TestCase):
             'POPPER_SHA': 'unknown',
             'POPPER_REF': 'unknown'})
 
+    def create_scheduler_workflow(self, events):
+        """Returns a workflow with a slow branch, whose runners record
+        their events."""
+        pu.write_file('/tmp/test_folder/a.workflow', """
+        workflow "sample" {
+            resolves = "end"
+        }
+        action "slow" { uses = "sh" }
+        action "b" { uses = "sh" }
+        action "c" {
+            uses = "sh"
+            needs = "b"
+        }
+        action "end" {
+            uses = "sh"
+            needs = ["slow", "c"]
+        }
+        """)
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        for a in wf.action:
+            wf.runners[a] = RecordingRunner(
+                a, events, 0.5 if a == 'slow' else 0)
+        return wf
+
+    def create_counting_workflow(self, content):
+        """Returns a workflow whose runners count the actions running at
+        the same time."""
+        pu.write_file('/tmp/test_folder/a.workflow', content)
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        for a in wf.action:
+            wf.runners[a] = CountingRunner('docker')
+        CountingRunner.peak = {'prepare': 0, 'execute': 0}
+        return wf
+
+    def test_action_scheduler(self):
+        events = list()
+        wf = self.create_scheduler_workflow(events)
+        ActionScheduler('docker', wf, max_workers=2).run()
+
+        self.assertEqual(len(events), 12)
+        self.assertLess(events.index(('prepare', 'c')),
+                        events.index(('start', 'c')))
+        self.assertLess(events.index(('end', 'c')),
+                        events.index(('end', 'slow')))
+        self.assertLess(events.index(('end', 'b')),
+                        events.index(('start', 'c')))
+        self.assertEqual(events[-3:], [
+            ('prepare', 'end'), ('start', 'end'), ('end', 'end')])
+
+        del events[:]
+        ActionScheduler('docker', wf).run(['slow', 'c'])
+        self.assertEqual(len(events), 6)
+
+        # Without history, the longest chain of actions goes first.
+        wf.runners['slow'].delay = 0
+        scheduler = ActionScheduler('docker', wf, max_workers=1)
+        pending, waiting = scheduler.get_dependencies(list(wf.action))
+        self.assertDictEqual(scheduler.get_priorities(pending, waiting),
+                             {'slow': 2, 'b': 3, 'c': 2, 'end': 1})
+        del events[:]
+        scheduler.run()
+        self.assertEqual(events[0], ('prepare', 'b'))
+
+        durations = ActionDurations('12345')
+        durations.durations = {'slow': 10, 'b': 1, 'c': 1, 'end': 1}
+        scheduler = ActionScheduler('docker', wf, durations=durations,
+                                    max_workers=1)
+        self.assertDictEqual(scheduler.get_priorities(pending, waiting),
+                             {'slow': 11, 'b': 3, 'c': 2, 'end': 1})
+        del events[:]
+        scheduler.run()
+        self.assertEqual(events[0], ('prepare', 'slow'))
+        self.assertLess(durations.get('slow'), 10)
+
+    def test_action_scheduler_keep_going(self):
+        events = list()
+        wf = self.create_scheduler_workflow(events)
+        wf.runners['b'].fail = True
+        wf.runners['b'].delay = 0.2
+        scheduler = ActionScheduler('docker', wf, max_workers=2)
+        self.assertRaises(SystemExit, scheduler.run)
+        self.assertNotIn(('start', 'c'), events)
+        self.assertNotIn(('start', 'end'), events)
+        self.assertIn(('stop', 'slow'), events)
+
+        # With keep_going, the branch of the slow action is completed.
+        del events[:]
+        scheduler = ActionScheduler('docker', wf, max_workers=2,
+                                    keep_going=True)
+        self.assertRaises(SystemExit, scheduler.run)
+        self.assertIn(('end', 'slow'), events)
+        self.assertNotIn(('stop', 'slow'), events)
+        self.assertNotIn(('start', 'c'), events)
+        self.assertEqual(scheduler.failed, ['b'])
+        # The levels of b and of the actions that need it are not waited on.
+        self.assertEqual(scheduler.frontier, 3)
+
+    def test_action_scheduler_prefetch(self):
+        events = list()
+        wf = self.create_scheduler_workflow(events)
+        pending, waiting = ActionScheduler('docker', wf).get_dependencies(
+            list(wf.action))
+        self.assertDictEqual(
+            ActionScheduler.get_levels(pending, waiting),
+            {'slow': 0, 'b': 0, 'c': 1, 'end': 2})
+
+        # The image of the next level is prefetched while b executes.
+        wf.runners['slow'].delay = 0
+        wf.runners['b'].delay = 0.2
+        ActionScheduler('docker', wf, max_workers=1, max_pulls=2,
+                        lookahead=1).run()
+        self.assertLess(events.index(('prepare', 'c')),
+                        events.index(('end', 'b')))
+        self.assertLess(events.index(('end', 'b')),
+                        events.index(('start', 'c')))
+        self.assertEqual(
+            len([e for e in events if e[0] == 'prepare']), 4)
+
+        del events[:]
+        ActionScheduler('docker', wf, max_workers=1, max_pulls=2).run()
+        self.assertLess(events.index(('end', 'b')),
+                        events.index(('prepare', 'c')))
+
+    def test_action_scheduler_limits(self):
+        wf = self.create_counting_workflow("""
+        workflow "sample" {
+            resolves = ["a", "b", "c", "d"]
+        }
+        action "a" { uses = "sh" }
+        action "b" { uses = "sh" }
+        action "c" { uses = "sh" }
+        action "d" { uses = "sh" }
+        """)
+        ActionScheduler('docker', wf, max_workers=4, max_pulls=1).run()
+        self.assertDictEqual(CountingRunner.peak,
+                             {'prepare': 1, 'execute': 4})
+
+        CountingRunner.peak = {'prepare': 0, 'execute': 0}
+        ActionScheduler('docker', wf, max_workers=4, caps={'docker': 2},
+                        pull_caps={'host': 1}).run()
+        self.assertDictEqual(CountingRunner.peak,
+                             {'prepare': 4, 'execute': 2})
+
+        os.environ['POPPER_DOCKER_JOBS'] = '2'
+        os.environ['POPPER_SINGULARITY_PULL_JOBS'] = '3'
+        self.assertDictEqual(ActionScheduler.get_runtime_caps(),
+                             {'docker': 2})
+        self.assertDictEqual(ActionScheduler.get_runtime_caps(pull=True),
+                             {'singularity': 3})
+        os.environ['POPPER_DOCKER_JOBS'] = '0'
+        self.assertRaises(SystemExit, ActionScheduler.get_runtime_caps)
+        os.environ.pop('POPPER_DOCKER_JOBS')
+        os.environ.pop('POPPER_SINGULARITY_PULL_JOBS')
+
+        # Workflows running at the same time share the budget.
+        CountingRunner.peak = {'prepare': 0, 'execute': 0}
+        budget = threading.Semaphore(3)
+        threads = [threading.Thread(target=ActionScheduler(
+            'docker', wf, max_workers=4, budget=budget).run)
+            for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(CountingRunner.peak['execute'], 3)
+        self.assertTrue(budget.acquire(False))
+
+    def test_action_scheduler_resources(self):
+        wf = self.create_counting_workflow("""
+        workflow "sample" {
+            resolves = ["a", "b", "c", "d"]
+        }
+        action "a" {
+            uses = "sh"
+            env = { POPPER_MEMORY = "1g" }
+        }
+        action "b" {
+            uses = "sh"
+            env = { POPPER_MEMORY = "1g", POPPER_CPUS = "0.5" }
+        }
+        action "c" {
+            uses = "sh"
+            env = { POPPER_MEMORY = "1g" }
+        }
+        action "d" {
+            uses = "sh"
+            env = { POPPER_MEMORY = "1g", POPPER_CPUS = 2 }
+        }
+        """)
+        ActionScheduler('docker', wf, max_workers=4,
+                        capacity=(8, pu.parse_memory('2g'))).run()
+        self.assertEqual(CountingRunner.peak['execute'], 2)
+
+        CountingRunner.peak = {'prepare': 0, 'execute': 0}
+        ActionScheduler('docker', wf, max_workers=4,
+                        capacity=(2, pu.parse_memory('8g'))).run()
+        self.assertEqual(CountingRunner.peak['execute'], 3)
+
+    def test_prepare_images(self):
+        pu.write_file('/tmp/test_folder/a.workflow', """
+        workflow "sample" {
+            resolves = ["c", "d"]
+        }
+        action "a" { uses = "docker://alpine:3.9" }
+        action "b" { uses = "docker://alpine:3.9" }
+        action "c" {
+            uses = "docker://busybox"
+            needs = ["a", "b"]
+        }
+        action "d" { uses = "sh" }
+        """)
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        WorkflowRunner.instantiate_runners(
+            'singularity', wf, '/tmp/test_folder', False, False, '12345')
+
+        def setup_runners():
+            pulls = list()
+            for a in ['a', 'b', 'c']:
+                runner = wf.runners[a]
+                runner.prepared = False
+                runner.prepare = (lambda reuse, a=a: pulls.append(
+                    wf.action[a]['uses']))
+                runner.execute = lambda reuse: None
+            return pulls
+
+        pulls = setup_runners()
+        self.assertEqual(WorkflowRunner.prepare_images(wf, max_workers=2),
+                         (2, 1))
+        self.assertEqual(sorted(pulls),
+                         ['docker://alpine:3.9', 'docker://busybox'])
+        for a in ['a', 'b', 'c']:
+            self.assertTrue(wf.runners[a].prepared)
+        self.assertFalse(wf.runners['d'].prepared)
+
+        # The scheduler prepares a shared image once as well.
+        pulls = setup_runners()
+        ActionScheduler('docker', wf, max_workers=2).run()
+        self.assertEqual(sorted(pulls),
+                         ['docker://alpine:3.9', 'docker://busybox'])
+
+        pulls = setup_runners()
+        ActionScheduler('docker', wf, max_workers=2, lookahead=1).run()
+        self.assertEqual(len(pulls), 2)
+
+    def test_get_resource_hints(self):
+        action = {'name': 'a', 'env': {'POPPER_CPUS': '1.5',
+                                       'POPPER_MEMORY': '512m'}}
+        self.assertEqual(get_resource_hints(action), (1.5, 512 * 1024 ** 2))
+        self.assertEqual(get_resource_hints({'name': 'a'}), (None, None))
+        self.assertRaises(SystemExit, get_resource_hints,
+                          {'name': 'a', 'env': {'POPPER_CPUS': 'many'}})
+        self.assertRaises(SystemExit, get_resource_hints,
+                          {'name': 'a', 'env': {'POPPER_CPUS': 0}})
+        self.assertRaises(SystemExit, get_resource_hints,
+                          {'name': 'a', 'env': {'POPPER_MEMORY': '1x'}})
+
+    def test_get_timeout(self):
+        action = {'name': 'a', 'env': {'POPPER_TIMEOUT': '2m'}}
+        self.assertEqual(get_timeout(action, 10), 120)
+        self.assertEqual(get_timeout({'name': 'a'}, 10), 10)
+        self.assertIsNone(get_timeout({'name': 'a'}))
+        self.assertIsNone(get_timeout(
+            {'name': 'a', 'env': {'POPPER_TIMEOUT': '0'}}, 10))
+        self.assertRaises(SystemExit, get_timeout,
+                          {'name': 'a', 'env': {'POPPER_TIMEOUT': 'soon'}})
+
+    def test_action_durations(self):
+        durations = ActionDurations('12345')
+        self.assertIsNone(durations.get('a'))
+        self.assertEqual(durations.estimate('a'), 1.0)
+        durations.record('a', 2.0)
+        durations.record('a', 4.0)
+        durations.record('b', 5.0)
+        self.assertEqual(durations.get('a'), 3.0)
+        self.assertEqual(durations.estimate('c'), 4.0)
+        durations.save()
+
+        durations = ActionDurations('12345')
+        self.assertDictEqual(durations.durations, {'a': 3.0, 'b': 5.0})
+
+    def test_action_samples(self):
+        samples = ActionSamples()
+        for i, seconds in enumerate([4.0, 1.0, 3.0, 2.0]):
+            samples.iteration = i
+            samples.record('a', seconds)
+        samples.record('a', 9.0, 1)
+        samples.record('b', 1.0, 124)
+        stats = samples.get_stats()
+        self.assertEqual(stats['a']['runs'], 5)
+        self.assertEqual(stats['a']['failures'], 1)
+        self.assertEqual(stats['a']['mean'], 2.5)
+        self.assertEqual(stats['a']['median'], 2.5)
+        self.assertAlmostEqual(stats['a']['stddev'], (5 / 3.0) ** 0.5)
+        self.assertAlmostEqual(stats['a']['p90'], 3.7)
+        self.assertEqual(stats['a']['max'], 4.0)
+        self.assertDictEqual(stats['b'], {'runs': 1, 'failures': 1})
+
+        samples.save('/tmp/test_folder/samples.csv')
+        with open('/tmp/test_folder/samples.csv') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], 'iteration,action,seconds,exit_code')
+        self.assertEqual(lines[-1], '3,b,1.0,124')
+        samples.save('/tmp/test_folder/samples.json')
+        with open('/tmp/test_folder/samples.json') as f:
+            self.assertEqual(len(json.load(f)['samples']), 6)
+
+    def test_repeat(self):
+        pu.write_file('/tmp/test_folder/a.sh', 'echo a >> log')
+        os.chmod('/tmp/test_folder/a.sh', 0o755)
+        pu.write_file('/tmp/test_folder/a.workflow', """
+        workflow "sample" {
+            resolves = "b"
+        }
+        action "a" {
+            uses = "sh"
+            runs = "a.sh"
+        }
+        action "b" {
+            uses = "sh"
+            runs = "a.sh"
+            needs = "a"
+        }
+        """)
+        for parallel in [False, True]:
+            pu.write_file('/tmp/test_folder/log')
+            runner = WorkflowRunner(Workflow('/tmp/test_folder/a.workflow'))
+            runner.run(None, True, True, list(), '/tmp/test_folder',
+                       False, False, parallel, False, 'docker', repeat=3,
+                       warmup=1, samples_file='/tmp/test_folder/s.json')
+            with open('/tmp/test_folder/log') as f:
+                self.assertEqual(len(f.read().split()), 8)
+            with open('/tmp/test_folder/s.json') as f:
+                result = json.load(f)
+            self.assertEqual([s['iteration'] for s in result['samples']],
+                             [0, 0, 1, 1, 2, 2])
+            self.assertEqual(result['stats']['b']['runs'], 3)
+
+        # Conflicting options fail before anything is run.
+        pu.write_file('/tmp/test_folder/log')
+        self.assertRaises(SystemExit, runner.run, None, True, True, list(),
+                          '/tmp/test_folder', False, False, False, False,
+                          'docker', repeat=2, cache_results=True)
+        with open('/tmp/test_folder/log') as f:
+            self.assertEqual(f.read(), '')
+
+    def test_run_journal(self):
+        for name, content in [('a.sh', 'echo a >> log'),
+                              ('b.sh', 'test ! -f fail && echo b >> log'),
+                              ('c.sh', 'echo c >> log')]:
+            pu.write_file('/tmp/test_folder/' + name, content)
+            os.chmod('/tmp/test_folder/' + name, 0o755)
+        workflow = """
+        workflow "sample" {
+            resolves = ["b", "c"]
+        }
+        action "a" {
+            uses = "sh"
+            runs = "a.sh"
+            env = { VERSION = "%s" }
+        }
+        action "b" {
+            uses = "sh"
+            runs = "b.sh"
+            needs = "a"
+        }
+        action "c" {
+            uses = "sh"
+            runs = "c.sh"
+        }
+        """
+
+        def run(version='1', resume=True):
+            pu.write_file('/tmp/test_folder/a.workflow', workflow % version)
+            pu.write_file('/tmp/test_folder/log')
+            runner = WorkflowRunner(Workflow('/tmp/test_folder/a.workflow'))
+            runner.run(None, True, True, list(), '/tmp/test_folder',
+                       False, False, False, False, 'docker', resume=resume)
+            with open('/tmp/test_folder/log') as f:
+                return sorted(f.read().split())
+
+        pu.write_file('/tmp/test_folder/a.workflow', workflow % '1')
+        runner = WorkflowRunner(Workflow('/tmp/test_folder/a.workflow'))
+        path = RunJournal(runner.wid, 'unknown').path
+
+        pu.write_file('/tmp/test_folder/fail')
+        self.assertRaises(SystemExit, run)
+        with open(path) as f:
+            entries = json.load(f)
+        self.assertEqual(entries['a']['exit_code'], 0)
+        self.assertEqual(entries['b']['exit_code'], 1)
+
+        # Only the action that failed is run again.
+        os.remove('/tmp/test_folder/fail')
+        self.assertEqual(run(), ['b'])
+        self.assertEqual(run(), [])
+
+        # Actions that need a changed one are run again.
+        self.assertEqual(run(version='2'), ['a', 'b'])
+        self.assertEqual(run(resume=False), ['a', 'b', 'c'])
+
+    def test_result_cache(self):
+        for name, content in [
+                ('gen.sh', 'echo gen >> log && mkdir -p out && '
+                           'cp in.txt out/data'),
+                ('use.sh', 'echo use >> log && cat out/data > result')]:
+            pu.write_file('/tmp/test_folder/' + name, content)
+            os.chmod('/tmp/test_folder/' + name, 0o755)
+        pu.write_file('/tmp/test_folder/a.workflow', """
+        workflow "sample" {
+            resolves = "use"
+        }
+        action "gen" {
+            uses = "sh"
+            runs = "gen.sh"
+            env = { POPPER_INPUTS = "in.txt", POPPER_OUTPUTS = "out" }
+        }
+        action "use" {
+            uses = "sh"
+            runs = "use.sh"
+            needs = "gen"
+            env = { POPPER_OUTPUTS = "result" }
+        }
+        """)
+
+        def run(parallel=False):
+            pu.write_file('/tmp/test_folder/log')
+            runner = WorkflowRunner(Workflow('/tmp/test_folder/a.workflow'))
+            runner.run(None, True, True, list(), '/tmp/test_folder',
+                       False, False, parallel, False, 'docker',
+                       cache_results=True)
+            with open('/tmp/test_folder/log') as f:
+                return f.read().split()
+
+        pu.write_file('/tmp/test_folder/in.txt', 'one')
+        self.assertEqual(run(), ['gen', 'use'])
+
+        # Outputs are restored without running the actions.
+        shutil.rmtree('/tmp/test_folder/out')
+        os.remove('/tmp/test_folder/result')
+        self.assertEqual(run(), [])
+        self.assertEqual(run(parallel=True), [])
+        with open('/tmp/test_folder/result') as f:
+            self.assertEqual(f.read(), 'one')
+
+        # A changed input invalidates the actions that depend on it.
+        pu.write_file('/tmp/test_folder/in.txt', 'two')
+        self.assertEqual(run(parallel=True), ['gen', 'use'])
+        with open('/tmp/test_folder/result') as f:
+            self.assertEqual(f.read(), 'two')
+
+        entries = ResultCache.get_entries()
+        self.assertEqual(len(entries), 4)
+        self.assertEqual(entries[-1]['action'], 'use')
+
+        # Keys do not depend on whether the needed actions were run.
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        WorkflowRunner.instantiate_runners(
+            'docker', wf, '/tmp/test_folder', False, False, '12345')
+        results = ResultCache(wf, '/tmp/test_folder')
+        results.get_key('gen')
+        resumed = ResultCache(wf, '/tmp/test_folder')
+        self.assertEqual(resumed.get_key('use'), results.get_key('use'))
+        self.assertEqual(resumed.keys['gen'], results.keys['gen'])
+
+    def test_result_cache_files(self):
+        pu.write_file('/tmp/test_folder/gen.sh',
+                      'echo gen >> log && echo a > a.txt && echo b > b.txt')
+        os.chmod('/tmp/test_folder/gen.sh', 0o755)
+        pu.write_file('/tmp/test_folder/a.workflow', """
+        workflow "sample" {
+            resolves = "gen"
+        }
+        action "gen" {
+            uses = "sh"
+            runs = "gen.sh"
+            env = { POPPER_OUTPUTS = "a.txt,b.txt" }
+        }
+        """)
+
+        def run():
+            pu.write_file('/tmp/test_folder/log')
+            runner = WorkflowRunner(Workflow('/tmp/test_folder/a.workflow'))
+            runner.run(None, True, True, list(), '/tmp/test_folder',
+                       False, False, False, False, 'docker',
+                       cache_results=True)
+            with open('/tmp/test_folder/log') as f:
+                return f.read().split()
+
+        self.assertEqual(run(), ['gen'])
+
+        # Files that share a directory are stored in the same entry.
+        os.remove('/tmp/test_folder/a.txt')
+        os.remove('/tmp/test_folder/b.txt')
+        self.assertEqual(run(), [])
+        with open('/tmp/test_folder/b.txt') as f:
+            self.assertEqual(f.read(), 'b\n')
+
 
 class TestActionRunner(unittest.TestCase):
 
@@ -249,7 +818,7 @@ class TestActionRunner(unittest.TestCase):
         self.wf.parse()
         WorkflowRunner.instantiate_runners(
             'docker', self.wf, '/tmp/test_folder', False, False, '12345')
-        self.runner = self.wf.action['sample action']['runner']
+        self.runner = self.wf.runners['sample action']
 
     def tearDown(self):
         os.chdir('/tmp')
@@ -358,7 +927,7 @@ class TestDockerRunner(unittest.TestCase):
         WorkflowRunner.instantiate_runners(
             'docker', self.wf, '/tmp/test_folder', False, False, '12345')
         self.docker_client = docker.from_env()
-        self.runner = self.wf.action['sample action']['runner']
+        self.runner = self.wf.runners['sample action']
 
     def tearDown(self):
         os.chdir('/tmp')
@@ -463,6 +1032,17 @@ class TestDockerRunner(unittest.TestCase):
         self.runner.docker_build('abcd:latest', '/tmp/test_folder')
         res = self.docker_client.images.get('abcd:latest')
 
+    @unittest.skipIf(
+        os.environ['RUNTIME'] != 'docker',
+        'Skipping docker tests...')
+    def test_get_container_limits(self):
+        self.assertDictEqual(self.runner.get_container_limits(), {})
+        self.runner.action['env'] = {'POPPER_CPUS': '0.5',
+                                     'POPPER_MEMORY': '1g'}
+        self.assertDictEqual(self.runner.get_container_limits(), {
+            'nano_cpus': 500000000, 'mem_limit': 1024 ** 3})
+        self.runner.action.pop('env')
+
     @unittest.skipIf(
         os.environ['RUNTIME'] != 'docker',
         'Skipping docker tests...')
@@ -496,7 +1076,7 @@ class TestSingularityRunner(unittest.TestCase):
         WorkflowRunner.download_actions(self.wf, False, False, '12345')
         WorkflowRunner.instantiate_runners(
             'singularity', self.wf, '/tmp/test_folder', False, False, '12345')
-        self.runner = self.wf.action['sample action']['runner']
+        self.runner = self.wf.runners['sample action']
         SingularityRunner.setup_singularity_cache('12345')
 
     def tearDown(self):
@@ -675,7 +1255,7 @@ class TestVagrantRunner(unittest.TestCase):
         WorkflowRunner.download_actions(self.wf, False, False, '12345')
         WorkflowRunner.instantiate_runners(
             'vagrant', self.wf, '/tmp/test_folder', False, False, '12345')
-        self.runner = self.wf.action['sample action']['runner']
+        self.runner = self.wf.runners['sample action']
         VagrantRunner.setup_vagrant_cache('12345')
 
     def tearDown(self):
@@ -779,6 +1359,20 @@ class TestVagrantRunner(unittest.TestCase):
         for line in content:
             self.assertEqual(line in required_content, True)
 
+    @unittest.skipIf(
+        os.environ['RUNTIME'] != 'vagrant',
+        'Skipping vagrant tests...')
+    def test_vagrant_repeat(self):
+        # The VM keeps running until the last execution of the actions.
+        self.runner.executions = 2
+        self.runner.prepare()
+        self.runner.execute()
+        self.assertTrue(VagrantRunner.running)
+        self.assertTrue(self.runner.vagrant_exists(VagrantRunner.vbox_path))
+        self.runner.execute()
+        self.assertFalse(VagrantRunner.running)
+        self.assertFalse(self.runner.vagrant_exists(VagrantRunner.vbox_path))
+
 
 class TestHostRunner(unittest.TestCase):
 
@@ -808,12 +1402,12 @@ class TestHostRunner(unittest.TestCase):
         log.setLevel('NOTSET')
 
     def test_run(self):
-        runner = self.wf.action['sample action']['runner']
+        runner = self.wf.runners['sample action']
         self.assertRaises(SystemExit, runner.run, reuse=True)
         runner.run()
 
     def test_host_prepare(self):
-        runner = self.wf.action['sample action']['runner']
+        runner = self.wf.runners['sample action']
         runner.action['runs'] = ['script1']
         runner.action['args'] = ['github.com']
         cmd = runner.host_prepare()
@@ -835,7 +1429,7 @@ class TestHostRunner(unittest.TestCase):
                 'arg1', 'arg2'])
 
     def test_host_start(self):
-        runner = self.wf.action['sample action']['runner']
+        runner = self.wf.runners['sample action']
         runner.prepare_environment(set_env=True)
         e = runner.host_start([
             "sh", "-c", "echo 'Hello from Popper 2.x !' > popper.file"
@@ -844,6 +1438,27 @@ class TestHostRunner(unittest.TestCase):
         self.assertEqual(os.path.exists('popper.file'), True)
         runner.remove_environment()
 
+    def test_stop(self):
+        runner = self.wf.runners['sample action']
+        runner.stop()
+        runner.host_start(['sh', '-c', 'sleep 0.1'])
+        start = time.time()
+        threading.Timer(0.2, runner.stop).start()
+        e = runner.host_start(['sh', '-c', 'sleep 5'])
+        self.assertNotEqual(e, 0)
+        self.assertLess(time.time() - start, 5)
+        self.assertRaises(SystemExit, runner.handle_exit, e)
+
+    def test_timeout(self):
+        runner = self.wf.runners['sample action']
+        runner.action['args'] = ['sleep', '5']
+        runner.timeout = 0.2
+        start = time.time()
+        with self.assertRaises(SystemExit) as e:
+            execute_action(runner)
+        self.assertEqual(e.exception.code, 124)
+        self.assertLess(time.time() - start, 5)
+
 
 class TestConcurrentExecution(unittest.TestCase):
 
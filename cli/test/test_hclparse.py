@@ -0,0 +1,100 @@
+import ast
+import os
+import unittest
+
+import hcl
+
+from popper import hclparse
+from popper.cli import log
+
+
+def workflow_corpus():
+    """Returns the workflow files that are written by the parser and runner
+    test suites."""
+    corpus = list()
+    test_dir = os.path.dirname(os.path.abspath(__file__))
+    for test_file in ['test_parser.py', 'test_gha.py']:
+        with open(os.path.join(test_dir, test_file)) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Call):
+                continue
+            name = getattr(node.func, 'attr', getattr(node.func, 'id', None))
+            if name not in ('create_workflow_file', 'write_file'):
+                continue
+            for arg in node.args:
+                value = getattr(arg, 'value', getattr(arg, 's', None))
+                if isinstance(value, str) and 'workflow "' in value:
+                    corpus.append(value)
+    return corpus
+
+
+class TestHclParse(unittest.TestCase):
+
+    def setUp(self):
+        log.setLevel('CRITICAL')
+
+    def tearDown(self):
+        log.setLevel('NOTSET')
+
+    def test_corpus(self):
+        corpus = workflow_corpus()
+        self.assertGreater(len(corpus), 20)
+        for content in corpus:
+            parsed, _ = hclparse.parse(content)
+            self.assertEqual(parsed, hcl.loads(content))
+
+    def test_parse(self):
+        content = """
+        # A comment.
+        workflow "w" {
+            resolves = ["a", "b",]
+            // Another comment.
+            on = "push"
+        }
+
+        /* A multi-line
+           comment. */
+        action "a" {
+            uses = "docker://alpine:3.9"
+            args = ["sh", "-c", "echo \\"${HOME}\\""]
+            env = {
+                A = "1", B = 2
+                "C D" = { E = true, F = 1.5 }
+            }
+        }
+
+        action
+          "b" { uses = "sh", needs = "a" }
+
+        action "a" { runs = "ls" }
+        """
+        parsed, declarations = hclparse.parse(content)
+        self.assertEqual(parsed, hcl.loads(content))
+        self.assertEqual(parsed['action']['a']['args'],
+                         ['sh', '-c', 'echo "${HOME}"'])
+        self.assertListEqual(declarations, [('a', 11), ('b', 20), ('a', 23)])
+
+    def test_unsupported(self):
+        for content in [
+            'action "a" { uses = "x"\n uses = "y" }',
+            'action "a" { uses = <<EOF\nsh\nEOF\n }',
+            'action "a" { uses = 0x10 }',
+            'action "a" "b" { uses = "x" }',
+            'action "a" { uses = "a\\tb" }',
+            'action "a" { uses = "a\\\\b" }',
+        ]:
+            self.assertRaises(hclparse.HCLParseError, hclparse.parse, content)
+            parsed, declarations = hclparse.loads(content)
+            self.assertEqual(parsed, hcl.loads(content))
+            self.assertEqual(declarations, [('a', 1)])
+
+    def test_invalid(self):
+        for content in [
+            'workflow "w" {',
+            'workflow "w" { resolves = }',
+            'workflow "w" { resolves = ["a" "b"] }',
+            'workflow { resolves = "a" }',
+            'action "a" { uses = "sh" } action = "b"',
+        ]:
+            self.assertRaises(hclparse.HCLParseError, hclparse.parse, content)
@@ -1,8 +1,9 @@
 import unittest
 import os
 import shutil
+import pickle
 
-from popper.parser import Workflow
+from popper.parser import Action, Workflow, WorkflowView
 from popper.cli import log
 
 
@@ -12,11 +13,18 @@ class TestParser(unittest.TestCase):
         os.makedirs('/tmp/test_folder')
         os.chdir('/tmp/test_folder')
         log.setLevel('CRITICAL')
+        # Compiled workflows are cached in the test folder.
+        self.cache_dir = os.environ.get('POPPER_CACHE_DIR')
+        os.environ['POPPER_CACHE_DIR'] = '/tmp/test_folder/cache'
 
     def tearDown(self):
         os.chdir('/tmp')
         shutil.rmtree('/tmp/test_folder')
         log.setLevel('NOTSET')
+        if self.cache_dir is None:
+            os.environ.pop('POPPER_CACHE_DIR')
+        else:
+            os.environ['POPPER_CACHE_DIR'] = self.cache_dir
 
     def create_workflow_file(self, content):
         f = open('/tmp/test_folder/a.workflow', 'w')
@@ -42,6 +50,31 @@ class TestParser(unittest.TestCase):
         workflow.resolves = ["a1", "a2"]
         self.assertRaises(SystemExit, workflow.check_for_empty_workflow)
 
+    def test_action(self):
+        a = Action(3, 'a', {'uses': 'sh', 'args': ['ls']})
+        self.assertEqual(a.id, 3)
+        self.assertEqual(a['name'], 'a')
+        self.assertEqual(a, {'uses': 'sh', 'args': ['ls'], 'name': 'a'})
+        self.assertNotEqual(a, {'uses': 'sh', 'name': 'a'})
+        self.assertIn('args', a)
+        self.assertNotIn('next', a)
+        self.assertEqual(a.get('next', None), None)
+        self.assertRaises(KeyError, a.__getitem__, 'next')
+        self.assertRaises(KeyError, a.__setitem__, 'on', 'push')
+
+        a.setdefault('next', set()).add('b')
+        self.assertSetEqual(a['next'], {'b'})
+        self.assertEqual(sorted(a.keys()), ['args', 'name', 'next', 'uses'])
+
+        b = a.copy()
+        b.pop('args')
+        self.assertIn('args', a)
+        self.assertIs(b['next'], a['next'])
+
+        c = pickle.loads(pickle.dumps(a))
+        self.assertEqual(c.id, 3)
+        self.assertEqual(c, a)
+
     def test_format_command(self):
         cmd = u"docker version"
         res = Workflow.format_command(cmd)
@@ -89,6 +122,31 @@ class TestParser(unittest.TestCase):
         workflow = Workflow('/tmp/test_folder/a.workflow')
         workflow.check_duplicate_actions()
 
+        self.create_workflow_file("""
+        workflow "sample" {
+            resolves = ["a", "b"]
+        }
+
+        action "a" {
+            uses = "sh"
+            env = {
+                action = "b"
+            }
+        }
+
+        action
+            "b" {
+            uses = "sh"
+        }
+
+        # action "b" {}
+        action "b" { uses = "sh" }
+        """)
+        workflow = Workflow('/tmp/test_folder/a.workflow')
+        self.assertRaises(SystemExit, workflow.check_duplicate_actions)
+        self.assertListEqual(workflow.action_declarations,
+                             [('a', 6), ('b', 13), ('b', 19)])
+
     def test_validate_workflow_block(self):
         self.create_workflow_file("""
         workflow "sample workflow 1" {
@@ -252,6 +310,92 @@ class TestParser(unittest.TestCase):
         wf = Workflow('/tmp/test_folder/a.workflow')
         self.assertRaises(SystemExit, wf.validate_action_blocks)
 
+    def test_lazy_validation(self):
+        self.create_workflow_file("""
+        workflow "sample workflow" {
+            resolves = ["c", "d"]
+        }
+        action "a" { uses = "sh" }
+        action "b" {
+            uses = "sh"
+            needs = "a"
+        }
+        action "c" {
+            uses = "sh"
+            needs = "b"
+        }
+        action "d" {
+            uses = "sh"
+            needs = "a"
+            runs = { A = 1 }
+        }
+        action "e" {
+            args = "ls"
+        }
+        """)
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        self.assertSetEqual(wf.get_action_scope(['c']), {'a', 'b', 'c'})
+        self.assertSetEqual(wf.get_action_scope(['d', 'x']), {'a', 'd'})
+        self.assertRaises(SystemExit, wf.parse)
+
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        self.assertRaises(SystemExit, wf.parse, True)
+
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse(True, ['c'])
+        self.assertSetEqual(set(wf.action), {'a', 'b', 'c'})
+        self.assertListEqual(wf.resolves, ['c'])
+        self.assertSetEqual(wf.root, {'a'})
+        self.assertListEqual(wf.action['c']['needs'], ['b'])
+        self.assertFalse(os.path.exists(wf.get_cache_file()))
+
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse(True, ['b'], ['c'])
+        self.assertSetEqual(set(wf.action), {'a', 'b', 'c'})
+        self.assertListEqual(wf.resolves, ['b'])
+
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        self.assertRaises(SystemExit, wf.parse, True, ['e'])
+
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        self.assertRaises(SystemExit, wf.parse, True, ['x'])
+
+    def test_lazy_validation_cached(self):
+        self.create_workflow_file("""
+        workflow "sample workflow" {
+            resolves = ["c", "d"]
+        }
+        action "a" { uses = "sh" }
+        action "b" {
+            uses = "sh"
+            needs = "a"
+            env = { POPPER_MATRIX_N = "1,2" }
+        }
+        action "c" {
+            uses = "sh"
+            needs = "b"
+        }
+        action "d" {
+            uses = "sh"
+            needs = "a"
+        }
+        """)
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        self.assertTrue(os.path.exists(wf.get_cache_file()))
+
+        # The targets are checked and selected on a cache hit too.
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        self.assertRaises(SystemExit, wf.parse, True, ['x'])
+
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse(True, ['b'], ['d'])
+        self.assertSetEqual(set(wf.action), {'a', 'b[N=1]', 'b[N=2]', 'd'})
+        self.assertListEqual(wf.resolves, ['b[N=1]', 'b[N=2]'])
+        self.assertSetEqual(wf.root, {'a'})
+        self.assertSetEqual(wf.action['a']['next'], {'b[N=1]', 'b[N=2]'})
+        self.assertNotIn('next', wf.action['b[N=1]'])
+
     def test_normalize(self):
         self.create_workflow_file("""
         workflow "sample workflow" {
@@ -277,6 +421,171 @@ class TestParser(unittest.TestCase):
         self.assertEqual(action_a['args'], ['npm', '--version'])
         self.assertEqual(action_a['secrets'], ['SECRET_KEY'])
 
+    def test_expand_matrices(self):
+        self.create_workflow_file("""
+        workflow "sample workflow" {
+            resolves = "plot"
+        }
+
+        action "build" {
+            uses = "sh"
+            args = "make"
+        }
+
+        action "run" {
+            needs = "build"
+            uses = "sh"
+            args = "run.sh"
+            env = {
+                POPPER_MATRIX_SIZE = "1, 10"
+                POPPER_MATRIX_MODE = "a,b"
+                OTHER = "x"
+            }
+        }
+
+        action "plot" {
+            needs = "run"
+            uses = "sh"
+            args = "plot.sh"
+        }
+        """)
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        expansions = ['run[MODE=a,SIZE=1]', 'run[MODE=a,SIZE=10]',
+                      'run[MODE=b,SIZE=1]', 'run[MODE=b,SIZE=10]']
+        self.assertListEqual(sorted(wf.action),
+                             sorted(['build', 'plot'] + expansions))
+        self.assertListEqual(wf.action['plot']['needs'], expansions)
+        self.assertSetEqual(wf.action['build']['next'], set(expansions))
+        self.assertDictEqual(wf.action['run[MODE=b,SIZE=1]']['env'],
+                             {'MODE': 'b', 'SIZE': '1', 'OTHER': 'x'})
+        self.assertListEqual(wf.action['run[MODE=b,SIZE=1]']['needs'],
+                             ['build'])
+        self.assertEqual(len(set(a.id for a in wf.action.values())), 6)
+        self.assertListEqual(list(wf.get_stages()),
+                             [{'build'}, set(expansions), {'plot'}])
+
+        # Empty values are rejected.
+        self.create_workflow_file("""
+        workflow "sample workflow" {
+            resolves = "run"
+        }
+
+        action "run" {
+            uses = "sh"
+            env = { POPPER_MATRIX_SIZE = "1,,2" }
+        }
+        """)
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        self.assertRaises(SystemExit, wf.parse)
+
+    def test_select_matrix_action(self):
+        self.create_workflow_file("""
+        workflow "sample workflow" {
+            resolves = "plot"
+        }
+
+        action "build" {
+            uses = "sh"
+            args = "make"
+        }
+
+        action "run" {
+            needs = "build"
+            uses = "sh"
+            args = "run.sh"
+            env = { POPPER_MATRIX_SIZE = "1,2" }
+        }
+
+        action "plot" {
+            needs = "run"
+            uses = "sh"
+            args = "plot.sh"
+        }
+        """)
+        expansions = ['run[SIZE=1]', 'run[SIZE=2]']
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        self.assertDictEqual(wf.expansions, {'run': expansions})
+
+        # The expansions are also known when loading from the cache.
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        self.assertDictEqual(wf.expansions, {'run': expansions})
+
+        view = Workflow.filter_action(wf, 'run')
+        self.assertSetEqual(set(view.action), set(expansions))
+        self.assertSetEqual(view.root, set(expansions))
+
+        view = Workflow.filter_action(wf, 'run', with_dependencies=True)
+        self.assertSetEqual(set(view.action), set(['build'] + expansions))
+        self.assertSetEqual(view.root, {'build'})
+
+        view = Workflow.skip_actions(wf, ['run'])
+        self.assertListEqual(view.props['skip_list'], expansions)
+        self.assertListEqual(view.action['plot']['needs'], list())
+        self.assertSetEqual(view.action['build'].get('next', set()), set())
+
+    def test_coalesce_actions(self):
+        self.create_workflow_file("""
+        workflow "sample workflow" {
+            resolves = ["d1", "d2", "e"]
+        }
+
+        action "a1" {
+            uses = "sh"
+            args = "ls"
+        }
+
+        action "a2" {
+            uses = "sh"
+            args = "ls"
+        }
+
+        action "b" {
+            uses = "sh"
+            args = "ls -l"
+        }
+
+        action "d1" {
+            needs = ["a1", "b"]
+            uses = "sh"
+            args = "make"
+        }
+
+        action "d2" {
+            needs = ["b", "a2"]
+            uses = "sh"
+            args = "make"
+        }
+
+        action "e" {
+            needs = "a2"
+            uses = "sh"
+            args = "make"
+            env = { X = "1" }
+        }
+        """)
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        self.assertDictEqual(wf.get_identical_actions(),
+                             {'a1': ['a2'], 'd1': ['d2']})
+
+        view = Workflow.coalesce_actions(wf)
+        self.assertSetEqual(set(view.action), {'a1', 'b', 'd1', 'e'})
+        self.assertSetEqual(view.root, {'a1', 'b'})
+        self.assertEqual(view.action['e']['needs'], ['a1'])
+        self.assertSetEqual(view.action['a1']['next'], {'d1', 'e'})
+        self.assertSetEqual(view.action['b']['next'], {'d1'})
+        self.assertDictEqual(view.props['coalesced'],
+                             {'a2': 'a1', 'd2': 'd1'})
+        self.assertListEqual(list(view.get_stages()),
+                             [{'a1', 'b'}, {'d1', 'e'}])
+
+        # The workflow is left untouched.
+        self.assertEqual(wf.action['e']['needs'], ['a2'])
+        self.assertEqual(len(wf.action), 6)
+
     def test_complete_graph(self):
         self.create_workflow_file("""
         workflow "example" {
@@ -582,6 +891,99 @@ class TestParser(unittest.TestCase):
                     'name': 'd',
                     'next': set()}})
 
+    def test_workflow_view(self):
+        self.create_workflow_file("""
+        workflow "example" {
+            resolves = "c"
+        }
+
+        action "a" {
+            uses = "sh"
+        }
+
+        action "b" {
+            needs = "a"
+            uses = "sh"
+        }
+
+        action "c" {
+            needs = "b"
+            uses = "sh"
+        }
+        """)
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        view = WorkflowView(wf)
+        self.assertIs(view.action['a'], wf.action['a'])
+
+        view.edit_action('a')['next'].clear()
+        view.root.clear()
+        self.assertIsNot(view.action['a'], wf.action['a'])
+        self.assertIs(view.action['b'], wf.action['b'])
+        self.assertSetEqual(wf.action['a']['next'], {'b'})
+        self.assertSetEqual(wf.root, {'a'})
+        self.assertEqual(list(view.get_stages()), [])
+        self.assertEqual(list(wf.get_stages()), [{'a'}, {'b'}, {'c'}])
+
+        changed_wf = Workflow.skip_actions(view, ['c'])
+        self.assertIs(changed_wf.base, wf)
+        self.assertIs(changed_wf.action['a'], view.action['a'])
+        self.assertListEqual(changed_wf.action['c']['needs'], [])
+        self.assertListEqual(wf.action['c']['needs'], ['b'])
+
+        changed_wf = Workflow.filter_action(wf, 'b')
+        self.assertListEqual(list(changed_wf.action), ['b'])
+        self.assertSetEqual(wf.action['b']['next'], {'c'})
+
+    def test_reachability_index(self):
+        self.create_workflow_file("""
+        workflow "example" {
+            resolves = ["e"]
+        }
+        action "a" { uses = "sh" }
+        action "b" { uses = "sh" }
+        action "c" {
+            uses = "sh"
+            needs = ["a", "b"]
+        }
+        action "d" {
+            uses = "sh"
+            needs = ["c"]
+        }
+        action "e" {
+            uses = "sh"
+            needs = ["c"]
+        }
+        action "f" {
+            uses = "sh"
+            needs = ["a"]
+        }
+        """)
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        index = wf.get_index()
+        self.assertIs(wf.get_index(), index)
+        self.assertIs(WorkflowView(wf).get_index(), index)
+        self.assertTrue(index.is_acyclic())
+
+        order = index.get_topological_order()
+        self.assertSetEqual(set(order), {'a', 'b', 'c', 'd', 'e', 'f'})
+        for a_name in order:
+            for n in wf.action[a_name].get('needs', []):
+                self.assertLess(order.index(n), order.index(a_name))
+
+        self.assertSetEqual(index.get_ancestors(['e']), {'a', 'b', 'c'})
+        self.assertSetEqual(index.get_ancestors(['a', 'b']), set())
+        self.assertSetEqual(index.get_descendants(['a']), {'c', 'd', 'e', 'f'})
+        self.assertSetEqual(index.get_descendants(['c', 'b']), {'c', 'd', 'e'})
+        self.assertSetEqual(index.get_unreachable(['e']), {'d', 'f'})
+
+        changed_wf = Workflow.filter_action(wf, 'e', with_dependencies=True)
+        self.assertSetEqual(set(changed_wf.action), {'a', 'b', 'c', 'e'})
+
+        wf.check_for_unreachable_actions()
+        self.assertSetEqual(set(wf.action), {'a', 'b', 'c', 'e'})
+
     def test_check_for_unreachable_actions(self):
         self.create_workflow_file("""
         workflow "example" {
@@ -682,6 +1084,116 @@ class TestParser(unittest.TestCase):
         wf.parse()
         wf.check_for_unreachable_actions()
 
+    def test_workflow_cache(self):
+        self.create_workflow_file("""
+        workflow "example" {
+            resolves = "b"
+        }
+
+        action "a" {
+            uses = "sh"
+            args = "ls"
+        }
+
+        action "b" {
+            needs = "a"
+            uses = "sh"
+        }
+        """)
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        self.assertTrue(os.path.isfile(wf.get_cache_file()))
+
+        cached_wf = Workflow('/tmp/test_folder/a.workflow')
+        self.assertTrue(cached_wf.load_from_cache())
+        self.assertEqual(cached_wf._parsed_workflow, None)
+        self.assertEqual(cached_wf.name, 'example')
+        self.assertEqual(cached_wf.resolves, ['b'])
+        self.assertSetEqual(cached_wf.root, {'a'})
+        self.assertDictEqual(cached_wf.action, wf.action)
+
+        self.create_workflow_file("""
+        workflow "example" {
+            resolves = "a"
+        }
+
+        action "a" {
+            uses = "sh"
+        }
+        """)
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        self.assertFalse(wf.load_from_cache())
+
+    def test_diamond_lattice(self):
+        # Every node of a layer needs both nodes of the previous layer, so
+        # there are 2^30 distinct paths from the root to the end action.
+        layers = 30
+        content = """
+        workflow "lattice" {
+            resolves = "end"
+        }
+
+        action "start" {
+            uses = "sh"
+        }
+        """
+        previous = '"start"'
+        for i in range(layers):
+            for side in ['a', 'b']:
+                content += """
+        action "l{}{}" {{
+            needs = [{}]
+            uses = "sh"
+        }}
+        """.format(i, side, previous)
+            previous = '"l{0}a", "l{0}b"'.format(i)
+        content += """
+        action "end" {{
+            needs = [{}]
+            uses = "sh"
+        }}
+        """.format(previous)
+        self.create_workflow_file(content)
+
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        self.assertSetEqual(wf.root, {'start'})
+        self.assertSetEqual(wf.action['l0a']['next'], {'l1a', 'l1b'})
+        wf.check_for_unreachable_actions()
+        self.assertEqual(len(wf.action), 2 * layers + 2)
+        stages = list(wf.get_stages())
+        self.assertEqual(len(stages), layers + 2)
+        self.assertSetEqual(stages[1], {'l0a', 'l0b'})
+        self.assertSetEqual(stages[-1], {'end'})
+
+    def test_deep_chain(self):
+        depth = 1500
+        content = """
+        workflow "chain" {{
+            resolves = "a{}"
+        }}
+
+        action "a0" {{
+            uses = "sh"
+        }}
+        """.format(depth - 1)
+        for i in range(1, depth):
+            content += """
+        action "a{}" {{
+            needs = "a{}"
+            uses = "sh"
+        }}
+        """.format(i, i - 1)
+        self.create_workflow_file(content)
+
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        self.assertSetEqual(wf.root, {'a0'})
+        wf.check_for_unreachable_actions()
+        self.assertEqual(len(wf.action), depth)
+        self.assertEqual(wf.get_action_level('a{}'.format(depth - 1)),
+                         depth - 1)
+
     def test_get_stages(self):
         self.create_workflow_file("""
         workflow "example" {
@@ -799,3 +1311,50 @@ class TestParser(unittest.TestCase):
             {'h'},
             {'end'}
         ])
+
+        self.create_workflow_file("""
+        workflow "example" {
+            resolves = ["end"]
+        }
+
+        action "a" {
+            uses = "sh"
+        }
+
+        action "x" {
+            needs = "a"
+            uses = "sh"
+        }
+
+        action "y" {
+            needs = "x"
+            uses = "sh"
+        }
+
+        action "b" {
+            needs = ["a", "y"]
+            uses = "sh"
+        }
+
+        action "end" {
+            needs = ["b", "x"]
+            uses = "sh"
+        }
+        """)
+        wf = Workflow('/tmp/test_folder/a.workflow')
+        wf.parse()
+        stages = list()
+        for stage in wf.get_stages():
+            stages.append(stage)
+
+        self.assertListEqual(stages, [
+            {'a'},
+            {'x'},
+            {'y'},
+            {'b'},
+            {'end'}
+        ])
+        self.assertEqual(wf.get_action_level('a'), 0)
+        self.assertEqual(wf.get_action_level('b'), 3)
+        self.assertEqual(wf.get_action_level('end'), 4)
+        self.assertEqual(wf.get_action_level('missing'), None)
@@ -189,6 +189,13 @@ class TestUtils(unittest.TestCase):
                 os.environ['HOME'],
                 '.cache/.popper/search/.popper_search_cache.yml'))
 
+    def test_setup_workflow_cache(self):
+        workflow_cache_dir = pu.setup_workflow_cache()
+        self.assertEqual(
+            workflow_cache_dir,
+            os.path.join(os.environ['HOME'], '.cache/.popper/workflows'))
+        self.assertTrue(os.path.isdir(workflow_cache_dir))
+
     def test_of_type(self):
         param = [u"hello", u"world"]
         self.assertEqual(pu.of_type(param, ['los']), True)
@@ -214,3 +221,18 @@ class TestUtils(unittest.TestCase):
     def test_get_id(self):
         id = pu.get_id('abcd', 1234, 'efgh')
         self.assertEqual(id, 'cbae02068489f7577862718287862a3b')
+
+    def test_parse_memory(self):
+        self.assertEqual(pu.parse_memory('512m'), 512 * 1024 ** 2)
+        self.assertEqual(pu.parse_memory('1.5GB'), 3 * 1024 ** 3 // 2)
+        self.assertEqual(pu.parse_memory('2k'), 2048)
+        self.assertEqual(pu.parse_memory(100), 100)
+        self.assertIsNone(pu.parse_memory('1x'))
+        self.assertIsNone(pu.parse_memory(''))
+
+    def test_parse_duration(self):
+        self.assertEqual(pu.parse_duration('90'), 90)
+        self.assertEqual(pu.parse_duration('30s'), 30)
+        self.assertEqual(pu.parse_duration('1.5h'), 5400)
+        self.assertEqual(pu.parse_duration(2), 2)
+        self.assertIsNone(pu.parse_duration('soon'))